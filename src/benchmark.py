@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the preprocessing and imputation functions, on synthetic data.
+The results of each run are saved, and compared with a previous run.
+"""
+
+import click
+import glob
+import json
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import traceback
+import pandas as pd
+import src.data.imputer as imp
+import src.data.missing_data as md
+import src.data.preprocessing as pp
+import src.data.schema as schema
+from src.data import ROOT_DIR, DATA_SYNTHETIC, RAW_FILES
+from src.data.synthetic import city_name, create_synthetic_city
+from src.profiling import profiled, profiling
+from src.utils import cluster_corr, pairwise_corr
+
+BENCHMARKS_DIR = os.path.join(ROOT_DIR, 'reports', 'benchmarks')
+BENCHMARKS = ['transform_all', 'fill_missing', 'fill_df_in_time',
+              'cluster_corr', 'pairwise_corr']
+
+# A metric is a regression if it grew more than this fraction.
+THRESHOLD = 0.2
+METRICS = ['wall_s', 'peak_alloc_mb']
+
+
+@click.command()
+@click.option('--scale', 'scales', type=float, multiple=True,
+              help='The size of the data relative to Seattle (can be '
+                   'repeated; 1 by default).')
+@click.option('--benchmark', 'benchmarks', multiple=True,
+              type=click.Choice(BENCHMARKS),
+              help='A benchmark to run (can be repeated; all by default).')
+@click.option('--baseline', type=click.Path(exists=True), default=None,
+              help='The results to compare with (the latest saved run by '
+                   'default).')
+@click.option('--threshold', type=float, default=THRESHOLD,
+              help='The relative growth that is flagged as a regression.')
+def main(scales, benchmarks, baseline, threshold):
+    """ Runs the benchmarks, saves the results and flags regressions. """
+    logger = logging.getLogger(__name__)
+    if baseline is None:
+        baseline = latest_results()
+    results = run_benchmarks(scales or (1,), benchmarks or BENCHMARKS)
+    path = save_results(results)
+    logger.info('Results saved to {}'.format(path))
+    if baseline is None:
+        return
+    comparison = compare(results, load_results(baseline), threshold)
+    logger.info('Compared with {}:\n{}'.format(baseline,
+                                               comparison.to_string()))
+    if comparison.regression.any():
+        logger.error('Regressions: {}'.format(', '.join(
+            comparison.index[comparison.regression].map(
+                lambda key: '{} ({}x)'.format(*key)))))
+        raise SystemExit(1)
+
+
+def run_benchmarks(scales=(1,), benchmarks=BENCHMARKS,
+                   data_dir=DATA_SYNTHETIC, seed=0):
+    """
+    Runs the benchmarks on synthetic cities (they are generated if they don't
+    exist). Each benchmark runs on the outputs of the previous steps, which
+    are computed even if they are not benchmarked.
+
+    Args:
+        scales (list(float)): The sizes of the data, relative to Seattle.
+        benchmarks (list(str)): The benchmarks to run (see BENCHMARKS).
+        data_dir (str): The directory of the synthetic cities (their raw
+            files; nothing is written to the interim or processed data).
+        seed (int): The seed of the synthetic data.
+    Returns:
+        list(dict): The 'benchmark', 'scale', 'status', time, memory and
+            rows of each run.
+    """
+    logger = logging.getLogger(__name__)
+    results = list()
+    for scale in scales:
+        city = city_name(scale)
+        if not all(os.path.exists(os.path.join(data_dir, city, name))
+                   for name in RAW_FILES):
+            logger.info('Creating the {} data'.format(city))
+            create_synthetic_city(scale, data_dir, seed=seed)
+
+        calendar, listings, reviews = pp.load_data(data_dir, city)
+        # The column kinds are not saved with those of the real cities
+        with tempfile.TemporaryDirectory() as interim_dir:
+            listings_cols_df = schema.load_column_kinds(
+                os.path.join(data_dir, city, 'listings.csv'), listings,
+                os.path.join(interim_dir, 'listings_cols_df.pkl'))
+        data = dict()
+        steps = [
+            ('transform_all', pp.transform_all,
+             lambda: (calendar.copy(), listings.copy(), reviews.copy())),
+            ('fill_missing', md.fill_missing,
+             lambda: tuple(df.copy() for df in data['transform_all']) +
+             (False, city, imp.ListingsImputer(listings_cols_df))),
+            ('fill_df_in_time', md.fill_df_in_time,
+             lambda: (data['transform_all'][0].copy(),)),
+            ('cluster_corr', cluster_corr,
+             lambda: (md.get_ts(data['fill_missing'][0]),)),
+            ('pairwise_corr', pairwise_corr,
+             lambda: (md.get_ts(data['transform_all'][0], dropna=False),)),
+        ]
+        for name, fun, get_args in steps:
+            if name not in benchmarks and not any(
+                    _needs(other, name) for other in benchmarks):
+                continue
+            logger.info('Running {} ({}x)'.format(name, scale))
+            result = _run_benchmark(fun, get_args, name, scale)
+            data[name] = result.pop('output', None)
+            if name in benchmarks:
+                results.append(result)
+    return results
+
+
+def _needs(benchmark, step):
+    """ Whether a benchmark needs the outputs of a step. """
+    dependencies = {'fill_missing': ['transform_all'],
+                    'fill_df_in_time': ['transform_all'],
+                    'cluster_corr': ['transform_all', 'fill_missing'],
+                    'pairwise_corr': ['transform_all']}
+    return step in dependencies.get(benchmark, [])
+
+
+def _run_benchmark(fun, get_args, name, scale):
+    """ Runs one benchmark, and records its results or its error. """
+    result = {'benchmark': name, 'scale': scale}
+    try:
+        args = get_args()
+    except Exception:
+        result.update(status='skipped', error=traceback.format_exc())
+        return result
+
+    with profiling(log_summary=False) as records:
+        try:
+            output = profiled(fun)(*args)
+        except Exception:
+            output = None
+            result.update(status='failed', error=traceback.format_exc())
+    record = [r for r in records if r['depth'] == 0][-1]
+    result.update({key: record[key] for key in [
+        'wall_s', 'cpu_s', 'peak_alloc_mb', 'peak_rss_mb', 'rows_in',
+        'rows_out']})
+    result.setdefault('status', 'ok')
+    result['output'] = output
+    return result
+
+
+def save_results(results, results_dir=BENCHMARKS_DIR):
+    """
+    Saves the results of a run, with the versions and the git commit that
+    were used.
+
+    Returns:
+        str: The path of the results.
+    """
+    os.makedirs(results_dir, exist_ok=True)
+    run = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'commit': _git_commit(),
+           'python': platform.python_version(),
+           'pandas': pd.__version__,
+           'results': results}
+    path = os.path.join(results_dir, 'benchmark-{}.json'.format(
+        time.strftime('%Y%m%d-%H%M%S')))
+    with open(path, 'w') as results_file:
+        json.dump(run, results_file, indent=2, default=float)
+    return path
+
+
+def load_results(path):
+    """ Loads the results of a saved run. """
+    with open(path) as results_file:
+        return json.load(results_file)['results']
+
+
+def latest_results(results_dir=BENCHMARKS_DIR):
+    """ The path of the latest saved run (None if there are no runs). """
+    paths = sorted(glob.glob(os.path.join(results_dir, 'benchmark-*.json')))
+    return paths[-1] if paths else None
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """
+    Compares the results of two runs.
+
+    Args:
+        results (list(dict)): The results of a run.
+        baseline (list(dict)): The results to compare with.
+        threshold (float): A metric is a regression if it grew more than this
+            fraction.
+    Returns:
+        pandas.DataFrame: For each (benchmark, scale) in both runs and with
+            status 'ok', the ratio of each metric (new / baseline), and
+            whether any of them is a regression.
+    """
+    def ok_results(run):
+        df = pd.DataFrame(run)
+        if df.empty or 'status' not in df:
+            return pd.DataFrame(columns=METRICS)
+        return df[df.status == 'ok'].set_index(['benchmark', 'scale'])
+
+    new = ok_results(results)
+    old = ok_results(baseline)
+    keys = new.index.intersection(old.index)
+    ratios = new.loc[keys, METRICS].astype(float) / \
+        old.loc[keys, METRICS].astype(float)
+    comparison = ratios.add_suffix('_ratio')
+    comparison['regression'] = (ratios > 1 + threshold).any(axis=1)
+    return comparison
+
+
+def _git_commit():
+    """ The current git commit (None if it is unknown). """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
@@ -9,18 +9,108 @@ DATA_RAW = os.path.join(DATA_DIR, 'raw')
 DATA_INTERIM = os.path.join(DATA_DIR, 'interim')
 DATA_EXTERNAL = os.path.join(DATA_DIR, 'external')
 DATA_PROCESSED = os.path.join(DATA_DIR, 'processed')
+DATA_CACHE = os.path.join(DATA_INTERIM, 'cache')
+DATA_SYNTHETIC = os.path.join(DATA_DIR, 'synthetic')
+MODELS_DIR = os.path.join(ROOT_DIR, 'models')
 
 SEATTLE_CALENDAR = os.path.join(DATA_RAW, 'seattle', 'calendar.csv')
 SEATTLE_LISTINGS = os.path.join(DATA_RAW, 'seattle', 'listings.csv')
 SEATTLE_REVIEWS = os.path.join(DATA_RAW, 'seattle', 'reviews.csv')
 
-SEATTLE_LISTINGS_COLS = os.path.join(
-    DATA_INTERIM, 'seattle', 'listings_cols_df.pkl')
+# The raw files of each city, in a folder named as the city.
+RAW_FILES = ['calendar.csv', 'listings.csv', 'reviews.csv']
 
-SEATTLE_CALENDAR_TEMP = os.path.join(DATA_INTERIM, 'seattle', 'calendar.pkl')
-SEATTLE_LISTINGS_TEMP = os.path.join(DATA_INTERIM, 'seattle', 'listings.pkl')
-SEATTLE_REVIEWS_TEMP = os.path.join(DATA_INTERIM, 'seattle', 'reviews.pkl')
 
-SEATTLE_CALENDAR_FINAL = os.path.join(DATA_PROCESSED, 'seattle', 'calendar.pkl')
-SEATTLE_LISTINGS_FINAL = os.path.join(DATA_PROCESSED, 'seattle', 'listings.pkl')
-SEATTLE_REVIEWS_FINAL = os.path.join(DATA_PROCESSED, 'seattle', 'reviews.pkl')
+def find_cities(raw_dir=DATA_RAW):
+    """ The names of the folders in raw_dir that have all the RAW_FILES. """
+    return sorted(
+        city for city in os.listdir(raw_dir)
+        if all(os.path.isfile(os.path.join(raw_dir, city, name))
+               for name in RAW_FILES))
+
+
+def listings_cols_path(city):
+    """ The path of the 'listings_cols_df' of a city. """
+    return os.path.join(DATA_INTERIM, city, 'listings_cols_df.pkl')
+
+
+SEATTLE_LISTINGS_COLS = listings_cols_path('seattle')
+
+
+def imputer_path(city):
+    """ The path of the fitted listings imputer of a city. """
+    return os.path.join(DATA_INTERIM, city, 'listings_imputer.pkl')
+
+
+# The interim and processed tables are saved in this format ('parquet',
+# 'feather' or 'pickle'). It can be changed with the AIRBNB_DATA_FORMAT
+# environment variable.
+EXTENSIONS = {
+    'pickle': '.pkl',
+    'parquet': '.parquet',
+    'feather': '.feather',
+}
+DATA_FORMAT = os.environ.get('AIRBNB_DATA_FORMAT', 'parquet')
+
+
+def table_path(data_dir, city, table, data_format=DATA_FORMAT):
+    """ The path of a table ('calendar', 'listings', ...) of a city. """
+    return os.path.join(data_dir, city, table + EXTENSIONS[data_format])
+
+
+SEATTLE_CALENDAR_TEMP = table_path(DATA_INTERIM, 'seattle', 'calendar')
+SEATTLE_LISTINGS_TEMP = table_path(DATA_INTERIM, 'seattle', 'listings')
+SEATTLE_REVIEWS_TEMP = table_path(DATA_INTERIM, 'seattle', 'reviews')
+
+SEATTLE_CALENDAR_FINAL = table_path(DATA_PROCESSED, 'seattle', 'calendar')
+SEATTLE_LISTINGS_FINAL = table_path(DATA_PROCESSED, 'seattle', 'listings')
+SEATTLE_REVIEWS_FINAL = table_path(DATA_PROCESSED, 'seattle', 'reviews')
+
+
+def memory_report_path(city):
+    """ The path of the memory report of a city (see dtypes.compact_all). """
+    return os.path.join(DATA_PROCESSED, city, 'memory_report.csv')
+
+
+SEATTLE_MEMORY_REPORT = memory_report_path('seattle')
+
+
+def profile_report_path(city):
+    """ The path of the profiling report of a city (see src.profiling). """
+    return os.path.join(DATA_PROCESSED, city, 'profile.json')
+
+
+def price_cube_dir(city, data_dir=DATA_PROCESSED):
+    """ The directory of the price cube of a city (see price_cube). """
+    return os.path.join(data_dir, city, 'price_cube')
+
+
+def feature_matrix_dir(city):
+    """ The directory of the model matrix of a city (see build_features). """
+    return os.path.join(DATA_PROCESSED, city, 'feature_matrix')
+
+
+def featurizer_path(city):
+    """ The path of the fitted listings featurizer of a city. """
+    return os.path.join(DATA_INTERIM, city, 'listings_featurizer.pkl')
+
+
+def model_dir(city, target):
+    """ The directory of the models of a review score of a city. """
+    return os.path.join(MODELS_DIR, city, target)
+
+
+# The map of the Seattle neighbourhoods that notebook 007 uses
+SEATTLE_MAP = os.path.join(DATA_EXTERNAL, 'neighborhoods.geojson')
+
+
+def neighbourhoods_map_path(city):
+    """
+    The GeoJSON map of the neighbourhoods of a city (see src.geo), in a
+    folder named as the city in DATA_EXTERNAL (or SEATTLE_MAP, for Seattle,
+    if it is not there).
+    """
+    path = os.path.join(DATA_EXTERNAL, city, 'neighborhoods.geojson')
+    if city == 'seattle' and not os.path.exists(path):
+        return SEATTLE_MAP
+    return path
@@ -0,0 +1,229 @@
+"""
+An aggregate cube of the calendar: the count, sum and sum of squares of the
+price, the availability and the value rating of the listings, and a price
+histogram, for each (neighbourhood, room_type, property_type, date) cell.
+Any roll-up of the cube is answered from the cells, without the calendar.
+"""
+
+import numpy as np
+import pandas as pd
+from src.data import DATA_PROCESSED, table_path
+from src.data import storage
+
+# The cube dimensions that come from the listings, and their columns
+LISTING_DIMENSIONS = {
+    'neighbourhood': 'neighbourhood_cleansed',
+    'room_type': 'room_type',
+    'property_type': 'property_type',
+}
+DIMENSIONS = list(LISTING_DIMENSIONS) + ['date']
+
+# The listings column of the value rating
+SCORE_COL = 'review_scores_value'
+
+# The price quantiles are interpolated from a histogram with N_BINS
+# log-spaced bins between these prices (the prices outside are in the first
+# or last bin).
+N_BINS = 64
+PRICE_RANGE = (1, 10000)
+PRICE_EDGES = np.geomspace(PRICE_RANGE[0], PRICE_RANGE[1], N_BINS + 1)
+HIST_COLS = ['price_hist_{:02d}'.format(i) for i in range(N_BINS)]
+
+# The additive columns of each cell
+SUM_COLS = ['listing_days',
+            'price_count', 'price_sum', 'price_sum_sq',
+            'available_count', 'available_sum',
+            'score_count', 'score_sum', 'score_sum_sq'] + HIST_COLS
+
+QUANTILES = (0.25, 0.5, 0.75)
+
+
+def build_aggregate_cube(city='seattle', data_dir=DATA_PROCESSED):
+    """
+    Builds the aggregate cube of a city from its processed calendar and
+    listings, and saves it as the 'aggregate_cube' table of the city. Each
+    listing counts once per date, so the value ratings are weighted by the
+    number of dates of each listing.
+
+    Returns:
+        AggregateCube: The cube.
+    """
+    calendar = storage.load_table(
+        table_path(data_dir, city, 'calendar'),
+        columns=['listing_id', 'date', 'available', 'price'])
+    listings = storage.load_table(
+        table_path(data_dir, city, 'listings'),
+        columns=['id', SCORE_COL] + list(LISTING_DIMENSIONS.values()))
+    cells = aggregate(calendar, listings)
+    storage.save_table(cells, table_path(data_dir, city, 'aggregate_cube'))
+    return AggregateCube(cells)
+
+
+def aggregate(calendar, listings):
+    """
+    Aggregates a processed calendar in the cells of the cube (only the cells
+    with data), with numpy.bincount over the cell codes. The rows without a
+    date, or of a listing that is not in the listings, are left out. The
+    listings without some dimension are kept, with that dimension missing.
+
+    Returns:
+        pandas.DataFrame: The DIMENSIONS and SUM_COLS of each cell.
+    """
+    rows = pd.Index(listings.id).get_indexer(calendar.listing_id)
+    is_valid = (rows >= 0) & calendar.date.notnull().values
+    calendar = calendar[is_valid]
+    rows = rows[is_valid]
+    group_codes, groups = pd.MultiIndex.from_frame(
+        listings[list(LISTING_DIMENSIONS.values())].astype(object)).factorize()
+    date_codes, dates = pd.factorize(calendar.date, sort=True)
+    cell_codes, cells = pd.factorize(
+        group_codes[rows].astype(np.int64) * len(dates) + date_codes,
+        sort=True)
+    n_cells = len(cells)
+
+    def sums(values):
+        is_valid = ~np.isnan(values)
+        return (np.bincount(cell_codes[is_valid], minlength=n_cells),
+                np.bincount(cell_codes[is_valid], values[is_valid],
+                            minlength=n_cells),
+                np.bincount(cell_codes[is_valid], values[is_valid] ** 2,
+                            minlength=n_cells))
+
+    price = calendar.price.values.astype(np.float64)
+    available = calendar.available.astype(float).values
+    score = listings[SCORE_COL].values.astype(np.float64)[rows]
+    result = pd.DataFrame({
+        name: pd.Categorical.from_codes(
+            group_codes_of_cell, categories=pd.Index(level).astype(str))
+        for name, group_codes_of_cell, level in _group_levels(
+            groups, cells // len(dates))})
+    result['date'] = dates[cells % len(dates)]
+    result['listing_days'] = np.bincount(cell_codes, minlength=n_cells)
+    (result['price_count'], result['price_sum'],
+     result['price_sum_sq']) = sums(price)
+    result['available_count'], result['available_sum'], _ = sums(available)
+    (result['score_count'], result['score_sum'],
+     result['score_sum_sq']) = sums(score)
+
+    is_priced = ~np.isnan(price)
+    bins = np.clip(np.searchsorted(PRICE_EDGES, price[is_priced],
+                                   side='right') - 1, 0, N_BINS - 1)
+    hist = np.bincount(cell_codes[is_priced] * N_BINS + bins,
+                       minlength=n_cells * N_BINS).reshape(n_cells, N_BINS)
+    hist = pd.DataFrame(hist.astype(np.int32), columns=HIST_COLS)
+    return pd.concat([result, hist], axis=1)
+
+
+def _group_levels(groups, group_codes):
+    """
+    The name, codes (of some cells) and categories of each listing
+    dimension, from the factorized (neighbourhood, room_type,
+    property_type) groups. The missing values are not imputed in those
+    columns: they keep the code -1, so they are missing in the cube too
+    (and not a 'nan' category).
+    """
+    for i, name in enumerate(LISTING_DIMENSIONS):
+        codes, levels = pd.factorize(groups.get_level_values(i), sort=True)
+        yield name, codes[group_codes], levels
+
+
+def open_aggregate_cube(city='seattle', data_dir=DATA_PROCESSED):
+    """ Loads the aggregate cube of a city. """
+    return AggregateCube(storage.load_table(
+        table_path(data_dir, city, 'aggregate_cube')))
+
+
+class AggregateCube(object):
+    """
+    The cells of an aggregate cube, that answers roll-up queries.
+
+    Attributes:
+        cells (pandas.DataFrame): The DIMENSIONS (the listing dimensions as
+            categories) and SUM_COLS of each cell.
+    """
+
+    def __init__(self, cells):
+        self.cells = cells
+
+    def query(self, by=(), start=None, end=None, quantiles=QUANTILES,
+              **filters):
+        """
+        Rolls up the cube to some dimensions.
+
+        Args:
+            by (list(str)): The dimensions to keep (the others are rolled
+                up).
+            start: The first date (included).
+            end: The last date (included).
+            quantiles (tuple(float)): The price quantiles to compute (they
+                are interpolated from the price histograms).
+            filters: The values of some listing dimensions, like
+                room_type='Private room' or neighbourhood=['Belltown',
+                'Fremont'].
+        Returns:
+            pandas.DataFrame: The 'listing_days', 'mean_price', 'std_price',
+                price quantiles ('price_p<percent>'), 'availability' (the
+                fraction of available listing-days), 'mean_score' and
+                'std_score' (of the value rating) of each group (the
+                listings without a dimension are in its NaN group).
+        """
+        by = list(by)
+        mask = np.ones(len(self.cells), dtype=bool)
+        if start is not None:
+            mask &= (self.cells.date >= pd.Timestamp(start)).values
+        if end is not None:
+            mask &= (self.cells.date <= pd.Timestamp(end)).values
+        for name, values in filters.items():
+            if name not in LISTING_DIMENSIONS:
+                raise ValueError('Unknown dimension: {}'.format(name))
+            values = [values] if isinstance(values, str) else list(values)
+            mask &= self.cells[name].isin(values).values
+        cells = self.cells[mask]
+        if by:
+            sums = cells.groupby(by, observed=True,
+                                 dropna=False)[SUM_COLS].sum()
+        else:
+            sums = cells[SUM_COLS].sum().to_frame().T
+        return summarize(sums, quantiles)
+
+
+def summarize(sums, quantiles=QUANTILES):
+    """ The statistics of some groups of cells, from their sums. """
+    result = pd.DataFrame(index=sums.index)
+    result['listing_days'] = sums.listing_days
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result['mean_price'], result['std_price'] = _mean_std(
+            sums.price_count, sums.price_sum, sums.price_sum_sq)
+        hist = sums[HIST_COLS].values
+        for q in quantiles:
+            result['price_p{:g}'.format(100 * q)] = hist_quantile(hist, q)
+        result['availability'] = sums.available_sum / sums.available_count
+        result['mean_score'], result['std_score'] = _mean_std(
+            sums.score_count, sums.score_sum, sums.score_sum_sq)
+    return result
+
+
+def _mean_std(count, total, total_sq):
+    """ The mean and the standard deviation (ddof=1) from the sums. """
+    mean = total / count
+    var = (total_sq - count * mean ** 2) / (count - 1)
+    return mean, np.sqrt(np.clip(var, 0, None))
+
+
+def hist_quantile(hist, q):
+    """
+    Interpolates a quantile of each row of price histograms (linearly in the
+    log of the price, within the bin of the quantile).
+    """
+    cumulative = np.cumsum(hist, axis=1)
+    total = cumulative[:, -1]
+    target = q * total
+    bins = np.minimum((cumulative < target[:, None]).sum(axis=1), N_BINS - 1)
+    rows = np.arange(len(hist))
+    before = cumulative[rows, bins] - hist[rows, bins]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fraction = np.clip((target - before) / hist[rows, bins], 0, 1)
+    log_edges = np.log(PRICE_EDGES)
+    values = np.exp(log_edges[bins] +
+                    fraction * (log_edges[bins + 1] - log_edges[bins]))
+    return np.where(total > 0, values, np.nan)
@@ -0,0 +1,167 @@
+""" An on-disk cache for the outputs of the stages of the data pipeline. """
+
+import hashlib
+import inspect
+import json
+import logging
+import os
+import shutil
+import uuid
+import pandas as pd
+from src.data import DATA_CACHE
+from src.profiling import profiled_call
+
+# The cache is trimmed to this size (in bytes) after each run, removing the
+# least recently used entries first. It can be changed with the
+# AIRBNB_CACHE_MAX_BYTES environment variable.
+CACHE_MAX_BYTES = int(os.environ.get('AIRBNB_CACHE_MAX_BYTES', 2 * 2 ** 30))
+
+
+def run_pipeline(stages, inputs, cache_dir=DATA_CACHE,
+                 max_bytes=CACHE_MAX_BYTES):
+    """
+    Runs a sequence of stages, loading their outputs from the cache when
+    possible. Each stage is keyed by the key of the previous stage (or the
+    pipeline inputs, for the first one), the source code of its modules and
+    its parameters. Only the last stage that is cached is loaded; the stages
+    after it are run and cached. While profiling, the load is recorded as the
+    '<name> stage (cache)' step, since the steps of the loaded stages don't
+    run.
+
+    Args:
+        stages (list(tuple)): The stages, as (name, fun, modules, params)
+            tuples. 'fun' takes the outputs of the previous stage (nothing,
+            for the first stage) and returns a tuple of dataframes (or other
+            picklable objects). 'modules' are the modules whose code
+            determines the results, and 'params' a JSON-serializable dict of
+            parameters.
+        inputs (list): JSON-serializable fingerprints of the data that the
+            first stage reads (see utils.file_fingerprint).
+        cache_dir (str): The directory of the cache.
+        max_bytes (int): The maximum size of the cache.
+    Returns:
+        tuple: The outputs of the last stage.
+    """
+    logger = logging.getLogger(__name__)
+    keys = list()
+    key = inputs
+    for name, fun, modules, params in stages:
+        key = stage_key(name, key, modules, params)
+        keys.append(key)
+
+    start = 0
+    data = None
+    for i in reversed(range(len(stages))):
+        if has_entry(keys[i], cache_dir):
+            logger.info('Loading the {} stage from the cache'.format(
+                stages[i][0]))
+            data = profiled_call('{} stage (cache)'.format(stages[i][0]),
+                                 load_entry, keys[i], cache_dir)
+            start = i + 1
+            break
+
+    for i in range(start, len(stages)):
+        name, fun = stages[i][:2]
+        logger.info('Running the {} stage'.format(name))
+        data = fun() if data is None else fun(*data)
+        save_entry(data, keys[i], cache_dir)
+    evict(cache_dir, max_bytes)
+    return data
+
+
+def stage_key(name, inputs, modules=(), params=None):
+    """
+    The key of a stage in the cache.
+
+    Args:
+        name (str): The name of the stage.
+        inputs: A JSON-serializable fingerprint of the inputs.
+        modules (list(module)): The modules that define the stage.
+        params (dict): JSON-serializable parameters of the stage.
+    Returns:
+        str: A SHA-1 hex digest.
+    """
+    content = {'name': name,
+               'inputs': inputs,
+               'code': [source_fingerprint(module) for module in modules],
+               'params': params or dict(),
+               'pandas': pd.__version__}
+    return hashlib.sha1(
+        json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def source_fingerprint(module):
+    """ The SHA-1 of the source code of a module. """
+    with open(inspect.getsourcefile(module), 'rb') as source:
+        return hashlib.sha1(source.read()).hexdigest()
+
+
+def entry_dir(key, cache_dir=DATA_CACHE):
+    """ The directory of a cache entry. """
+    return os.path.join(cache_dir, key)
+
+
+def has_entry(key, cache_dir=DATA_CACHE):
+    """ Whether a key is in the cache. """
+    return os.path.isdir(entry_dir(key, cache_dir))
+
+
+def load_entry(key, cache_dir=DATA_CACHE):
+    """
+    Loads the values of a cache entry, and marks it as recently used.
+    """
+    path = entry_dir(key, cache_dir)
+    os.utime(path)
+    n_tables = len(os.listdir(path))
+    return tuple(pd.read_pickle(os.path.join(path, '{}.pkl'.format(i)))
+                 for i in range(n_tables))
+
+
+def save_entry(data, key, cache_dir=DATA_CACHE):
+    """
+    Saves a tuple of dataframes (or other picklable objects) as a cache
+    entry. The entry is written to a temporary directory first, so that an
+    interrupted run doesn't leave incomplete entries.
+    """
+    path = entry_dir(key, cache_dir)
+    temp_path = os.path.join(cache_dir, 'tmp-' + uuid.uuid4().hex)
+    os.makedirs(temp_path)
+    for i, value in enumerate(data):
+        pd.to_pickle(value, os.path.join(temp_path, '{}.pkl'.format(i)))
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(temp_path, path)
+
+
+def evict(cache_dir=DATA_CACHE, max_bytes=CACHE_MAX_BYTES):
+    """
+    Removes the least recently used entries until the cache is not larger
+    than max_bytes.
+
+    Returns:
+        list(str): The keys of the removed entries.
+    """
+    if not os.path.isdir(cache_dir):
+        return list()
+    entries = list()
+    for key in os.listdir(cache_dir):
+        # Entries being written by other processes are skipped, and so are
+        # the ones that other processes remove meanwhile.
+        if key.startswith('tmp-'):
+            continue
+        path = entry_dir(key, cache_dir)
+        try:
+            size = sum(os.path.getsize(os.path.join(path, f))
+                       for f in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, key))
+        except FileNotFoundError:
+            continue
+
+    removed = list()
+    total = sum(size for _, size, _ in entries)
+    for _, size, key in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry_dir(key, cache_dir), ignore_errors=True)
+        total -= size
+        removed.append(key)
+    return removed
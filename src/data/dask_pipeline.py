@@ -0,0 +1,227 @@
+"""
+An optional Dask backend for the calendar and the reviews. The calendars are
+read in partitions, transformed and filled on a local cluster of processes,
+and written as directories of parquet files, so that calendars larger than
+the memory can be processed using all the cores. The listings are small, and
+they are processed with pandas; the reviews of each city are streamed in
+chunks, in one task.
+"""
+
+from contextlib import contextmanager
+import logging
+import os
+import time
+import traceback
+import pandas as pd
+import src.data.dtypes as dt
+import src.data.imputer as imp
+import src.data.incremental as inc
+import src.data.missing_data as md
+import src.data.preprocessing as pp
+import src.data.schema as schema
+from src.data import make_dataset
+from src.data import storage
+from src.data import DATA_RAW, DATA_INTERIM, DATA_PROCESSED, DATA_FORMAT, \
+    find_cities, imputer_path, listings_cols_path, table_path
+
+# The size of the partitions of the raw calendars, in bytes
+BLOCKSIZE = 64 * 2 ** 20
+
+RAW_CALENDAR_DTYPES = {'listing_id': 'int64', 'date': object,
+                       'available': object, 'price': object}
+
+# The number of rows of the chunks of the raw reviews
+REVIEWS_CHUNKSIZE = 100000
+
+# The text columns of the reviews are read as text in every chunk (a chunk
+# where they are all missing would be read as floats).
+RAW_REVIEWS_DTYPES = {'reviewer_name': object, 'comments': object}
+
+
+@contextmanager
+def local_cluster(n_workers=None, max_memory=None):
+    """
+    Starts a local dask cluster, with one single-threaded process per
+    worker. The workers spill their data to disk when they reach their share
+    of max_memory.
+
+    Args:
+        n_workers (int): The number of processes (one per CPU by default).
+        max_memory (int): The memory of all the workers, in bytes (dask
+            decides by default).
+    Yields:
+        distributed.Client: A client of the cluster.
+    """
+    from dask.distributed import Client, LocalCluster
+    n_workers = n_workers or os.cpu_count()
+    memory_limit = 'auto' if max_memory is None else max_memory // n_workers
+    with LocalCluster(n_workers=n_workers, threads_per_worker=1,
+                      processes=True, memory_limit=memory_limit) as cluster:
+        with Client(cluster) as client:
+            yield client
+
+
+def create_datasets(raw_dir=DATA_RAW, cities=None, n_workers=None,
+                    max_memory=None, blocksize=BLOCKSIZE):
+    """
+    Creates the datasets of many cities, like make_dataset.create_dataset,
+    on a local dask cluster. The calendars and reviews of all the cities are
+    processed at the same time. A city that fails doesn't stop the others.
+    The tables are saved in parquet format only.
+
+    Args:
+        raw_dir (str): The directory that contains one folder per city.
+        cities (list(str)): The cities to process (all the cities in raw_dir
+            by default).
+        n_workers (int): The number of processes (one per CPU by default).
+        max_memory (int): The memory of the cluster, in bytes.
+        blocksize (int): The size of the partitions of the raw calendars.
+    Returns:
+        list(tuple): The (city, status, seconds, error) of each city.
+    """
+    if DATA_FORMAT != 'parquet':
+        raise ValueError('The dask backend only saves parquet tables.')
+    logger = logging.getLogger(__name__)
+    if cities is None:
+        cities = find_cities(raw_dir)
+    start = time.time()
+    results = list()
+    with local_cluster(n_workers, max_memory) as client, _object_strings():
+        futures = dict()
+        for city in cities:
+            try:
+                futures[city] = client.compute(
+                    city_graph(raw_dir, city, blocksize))
+            except Exception:
+                logger.exception('{} failed'.format(city))
+                results.append((city, 'failed', time.time() - start,
+                                traceback.format_exc()))
+        for city, city_futures in futures.items():
+            try:
+                client.gather(city_futures)
+                make_dataset.finalize_dataset(city)
+            except Exception:
+                logger.exception('{} failed'.format(city))
+                results.append((city, 'failed', time.time() - start,
+                                traceback.format_exc()))
+                continue
+            logger.info('The processed data of {} is ready.'.format(city))
+            results.append((city, 'ok', time.time() - start, None))
+    return results
+
+
+@contextmanager
+def _object_strings():
+    """
+    Keeps the text as object columns, as pandas reads it (dask converts it to
+    arrow strings by default, with different missing values).
+    """
+    import dask
+    with dask.config.set({'dataframe.convert-string': False}):
+        yield
+
+
+def city_graph(raw_dir, city, blocksize=BLOCKSIZE):
+    """
+    Processes the listings of a city (with pandas), and builds the dask
+    computations that process and save its calendar (in partitions) and its
+    reviews.
+
+    Returns:
+        list: The computations that save the interim and processed calendar
+            and reviews.
+    """
+    from dask import delayed
+    inc.remove_row_hashes(city)
+    listings = pd.read_csv(os.path.join(raw_dir, city, 'listings.csv'))
+    listings_cols_df = schema.load_column_kinds(
+        os.path.join(raw_dir, city, 'listings.csv'), listings,
+        listings_cols_path(city))
+    listings = pp.transform_listings(listings, listings_cols_df)
+    prices = listings[['id', 'price']]
+    ids_dtype = dt.id_dtype(listings.id)
+    imputer = imp.ListingsImputer(listings_cols_df)
+    listings = md.fill_listings_na(listings, imputer)
+    imputer.save(imputer_path(city))
+    storage.save_table(listings, table_path(DATA_INTERIM, city, 'listings'))
+    storage.save_table(dt.compact_listings(listings),
+                       table_path(DATA_PROCESSED, city, 'listings'))
+
+    calendar = fill_calendar(read_calendar(raw_dir, city, blocksize), prices)
+    return [
+        _to_parquet(calendar, city, 'calendar', DATA_INTERIM),
+        _to_parquet(calendar.map_partitions(
+            dt.compact_calendar, ids_dtype,
+            meta=dt.compact_calendar(calendar._meta, ids_dtype)),
+            city, 'calendar', DATA_PROCESSED),
+        delayed(process_reviews)(raw_dir, city, ids_dtype),
+    ]
+
+
+def read_calendar(raw_dir, city, blocksize=BLOCKSIZE):
+    """ Reads the raw calendar of a city, in partitions of blocksize bytes. """
+    import dask.dataframe as dd
+    return dd.read_csv(os.path.join(raw_dir, city, 'calendar.csv'),
+                       blocksize=blocksize, dtype=RAW_CALENDAR_DTYPES)
+
+
+def fill_calendar(calendar, prices):
+    """
+    Transforms and fills a dask calendar. The transformations are mapped
+    over the partitions, and the calendar is then shuffled so that all the
+    rows of each listing are in the same partition, to be filled in time.
+
+    Args:
+        calendar (dask.dataframe.DataFrame): A raw calendar.
+        prices (pandas.DataFrame): The 'id' and transformed 'price' of the
+            listings, to fill the prices that are missing in all the dates
+            of a listing.
+    Returns:
+        dask.dataframe.DataFrame: The filled calendar.
+    """
+    meta = _transform_calendar(calendar._meta.astype(RAW_CALENDAR_DTYPES))
+    calendar = calendar.map_partitions(_transform_calendar, meta=meta)
+    calendar = calendar.shuffle('listing_id')
+    return calendar.map_partitions(_fill_calendar, prices, meta=meta)
+
+
+def _transform_calendar(calendar):
+    """ Transforms a partition of the calendar. """
+    return pp.transform_calendar(calendar.astype(RAW_CALENDAR_DTYPES))
+
+
+def _fill_calendar(calendar, prices):
+    """ Fills a partition of the calendar that has complete listings. """
+    return md.fill_calendar_na(calendar, prices)
+
+
+def process_reviews(raw_dir, city, ids_dtype='int32',
+                    chunksize=REVIEWS_CHUNKSIZE):
+    """
+    Transforms, fills and saves the reviews of a city. The raw file is
+    streamed in chunks of chunksize rows (pandas parses the line breaks of
+    the quoted comments), so only one chunk is in memory at a time. The
+    chunks are saved to the interim table, and compacted to the processed
+    one, like make_dataset.create_dataset_by_chunks does.
+
+    Returns:
+        int: The number of reviews that were saved.
+    """
+    reviews = pd.read_csv(os.path.join(raw_dir, city, 'reviews.csv'),
+                          chunksize=chunksize, dtype=RAW_REVIEWS_DTYPES)
+    reviews = (md.fill_reviews_na(pp.transform_reviews(chunk))
+               for chunk in reviews)
+    return storage.save_chunks(reviews, {
+        table_path(DATA_INTERIM, city, 'reviews'): None,
+        table_path(DATA_PROCESSED, city, 'reviews'):
+            lambda chunk: dt.compact_reviews(chunk, ids_dtype)})
+
+
+def _to_parquet(df, city, table, data_dir):
+    """
+    The computation that saves a dask table as a directory of parquet files
+    (any previous version of the table is removed first).
+    """
+    path = table_path(data_dir, city, table)
+    storage.remove_table(path)
+    return df.to_parquet(path, write_index=False, compute=False)
@@ -0,0 +1,221 @@
+"""
+A lazy handle of the processed tables of a city. Opening it reads nothing:
+the column selections and row filters are kept, and pushed down to the
+storage layer (see storage.load_table) when a table is loaded, at once or in
+chunks.
+"""
+
+import pandas as pd
+from src.data import DATA_PROCESSED, table_path
+from src.data import storage
+
+TABLES = ['calendar', 'listings', 'reviews']
+
+# The columns of each table that the dataset filters apply to
+DATE_COLS = {'calendar': 'date', 'reviews': 'date'}
+LISTING_ID_COLS = {'calendar': 'listing_id', 'listings': 'id',
+                   'reviews': 'listing_id'}
+NEIGHBOURHOOD_COL = 'neighbourhood_cleansed'
+
+
+class LazyTable(object):
+    """
+    A table that is not read yet, with the columns to read and the conditions
+    that the rows must meet. The methods that narrow it return a new table.
+
+    Attributes:
+        path (str): The path of the table.
+        columns (list(str)): The columns to read (None for all of them).
+        filters (list(tuple)): The (column, operator, value) conditions of
+            the rows (see storage.load_table).
+    """
+
+    def __init__(self, path, columns=None, filters=None):
+        self.path = path
+        self.columns = columns
+        self.filters = list(filters or [])
+
+    def select(self, columns):
+        """ The same table, with only some columns. """
+        return LazyTable(self.path, list(columns), self.filters)
+
+    def where(self, column, op, value):
+        """ The same table, with one more condition on the rows. """
+        return LazyTable(self.path, self.columns,
+                         self.filters + [(column, op, value)])
+
+    def load(self, memory_map=False):
+        """ Reads the selected rows and columns. """
+        return storage.load_table(self.path, columns=self.columns,
+                                  filters=self.filters or None,
+                                  memory_map=memory_map)
+
+    def iter_chunks(self, chunk_rows=storage.ROW_GROUP_SIZE):
+        """
+        Reads the selected rows and columns in chunks of at most chunk_rows
+        rows (see storage.iter_table).
+        """
+        return storage.iter_table(self.path, columns=self.columns,
+                                  filters=self.filters or None,
+                                  chunk_rows=chunk_rows)
+
+    def __repr__(self):
+        return 'LazyTable({!r}, columns={}, filters={})'.format(
+            self.path, self.columns, self.filters)
+
+
+class Dataset(object):
+    """
+    The processed calendar, listings and reviews of a city, with some row
+    filters that apply to all of them:
+        - start and end: the dates of the calendar and the reviews (both
+          included).
+        - listing_ids: the listings (the 'id' of the listings, and the
+          'listing_id' of the calendar and the reviews).
+        - neighbourhoods: the neighbourhood_cleansed of the listings. The
+          calendar and the reviews are filtered by the ids of those listings,
+          that are read (only the two columns) the first time they are
+          needed.
+
+    Attributes:
+        city (str): The city.
+        data_dir (str): The directory of the processed data.
+        start (pandas.Timestamp): The first date.
+        end (pandas.Timestamp): The last date.
+        listing_ids (list): The listings.
+        neighbourhoods (list(str)): The neighbourhoods.
+    """
+
+    def __init__(self, city='seattle', data_dir=DATA_PROCESSED, start=None,
+                 end=None, listing_ids=None, neighbourhoods=None):
+        self.city = city
+        self.data_dir = data_dir
+        self.start = None if start is None else pd.Timestamp(start)
+        self.end = None if end is None else pd.Timestamp(end)
+        self.listing_ids = None if listing_ids is None else list(listing_ids)
+        self.neighbourhoods = (None if neighbourhoods is None else
+                               _as_list(neighbourhoods))
+        self._neighbourhood_ids = None
+
+    def filter(self, start=None, end=None, listing_ids=None,
+               neighbourhoods=None):
+        """
+        The same dataset, with more filters (they are combined with the
+        current ones).
+        """
+        if listing_ids is not None and self.listing_ids is not None:
+            listing_ids = pd.Index(self.listing_ids).intersection(
+                listing_ids)
+        if neighbourhoods is not None and self.neighbourhoods is not None:
+            neighbourhoods = [n for n in _as_list(neighbourhoods)
+                              if n in self.neighbourhoods]
+        return Dataset(self.city, self.data_dir,
+                       _latest(self.start, start), _earliest(self.end, end),
+                       self.listing_ids if listing_ids is None
+                       else listing_ids,
+                       self.neighbourhoods if neighbourhoods is None
+                       else neighbourhoods)
+
+    def table(self, name):
+        """ A lazy table ('calendar', 'listings' or 'reviews'). """
+        table = LazyTable(table_path(self.data_dir, self.city, name))
+        if name in DATE_COLS:
+            if self.start is not None:
+                table = table.where(DATE_COLS[name], '>=', self.start)
+            if self.end is not None:
+                table = table.where(DATE_COLS[name], '<=', self.end)
+        if self.listing_ids is not None:
+            table = table.where(LISTING_ID_COLS[name], 'in',
+                                self.listing_ids)
+        if self.neighbourhoods is not None:
+            if name == 'listings':
+                table = table.where(NEIGHBOURHOOD_COL, 'in',
+                                    self.neighbourhoods)
+            else:
+                table = table.where(LISTING_ID_COLS[name], 'in',
+                                    self.neighbourhood_ids())
+        return table
+
+    @property
+    def calendar(self):
+        """ The lazy calendar. """
+        return self.table('calendar')
+
+    @property
+    def listings(self):
+        """ The lazy listings. """
+        return self.table('listings')
+
+    @property
+    def reviews(self):
+        """ The lazy reviews. """
+        return self.table('reviews')
+
+    def neighbourhood_ids(self):
+        """ The ids of the listings in the neighbourhoods of the filter. """
+        if self._neighbourhood_ids is None:
+            listings = storage.load_table(
+                table_path(self.data_dir, self.city, 'listings'),
+                columns=['id'],
+                filters=[(NEIGHBOURHOOD_COL, 'in', self.neighbourhoods)])
+            self._neighbourhood_ids = listings.id.tolist()
+        return self._neighbourhood_ids
+
+    def load(self, columns=None, memory_map=False):
+        """
+        Reads the three tables.
+
+        Args:
+            columns (dict): The columns to read of some of the tables, like
+                {'calendar': ['listing_id', 'date', 'price']}.
+            memory_map (bool): Whether to memory-map the files.
+        Returns:
+            The calendar, listings and reviews.
+        """
+        columns = columns or dict()
+        return tuple((self.table(name).select(columns[name])
+                      if name in columns else self.table(name)).load(
+                          memory_map)
+                     for name in TABLES)
+
+    def __repr__(self):
+        return ('Dataset({!r}, start={}, end={}, listing_ids={}, '
+                'neighbourhoods={})').format(
+                    self.city, self.start, self.end,
+                    None if self.listing_ids is None
+                    else '<{} ids>'.format(len(self.listing_ids)),
+                    self.neighbourhoods)
+
+
+def open_dataset(city='seattle', data_dir=DATA_PROCESSED, **filters):
+    """
+    Opens the processed tables of a city, without reading them.
+
+    Args:
+        city (str): The city.
+        data_dir (str): The directory of the processed data.
+        filters: The filters of the rows (start, end, listing_ids and
+            neighbourhoods; see Dataset).
+    Returns:
+        Dataset: The lazy dataset.
+    """
+    return Dataset(city, data_dir, **filters)
+
+
+def _as_list(values):
+    """ A list of values, from a single string or an iterable. """
+    return [values] if isinstance(values, str) else list(values)
+
+
+def _latest(a, b):
+    """ The latest of two optional dates. """
+    if a is None or b is None:
+        return b if a is None else a
+    return max(a, pd.Timestamp(b))
+
+
+def _earliest(a, b):
+    """ The earliest of two optional dates. """
+    if a is None or b is None:
+        return b if a is None else a
+    return min(a, pd.Timestamp(b))
@@ -0,0 +1,209 @@
+""" Functions to store the processed data with compact dtypes. """
+
+import logging
+import os
+import numpy as np
+import pandas as pd
+from src.data import memory_report_path
+
+# A text column of the listings is categorical if it has less unique values
+# than this fraction of the rows.
+MAX_UNIQUE_FRAC = 0.5
+
+# Columns that need more precision than float32
+FLOAT64_COLS = ['latitude', 'longitude']
+
+INT32_MAX = np.iinfo(np.int32).max
+
+# The missing availabilities are kept as missing, so the same dtype is used
+# in all the chunks.
+AVAILABLE_DTYPE = 'boolean'
+
+# Arrow strings are stored contiguously, instead of as Python objects.
+STRING_DTYPE = 'string[pyarrow]'
+
+
+def compact_all(calendar, listings, reviews, save_report=False,
+                city='seattle'):
+    """
+    Converts all the tables to compact dtypes, and logs how much memory
+    was saved.
+
+    Args:
+        calendar (pandas.DataFrame): Contains prices and availabilities in
+            time for the listings.
+        listings (pandas.DataFrame): Contains the static features of each
+            listing.
+        reviews (pandas.DataFrame): Contains the customer reviews for the
+            listings.
+        save_report (bool): Whether to save the per-column memory report.
+        city (str): The city of the data (for the path of the report).
+    Returns:
+        The same arguments, with compact dtypes.
+    """
+    ids_dtype = id_dtype(listings.id)
+    before = {'calendar': memory_usage(calendar),
+              'listings': memory_usage(listings),
+              'reviews': memory_usage(reviews)}
+    calendar = compact_calendar(calendar, ids_dtype)
+    listings = compact_listings(listings)
+    reviews = compact_reviews(reviews, ids_dtype)
+    after = {'calendar': memory_usage(calendar),
+             'listings': memory_usage(listings),
+             'reviews': memory_usage(reviews)}
+
+    report = memory_report(before, after)
+    totals = report.groupby(level='table')[['bytes_before',
+                                            'bytes_after']].sum()
+    logger = logging.getLogger(__name__)
+    for table, row in totals.iterrows():
+        logger.info('{}: {:.1f} MB -> {:.1f} MB'.format(
+            table, row.bytes_before / 1e6, row.bytes_after / 1e6))
+    if save_report:
+        path = memory_report_path(city)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        report.to_csv(path)
+
+    return calendar, listings, reviews
+
+
+def id_dtype(ids):
+    """
+    The smallest dtype for a column of ids: int32 if all the ids fit in it,
+    int64 otherwise.
+    """
+    return 'int32' if ids.max() <= INT32_MAX else 'int64'
+
+
+def compact_calendar(calendar, ids_dtype='int32'):
+    """
+    Converts the calendar to compact dtypes. The conversions don't depend on
+    the values, so it can be applied to chunks of the calendar.
+
+    Args:
+        calendar (pandas.DataFrame): Contains prices and availabilities in
+            time for the listings.
+        ids_dtype (str): The dtype for listing_id (see id_dtype).
+    Returns:
+        pandas.DataFrame: The compact calendar.
+    """
+    return calendar.astype({'listing_id': ids_dtype,
+                            'date': 'datetime64[ns]',
+                            'available': AVAILABLE_DTYPE,
+                            'price': 'float32'})
+
+
+def compact_reviews(reviews, ids_dtype='int32'):
+    """
+    Converts the reviews to compact dtypes (the text is stored as arrow
+    strings). The conversions don't depend on the values, so it can be
+    applied to chunks of the reviews.
+
+    Args:
+        reviews (pandas.DataFrame): Contains the customer reviews for the
+            listings.
+        ids_dtype (str): The dtype for listing_id (see id_dtype).
+    Returns:
+        pandas.DataFrame: The compact reviews.
+    """
+    text_cols = reviews.select_dtypes(include='object').columns
+    dtypes = {col: STRING_DTYPE for col in text_cols}
+    dtypes.update({'listing_id': ids_dtype, 'date': 'datetime64[ns]'})
+    return reviews.astype(dtypes)
+
+
+def compact_listings(listings):
+    """
+    Converts the listings to compact dtypes: the boolean columns (and the
+    object columns of booleans and NaNs) to nullable booleans, the
+    low-cardinality text to categoricals and the rest of the text to arrow
+    strings, dates to datetime64, integers to the smallest integer type, and
+    floats to float32 (except for FLOAT64_COLS).
+
+    Args:
+        listings (pandas.DataFrame): Contains the static features of each
+            listing.
+    Returns:
+        pandas.DataFrame: The compact listings.
+    """
+    columns = dict()
+    max_unique = MAX_UNIQUE_FRAC * listings.shape[0]
+    for col in listings.columns:
+        series = listings[col]
+        if pd.api.types.is_bool_dtype(series):
+            columns[col] = series.astype('boolean')
+        elif pd.api.types.is_integer_dtype(series):
+            columns[col] = pd.to_numeric(series, downcast='integer')
+        elif pd.api.types.is_float_dtype(series) and \
+                col not in FLOAT64_COLS:
+            columns[col] = series.astype('float32')
+        elif series.dtype == object:
+            columns[col] = _compact_object(series, max_unique)
+    return listings.assign(**columns)
+
+
+def _compact_object(series, max_unique):
+    """ Converts an object column of the listings (see compact_listings). """
+    kind = pd.api.types.infer_dtype(series, skipna=True)
+    if kind == 'boolean':
+        return series.astype('boolean')
+    elif kind in ('datetime', 'datetime64', 'date'):
+        return pd.to_datetime(series)
+    elif kind == 'string' and series.nunique() < max_unique:
+        return series.astype('category')
+    elif kind == 'string':
+        return series.astype(STRING_DTYPE)
+    elif kind == 'mixed':
+        return _compact_mixed(series)
+    return series
+
+
+def _compact_mixed(series):
+    """
+    Converts an object column that mixes types, like a 'tf' column whose
+    missing values were filled with the median: to nullable booleans if all
+    the values are booleans, 0 or 1; to float32 if they are numbers. Other
+    columns are not converted.
+    """
+    try:
+        values = series.astype(float)
+    except (TypeError, ValueError):
+        return series
+    if values.dropna().isin([0.0, 1.0]).all():
+        return values.astype('boolean')
+    return values.astype('float32')
+
+
+def memory_usage(df):
+    """
+    The memory used by each column of a dataframe (including the objects
+    referenced by object columns), and its dtype.
+
+    Args:
+        df (pandas.DataFrame): Any dataframe.
+    Returns:
+        pandas.DataFrame: The 'dtype' and 'bytes' of each column.
+    """
+    return pd.DataFrame({'dtype': df.dtypes.astype(str),
+                         'bytes': df.memory_usage(deep=True, index=False)})
+
+
+def memory_report(before, after):
+    """
+    Compares the memory usage of some tables before and after a conversion.
+
+    Args:
+        before (dict(pandas.DataFrame)): The memory_usage of each table
+            before the conversion.
+        after (dict(pandas.DataFrame)): The memory_usage of each table after
+            the conversion.
+    Returns:
+        pandas.DataFrame: A (table, column) indexed dataframe with the dtypes
+            and bytes, before and after, and the fraction of memory saved.
+    """
+    report = pd.concat({table: before[table].join(after[table],
+                                                  lsuffix='_before',
+                                                  rsuffix='_after')
+                        for table in before}, names=['table', 'column'])
+    report['saved'] = 1.0 - report.bytes_after / report.bytes_before
+    return report
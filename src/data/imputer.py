@@ -0,0 +1,202 @@
+"""
+An imputer for the listings, that learns the statistics to fill the missing
+data once and applies them to new batches of listings.
+"""
+
+import os
+import pickle
+import pandas as pd
+from src.data import preprocessing as pp
+from src.profiling import profiled
+
+# Numeric columns with too little data to be used
+DROP_COLS = ['license', 'square_feet']
+
+# Numeric columns that are filled with the median (the others, with the mean)
+MEDIAN_COLS = [
+    'bathrooms',
+    'bedrooms',
+    'beds',
+    'host_listings_count',
+    'host_total_listings_count'
+]
+
+# Long-term prices and fees that are filled proportionally to the price
+PRICE_RATIO_COLS = ['weekly_price', 'monthly_price', 'cleaning_fee']
+
+# Categorical columns that are filled with their most frequent value (the
+# others keep their missing values)
+MODE_COLS = ['property_type']
+
+# The numeric columns with a fraction of missing values in this range get a
+# '<column>_missing' indicator.
+MISSING_INDICATOR_RANGE = (0.1, 0.9)
+
+# The review scores are the targets of the models (see train_model): they
+# always get a missing indicator, so that their imputed values can be left
+# out of the training.
+SCORE_PREFIX = 'review_scores_'
+
+
+class ListingsImputer(object):
+    """
+    Fills the missing data of the (transformed) listings. 'fit' learns the
+    medians, means, modes and price ratios from the listings; 'transform'
+    fills any batch of listings with them, in one pass, without the data that
+    was used to fit. The fitted imputer can be saved and loaded with pickle.
+
+    Attributes:
+        listings_cols_df (pandas.DataFrame): The 'kind' of each column (without
+            the dropped columns, once fitted).
+        missing_indicators (list(str)): The columns that get a
+            '<column>_missing' indicator (see MISSING_INDICATOR_RANGE and
+            SCORE_PREFIX).
+        drop_cols (list(str)): The columns that are dropped.
+        price_ratios (dict): The mean ratio of each PRICE_RATIO_COLS column to
+            the price.
+        fill_values (dict): The value to fill in each column.
+    """
+
+    def __init__(self, listings_cols_df):
+        self.listings_cols_df = listings_cols_df
+        self.missing_indicators = None
+        self.drop_cols = None
+        self.price_ratios = None
+        self.fill_values = None
+
+    @profiled
+    def fit(self, listings):
+        """
+        Learns the statistics to fill the missing data.
+
+        Args:
+            listings (pandas.DataFrame): The transformed listings (see
+                preprocessing.transform_listings).
+        Returns:
+            ListingsImputer: self.
+        """
+        cols_df = self.listings_cols_df
+        num_cols = pp.get_column_by_kind(cols_df, 'num_cols')
+        missing = listings[num_cols].isnull().mean()
+        low, high = MISSING_INDICATOR_RANGE
+        self.missing_indicators = missing.index[
+            ((missing > low) & (missing < high)) |
+            missing.index.str.startswith(SCORE_PREFIX)].tolist()
+        self.drop_cols = [col for col in DROP_COLS if col in listings.columns]
+        self.listings_cols_df = cols_df.drop(
+            [col for col in self.drop_cols if col in cols_df.index])
+
+        median_cols = [col for col in num_cols if col in MEDIAN_COLS]
+        mean_cols = [col for col in num_cols
+                     if col not in MEDIAN_COLS + DROP_COLS]
+        self.price_ratios = {col: (listings[col] / listings.price).mean()
+                             for col in PRICE_RATIO_COLS}
+        fill_values = dict()
+        fill_values.update(listings[median_cols].median())
+        fill_values.update(listings[mean_cols].mean())
+        fill_values['security_deposit'] = listings.security_deposit.mean()
+        tf_cols = pp.get_column_by_kind(cols_df, 'tf_cols')
+        fill_values.update(listings[tf_cols].astype(float).median())
+        for kind in ['free_text_cols', 'url_cols']:
+            fill_values.update({col: '' for col in pp.get_column_by_kind(
+                cols_df, kind)})
+        fill_values['host_location'] = _mode(listings.host_location)
+        fill_values['zipcode'] = ''
+        fill_values['host_response_time'] = 'no data'
+
+        # The listings without 'host_since' are dropped before the rest of
+        # the statistics are computed.
+        listings = listings[~listings.host_since.isnull()]
+        percent_cols = pp.get_column_by_kind(cols_df, 'percent_cols')
+        fill_values.update(listings[percent_cols].mean())
+        for col in MODE_COLS:
+            fill_values[col] = _mode(listings[col])
+        self.fill_values = {col: value for col, value in fill_values.items()
+                            if not pd.isnull(value)}
+        return self
+
+    @profiled
+    def transform(self, listings, last_scraped=None):
+        """
+        Fills the missing data of a batch of listings. The listings without
+        'host_since' are dropped.
+
+        Args:
+            listings (pandas.DataFrame): The transformed listings (see
+                preprocessing.transform_listings).
+            last_scraped (pandas.Timestamp): The date to fill the missing
+                reviews dates with (the latest 'last_scraped' of the batch by
+                default).
+        Returns:
+            pandas.DataFrame: The filled listings.
+        """
+        listings = listings.join(listings[self.missing_indicators].isnull(
+            ).astype(int).add_suffix('_missing'))
+        listings = listings.drop(self.drop_cols, axis=1)
+        fill_values = self.batch_fill_values(listings, last_scraped)
+        listings = fix_zipcodes(listings.fillna(
+            {col: value for col, value in fill_values.items()
+             if col in listings.columns}))
+        return listings[~listings.host_since.isnull()]
+
+    def batch_fill_values(self, listings, last_scraped=None):
+        """
+        The values to fill each column of a batch of listings with: the
+        fitted statistics, and the values that depend on the batch (the
+        prices proportional to the price of each listing, the neighbourhoods
+        and the reviews dates).
+
+        Args:
+            listings (pandas.DataFrame): The transformed listings.
+            last_scraped (pandas.Timestamp): The date to fill the missing
+                reviews dates with (see transform).
+        Returns:
+            dict: A value, or a series of values, per column.
+        """
+        if self.fill_values is None:
+            raise ValueError('The imputer is not fitted.')
+        fill_values = dict(self.fill_values)
+        if last_scraped is None:
+            last_scraped = listings.last_scraped.max()
+        fill_values.update(first_review=last_scraped,
+                           last_review=last_scraped)
+        for col, ratio in self.price_ratios.items():
+            fill_values[col] = listings.price * ratio
+        fill_values['neighbourhood'] = listings.neighbourhood_cleansed
+        fill_values['host_neighbourhood'] = listings.neighbourhood.fillna(
+            listings.neighbourhood_cleansed)
+        return fill_values
+
+    def fit_transform(self, listings):
+        """ Fits the imputer and fills the listings. """
+        return self.fit(listings).transform(listings)
+
+    def save(self, path):
+        """ Saves the imputer with pickle. """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'wb') as imputer_file:
+            pickle.dump(self, imputer_file)
+
+    @staticmethod
+    def load(path):
+        """ Loads an imputer that was saved with 'save'. """
+        with open(path, 'rb') as imputer_file:
+            return pickle.load(imputer_file)
+
+
+def fix_zipcodes(listings):
+    """
+    Fixes a mistake in the zipcodes (only if it is there: setting a string
+    would turn a numeric zipcode column into an object column of numbers).
+    """
+    is_mistake = listings.zipcode == '99\n98122'
+    if is_mistake.any():
+        listings = listings.copy()
+        listings.loc[is_mistake, 'zipcode'] = '98122'
+    return listings
+
+
+def _mode(series):
+    """ The most frequent value of a series (None if it is empty). """
+    counts = series.value_counts()
+    return counts.index[0] if len(counts) > 0 else None
@@ -0,0 +1,113 @@
+"""
+Functions to find the rows of a new raw snapshot that changed since the
+previous one, so that only those rows need to be processed.
+"""
+
+import os
+import pandas as pd
+from src.data import DATA_INTERIM, table_path
+from src.data import storage
+
+# The columns that identify a row of each raw table
+KEYS = {
+    'calendar': ['listing_id', 'date'],
+    'listings': ['id'],
+    'reviews': ['id'],
+}
+
+# The metadata of the scrape, that changes in every snapshot. It is not
+# part of the row hash, so that a listing only counts as changed when its
+# data changed (its processed row keeps the metadata of the snapshot where
+# it last changed).
+VOLATILE_COLS = ['scrape_id', 'last_scraped', 'calendar_last_scraped',
+                 'calendar_updated']
+
+
+def row_hashes(df, keys):
+    """
+    Hashes the rows of a raw table.
+
+    Args:
+        df (pandas.DataFrame): A raw table.
+        keys (list(str)): The columns that identify a row.
+    Returns:
+        pandas.DataFrame: The keys of each row, their 'key_hash', and the
+            'row_hash' of all the values of the row, except the
+            VOLATILE_COLS.
+    """
+    hashes = df[keys].copy()
+    hashes['key_hash'] = _hash(df[keys])
+    hashes['row_hash'] = _hash(df.drop(
+        columns=[col for col in VOLATILE_COLS if col in df.columns]))
+    return hashes
+
+
+def _hash(df):
+    """ Hashes the rows of a dataframe (without the index). """
+    return pd.util.hash_pandas_object(df, index=False).values
+
+
+def hashes_path(city, table):
+    """ The path of the row hashes of a raw table of a city. """
+    return table_path(DATA_INTERIM, city, table + '_hashes')
+
+
+def has_row_hashes(city):
+    """ Whether the row hashes of all the tables of a city were saved. """
+    return all(os.path.exists(hashes_path(city, table)) for table in KEYS)
+
+
+def save_row_hashes(hashes, city='seattle'):
+    """ Saves the row hashes of each table (a dict, like KEYS) of a city. """
+    for table, table_hashes in hashes.items():
+        storage.save_table(table_hashes, hashes_path(city, table))
+
+
+def load_row_hashes(city='seattle'):
+    """ Loads the row hashes of each table of a city. """
+    return {table: storage.load_table(hashes_path(city, table))
+            for table in KEYS}
+
+
+def remove_row_hashes(city='seattle'):
+    """
+    Removes the row hashes of a city (when its data is created from scratch,
+    they don't describe it anymore).
+    """
+    for table in KEYS:
+        path = hashes_path(city, table)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def diff_rows(old_hashes, new_hashes, keys):
+    """
+    Compares the row hashes of two snapshots of a table.
+
+    Args:
+        old_hashes (pandas.DataFrame): The row hashes of the old snapshot.
+        new_hashes (pandas.DataFrame): The row hashes of the new snapshot.
+        keys (list(str)): The columns that identify a row.
+    Returns:
+        numpy.ndarray: Whether each row of the new snapshot is new or changed.
+        pandas.DataFrame: The keys of the rows that were removed.
+    """
+    is_changed = ~pd.Index(new_hashes.row_hash).isin(old_hashes.row_hash)
+    is_removed = ~pd.Index(old_hashes.key_hash).isin(new_hashes.key_hash)
+    return is_changed, old_hashes.loc[is_removed, keys]
+
+
+def merge_rows(df, new_rows, key, replaced):
+    """
+    Replaces some rows of a table.
+
+    Args:
+        df (pandas.DataFrame): A table.
+        new_rows (pandas.DataFrame): The rows to add (at the end).
+        key (str): The column that identifies the rows to replace.
+        replaced (array-like): The values of 'key' of the rows to remove.
+    Returns:
+        pandas.DataFrame: The merged table, with a new index.
+    """
+    kept = df[~df[key].isin(replaced)]
+    return pd.concat([kept, new_rows], ignore_index=True, sort=False)
@@ -1,17 +1,67 @@
 # -*- coding: utf-8 -*-
 import click
 import logging
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
 import pandas as pd
 import src.data.preprocessing as pp
 import src.data.missing_data as md
-from src.data import DATA_RAW, DATA_PROCESSED, SEATTLE_CALENDAR_FINAL,\
-    SEATTLE_LISTINGS_FINAL, SEATTLE_REVIEWS_FINAL
+import src.data.dtypes as dt
+import src.data.schema as schema
+import src.data.imputer as imp
+import src.data.incremental as inc
+import src.utils as utils
+from src.data import aggregate_cube
+from src.data import cache
+from src.data import dataset
+from src.data import price_cube
+from src.data import storage
+from src.data import DATA_RAW, DATA_INTERIM, DATA_PROCESSED, RAW_FILES, \
+    find_cities, imputer_path, listings_cols_path, profile_report_path, \
+    table_path
+from src.profiling import profiling
+
+# A rough estimate of the peak memory used to process a city, per byte of
+# its raw files.
+MEMORY_PER_RAW_BYTE = 5
+
+TABLES = ['calendar', 'listings', 'reviews']
 
 
 @click.command()
 @click.argument('input_filepath', type=click.Path(exists=True), required=False)
 @click.argument('output_filepath', type=click.Path(), required=False)
-def main(input_filepath, output_filepath):
+@click.option('--chunksize', type=int, default=None,
+              help='Stream the calendar and reviews in chunks of this many '
+                   'rows.')
+@click.option('--no-cache', is_flag=True,
+              help='Run all the stages, without using the stage cache.')
+@click.option('--city', 'cities', multiple=True,
+              help='A city to process (can be repeated). All the cities in '
+                   'the raw data folder are processed by default.')
+@click.option('--workers', type=int, default=None,
+              help='The number of processes (one per CPU by default).')
+@click.option('--max-memory', type=float, default=None,
+              help='The memory (in GB) that the running cities can use, '
+                   'estimated from the size of their raw files (the '
+                   'available memory by default).')
+@click.option('--profile', is_flag=True,
+              help='Log the time and memory of each step, and save them to '
+                   'data/processed/<city>/profile.json.')
+@click.option('--incremental', is_flag=True,
+              help='Only process the rows that changed since the previous '
+                   'run, and merge them into the processed data.')
+@click.option('--backend', type=click.Choice(['pandas', 'dask']),
+              default='pandas',
+              help='Process the calendars and reviews in memory with pandas, '
+                   'or out of core on a local dask cluster (parquet only; '
+                   'the other options, except --city, --workers and '
+                   '--max-memory, are ignored).')
+def main(input_filepath, output_filepath, chunksize, no_cache, cities,
+         workers, max_memory, profile, incremental, backend):
     """ Runs data processing scripts to turn raw data from (../raw) into
         cleaned data ready to be analyzed (saved in ../processed).
     """
@@ -24,47 +74,405 @@ def main(input_filepath, output_filepath):
         input_filepath, output_filepath
     ))
     logger.info('Making the final data set from raw data')
-    create_dataset(input_filepath)
+    if max_memory is not None:
+        max_memory = int(max_memory * 2 ** 30)
+    create_all_datasets(input_filepath, cities=list(cities) or None,
+                        n_workers=workers, max_memory=max_memory,
+                        backend=backend, chunksize=chunksize,
+                        use_cache=not no_cache, profile=profile,
+                        incremental=incremental)
 
 
-def create_dataset(raw_dir=DATA_RAW):
+def create_all_datasets(raw_dir=DATA_RAW, cities=None, n_workers=None,
+                        max_memory=None, backend='pandas', **kwargs):
     """
-    Does the same as main, but without 'click'. To be called from other
-    functions or notebooks.
+    Creates the datasets of many cities, in parallel. A city that fails
+    doesn't stop the others. The largest cities are started first, and a
+    city is only started if the estimated memory of the running cities
+    (see MEMORY_PER_RAW_BYTE) fits in max_memory; one city is always run.
+
+    Args:
+        raw_dir (str): The directory that contains one folder per city.
+        cities (list(str)): The cities to process (all the cities in raw_dir
+            by default, see find_cities).
+        n_workers (int): The number of processes (one per CPU by default).
+            With one worker the cities are processed in this process.
+        max_memory (int): The memory budget, in bytes (the available memory
+            by default).
+        backend (str): 'pandas', or 'dask' to process all the cities on a
+            local dask cluster (see src.data.dask_pipeline; kwargs are
+            ignored).
+        kwargs: Passed to create_dataset.
+    Returns:
+        pandas.DataFrame: The 'status' ('ok' or 'failed'), 'seconds' and
+            'error' of each city.
     """
     logger = logging.getLogger(__name__)
+    if cities is None:
+        cities = find_cities(raw_dir)
+    if max_memory is None:
+        max_memory = available_memory()
+    n_workers = n_workers or os.cpu_count()
+    estimates = {city: estimate_memory(raw_dir, city) for city in cities}
+    pending = sorted(cities, key=estimates.get, reverse=True)
+
+    if backend == 'dask':
+        from src.data import dask_pipeline
+        results = dask_pipeline.create_datasets(raw_dir, pending, n_workers,
+                                                max_memory)
+    elif n_workers == 1:
+        results = [_create_city_dataset(raw_dir, city, kwargs)
+                   for city in pending]
+    else:
+        results = _run_in_pool(raw_dir, pending, estimates, n_workers,
+                               max_memory, kwargs)
+
+    summary = pd.DataFrame(results, columns=['city', 'status', 'seconds',
+                                             'error'])
+    summary = summary.set_index('city').sort_index()
+    logger.info('Summary:\n{}'.format(summary[['status', 'seconds']]))
+    failed = summary.index[summary.status == 'failed'].tolist()
+    if failed:
+        logger.error('Failed cities: {}'.format(', '.join(failed)))
+    return summary
+
+
+def _run_in_pool(raw_dir, pending, estimates, n_workers, max_memory, kwargs):
+    """
+    Runs _create_city_dataset for the pending cities, in a process pool,
+    within the memory budget (see create_all_datasets).
+    """
+    results = list()
+    running = dict()
+
+    def fits(city):
+        used = sum(estimates[c] for c in running.values())
+        return not running or max_memory is None or \
+            used + estimates[city] <= max_memory
+
+    with ProcessPoolExecutor(n_workers) as executor:
+        while pending or running:
+            while pending and len(running) < n_workers and fits(pending[0]):
+                city = pending.pop(0)
+                future = executor.submit(_create_city_dataset, raw_dir, city,
+                                         kwargs)
+                running[future] = city
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                city = running.pop(future)
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    # The worker process died (e.g. out of memory)
+                    results.append((city, 'failed', None, repr(e)))
+    return results
+
+
+def _create_city_dataset(raw_dir, city, kwargs):
+    """
+    Runs create_dataset for one city, and returns its (city, status, seconds,
+    error). The errors are returned as text, so that they can be pickled.
+    """
+    start = time.time()
+    try:
+        create_dataset(raw_dir, city=city, **kwargs)
+    except Exception:
+        logging.getLogger(__name__).exception('{} failed'.format(city))
+        return city, 'failed', time.time() - start, traceback.format_exc()
+    return city, 'ok', time.time() - start, None
+
 
-    logger.info('Loading the raw data')
-    calendar, listings, reviews = pp.load_data(raw_dir)
-
-    logger.info('Preprocessing the data')
-    calendar, listings, reviews = pp.transform_all(calendar,
-                                                   listings,
-                                                   reviews,
-                                                   save_results=True)
-    logger.info('Filling the missing data')
-    calendar, listings, reviews = md.fill_missing(calendar,
-                                                  listings,
-                                                  reviews,
-                                                  save_results=True)
+def estimate_memory(raw_dir, city):
+    """ The estimated peak memory to process a city, in bytes. """
+    return MEMORY_PER_RAW_BYTE * sum(
+        os.path.getsize(os.path.join(raw_dir, city, name))
+        for name in RAW_FILES)
+
+
+def available_memory():
+    """ The available memory in bytes, or None if it is unknown. """
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def create_dataset(raw_dir=DATA_RAW, chunksize=None, use_cache=True,
+                   city='seattle', profile=False, incremental=False):
+    """
+    Does the same as main, for one city, but without 'click'. To be called
+    from other functions or notebooks.
+    If chunksize is given, the calendar and reviews are streamed in chunks
+    (see create_dataset_by_chunks).
+    The outputs of the transform and fill stages are cached (see
+    src.data.cache): a stage is only run again if its input data, its code
+    or its parameters changed.
+    If profile is True, the time and memory of each transform and fill step
+    are logged and saved (see src.profiling).
+    If incremental is True, only the rows that changed since the previous run
+    are processed (see update_dataset).
+    """
+    if profile:
+        with profiling(profile_report_path(city)):
+            return create_dataset(raw_dir, chunksize, use_cache, city,
+                                  incremental=incremental)
+    if incremental:
+        return update_dataset(raw_dir, city, use_cache)
+    inc.remove_row_hashes(city)
+    if chunksize is not None:
+        return create_dataset_by_chunks(raw_dir, chunksize, city)
+
+    logger = logging.getLogger(__name__)
+    listings_path = os.path.join(raw_dir, city, 'listings.csv')
+    cols_path = listings_cols_path(city)
+
+    def transform():
+        logger.info('Loading the raw data')
+        calendar, listings, reviews = pp.load_data(raw_dir, city)
+        logger.info('Preprocessing the data')
+        listings_cols_df = schema.load_column_kinds(listings_path, listings,
+                                                    cols_path)
+        return pp.transform_all(calendar, listings, reviews,
+                                listings_cols_df=listings_cols_df)
+
+    def fill(calendar, listings, reviews):
+        logger.info('Filling the missing data')
+        imputer = imp.ListingsImputer(schema.load_column_kinds(
+            listings_path, cols_path=cols_path))
+        calendar, listings, reviews = md.fill_missing(
+            calendar, listings, reviews, city=city, imputer=imputer)
+        # The fitted imputer is kept with the stage outputs, so that it is
+        # saved again when the stage is loaded from the cache.
+        return calendar, listings, reviews, imputer
+
+    params = {'city': city}
+    stages = [('transform', transform, [pp, schema, utils], params),
+              ('fill', fill, [md, imp, pp, schema], params)]
+    if use_cache:
+        inputs = [utils.file_fingerprint(
+            os.path.join(raw_dir, city, name)) for name in RAW_FILES]
+        calendar, listings, reviews, imputer = cache.run_pipeline(stages,
+                                                                  inputs)
+    else:
+        calendar, listings, reviews, imputer = fill(*transform())
+    imputer.save(imputer_path(city))
+    pp.save_data(calendar, listings, reviews, city)
+
+    logger.info('Compacting the dtypes')
+    calendar, listings, reviews = dt.compact_all(calendar,
+                                                 listings,
+                                                 reviews,
+                                                 save_report=True,
+                                                 city=city)
     logger.info('Saving the data')
-    save_to_processed(calendar, listings, reviews)
-    logger.info('The processed data is ready.')
+    save_to_processed(calendar, listings, reviews, city)
+    finalize_dataset(city)
+    logger.info('The processed data of {} is ready.'.format(city))
 
 
-def save_to_processed(calendar, listings, reviews):
-    """ Saves the data to the 'processed' folder. """
-    calendar.to_pickle(SEATTLE_CALENDAR_FINAL)
-    listings.to_pickle(SEATTLE_LISTINGS_FINAL)
-    reviews.to_pickle(SEATTLE_REVIEWS_FINAL)
+def create_dataset_by_chunks(raw_dir=DATA_RAW, chunksize=100000,
+                             city='seattle'):
+    """
+    Creates the same dataset as create_dataset, but reads, transforms, fills
+    and saves the calendar and the reviews in chunks of 'chunksize' rows, so
+    that the memory usage doesn't grow with the size of those files. The
+    listings are processed at once. The interim tables keep the dtypes of
+    the filled data; only the processed tables are compacted.
+    """
+    logger = logging.getLogger(__name__)
+
+    logger.info('Loading the raw listings')
+    calendar, listings, reviews = pp.load_data(raw_dir, city,
+                                               chunksize=chunksize)
+    listings_cols_df = schema.load_column_kinds(
+        os.path.join(raw_dir, city, 'listings.csv'), listings,
+        listings_cols_path(city))
+    listings = pp.transform_listings(listings, listings_cols_df)
+    ids_dtype = dt.id_dtype(listings.id)
+
+    logger.info('Processing the calendar in chunks of {} rows'.format(
+        chunksize))
+    calendar = (pp.transform_calendar(chunk) for chunk in calendar)
+    calendar = md.fill_calendar_chunks(calendar, listings)
+    temp_path, final_path = _table_paths(city, 'calendar')
+    n_rows = storage.save_chunks(calendar, {
+        temp_path: None,
+        final_path: lambda chunk: dt.compact_calendar(chunk, ids_dtype)})
+    logger.info('Saved {} calendar rows'.format(n_rows))
+
+    logger.info('Processing the reviews in chunks of {} rows'.format(
+        chunksize))
+    reviews = (md.fill_reviews_na(pp.transform_reviews(chunk))
+               for chunk in reviews)
+    temp_path, final_path = _table_paths(city, 'reviews')
+    n_rows = storage.save_chunks(reviews, {
+        temp_path: None,
+        final_path: lambda chunk: dt.compact_reviews(chunk, ids_dtype)})
+    logger.info('Saved {} review rows'.format(n_rows))
+
+    logger.info('Filling the missing data in the listings')
+    imputer = imp.ListingsImputer(listings_cols_df)
+    listings = md.fill_listings_na(listings, imputer)
+    imputer.save(imputer_path(city))
+    temp_path, final_path = _table_paths(city, 'listings')
+    storage.save_table(listings, temp_path)
+    storage.save_table(dt.compact_listings(listings), final_path)
+    finalize_dataset(city)
+    logger.info('The processed data of {} is ready.'.format(city))
+
+
+def update_dataset(raw_dir=DATA_RAW, city='seattle', use_cache=True):
+    """
+    Updates the data of a city with a new raw snapshot. The rows of the new
+    snapshot are compared with the previous one (see src.data.incremental),
+    and only the listings that are new or changed, or whose calendar
+    changed, and the new or changed reviews, are transformed and filled.
+    They replace the old versions of those rows in the interim and processed
+    tables. The listings are filled with the imputer of the last full run
+    (see missing_data.fill_listings_na). If there is no previous snapshot,
+    the dataset is created from scratch (with the stage cache, if use_cache
+    is True).
 
+    Only the transformation and the imputation scale with the change. Each
+    table is a single file, so the interim and processed tables are still
+    read, merged and rewritten whole. The processed tables are compacted
+    again, because their compact dtypes depend on all the rows. The price
+    and aggregate cubes are rebuilt from them (see finalize_dataset). Those
+    steps only read and write, but their cost grows with the size of the
+    city, not with the change.
+    """
+    logger = logging.getLogger(__name__)
+    calendar, listings, reviews = pp.load_data(raw_dir, city)
+    new_hashes = {name: inc.row_hashes(df, inc.KEYS[name]) for name, df in
+                  zip(TABLES, [calendar, listings, reviews])}
+    if not inc.has_row_hashes(city) or \
+            not os.path.exists(imputer_path(city)):
+        logger.info('No previous snapshot of {}: creating the dataset'.format(
+            city))
+        create_dataset(raw_dir, city=city, use_cache=use_cache)
+        inc.save_row_hashes(new_hashes, city)
+        return
+
+    old_hashes = inc.load_row_hashes(city)
+    changes = {name: inc.diff_rows(old_hashes[name], new_hashes[name],
+                                   inc.KEYS[name]) for name in TABLES}
+    listing_ids = pd.unique(np.concatenate([
+        listings.id.values[changes['listings'][0]],
+        calendar.listing_id.values[changes['calendar'][0]],
+        changes['calendar'][1].listing_id.values]))
+    removed_ids = changes['listings'][1].id.values
+    review_ids = np.concatenate([reviews.id.values[changes['reviews'][0]],
+                                 changes['reviews'][1].id.values])
+    logger.info('{} listings and {} reviews changed or were removed'.format(
+        len(listing_ids) + len(removed_ids), len(review_ids)))
+    if len(listing_ids) + len(removed_ids) + len(review_ids) == 0:
+        inc.save_row_hashes(new_hashes, city)
+        return
+
+    new_calendar, new_listings = _process_listings(
+        calendar[calendar.listing_id.isin(listing_ids)],
+        listings[listings.id.isin(listing_ids)],
+        pp.string2date(listings.last_scraped).max(), city)
+    new_reviews = md.fill_reviews_na(pp.transform_reviews(
+        reviews[changes['reviews'][0]].copy()))
+    del calendar, listings, reviews
+
+    replaced_ids = np.concatenate([listing_ids, removed_ids])
+    calendar, listings, reviews = [
+        inc.merge_rows(storage.load_table(table_path(DATA_INTERIM, city,
+                                                     name)),
+                       new_rows, key, replaced)
+        for name, new_rows, key, replaced in [
+            ('calendar', new_calendar, 'listing_id', replaced_ids),
+            ('listings', new_listings, 'id', replaced_ids),
+            ('reviews', new_reviews, 'id', review_ids)]]
+    pp.save_data(calendar, listings, reviews, city)
+    calendar, listings, reviews = dt.compact_all(calendar, listings, reviews,
+                                                 save_report=True, city=city)
+    save_to_processed(calendar, listings, reviews, city)
+    finalize_dataset(city, new_hashes)
+    logger.info('The processed data of {} is updated.'.format(city))
+
+
+def finalize_dataset(city='seattle', row_hashes=None):
+    """
+    The last step of every way of creating the data of a city (in memory, in
+    chunks, incrementally, or with the dask backend), once its interim and
+    processed tables are saved: builds the price and aggregate cubes, and
+    saves the row hashes of the raw snapshot that the tables come from (see
+    update_dataset), or removes the previous ones, that don't describe the
+    tables anymore.
 
-def load_processed():
+    Args:
+        city (str): The city.
+        row_hashes (dict): The row hashes of each raw table (see
+            incremental.row_hashes), if they were computed.
+    """
+    logger = logging.getLogger(__name__)
+    logger.info('Building the price and aggregate cubes')
+    price_cube.build_price_cube(city)
+    aggregate_cube.build_aggregate_cube(city)
+    if row_hashes is None:
+        inc.remove_row_hashes(city)
+    else:
+        inc.save_row_hashes(row_hashes, city)
+
+
+def _process_listings(calendar, listings, last_scraped, city):
+    """
+    Transforms and fills some raw listings and their calendar, like
+    create_dataset does, with the imputer of the last full run.
+    """
+    imputer = imp.ListingsImputer.load(imputer_path(city))
+    listings = pp.transform_listings(listings.copy(),
+                                     imputer.listings_cols_df)
+    calendar = md.fill_calendar_na(pp.transform_calendar(calendar.copy()),
+                                   listings)
+    return calendar, imputer.transform(listings, last_scraped)
+
+
+def _table_paths(city, table):
+    """ The interim and processed paths of a table of a city. """
+    return [table_path(DATA_INTERIM, city, table),
+            table_path(DATA_PROCESSED, city, table)]
+
+
+def save_to_processed(calendar, listings, reviews, city='seattle'):
     """ Saves the data to the 'processed' folder. """
-    calendar = pd.read_pickle(SEATTLE_CALENDAR_FINAL)
-    listings = pd.read_pickle(SEATTLE_LISTINGS_FINAL)
-    reviews = pd.read_pickle(SEATTLE_REVIEWS_FINAL)
-    return calendar, listings, reviews
+    storage.save_table(calendar, table_path(DATA_PROCESSED, city, 'calendar'))
+    storage.save_table(listings, table_path(DATA_PROCESSED, city, 'listings'))
+    storage.save_table(reviews, table_path(DATA_PROCESSED, city, 'reviews'))
+
+
+def load_processed(columns=None, filters=None, memory_map=False,
+                   city='seattle'):
+    """
+    Loads the data from the 'processed' folder. To read only a part of it, or
+    to read it in chunks, see dataset.open_dataset.
+
+    Args:
+        columns (dict): The columns to load for some of the tables, like
+            {'calendar': ['listing_id', 'date', 'price']}.
+        filters (dict): Row conditions for some of the tables, like
+            {'calendar': [('date', '>=', pd.Timestamp('2016-06-01'))]}
+            (see storage.load_table).
+        memory_map (bool): Whether to memory-map the files.
+        city (str): The city to load.
+    Returns:
+        The calendar, listings and reviews.
+    """
+    columns = columns or dict()
+    filters = filters or dict()
+    data = dataset.open_dataset(city)
+    tables = list()
+    for name in dataset.TABLES:
+        table = data.table(name)
+        if name in columns:
+            table = table.select(columns[name])
+        for condition in filters.get(name, []):
+            table = table.where(*condition)
+        tables.append(table.load(memory_map))
+    return tuple(tables)
 
 
 if __name__ == '__main__':
@@ -1,51 +1,66 @@
 """ Functions to help filling the missing data. """
+import numpy as np
 import pandas as pd
 from src.data import preprocessing as pp
-from src.data import SEATTLE_LISTINGS_COLS, SEATTLE_CALENDAR_TEMP, \
-    SEATTLE_LISTINGS_TEMP, SEATTLE_REVIEWS_TEMP
+from src.data import imputer_path, listings_cols_path
+from src.data.imputer import MODE_COLS, ListingsImputer, fix_zipcodes
+from src.profiling import profiled
 
 
-def fill_missing(calendar, listings, reviews, save_results=False):
+@profiled
+def fill_missing(calendar, listings, reviews, save_results=False,
+                 city='seattle', imputer=None):
     """
     Fills all the missing data that is filledbefore the feature generation.
     There may be some missing data that is filled after the feature generation.
+    The listings are filled with 'imputer' (see fill_listings_na).
     """
     calendar = fill_calendar_na(calendar, listings)
     reviews = fill_reviews_na(reviews)
-    listings = fill_listings_na(listings)
+    listings = fill_listings_na(listings, imputer, city=city)
 
     if save_results:
-        pp.save_data(calendar, listings, reviews)
+        pp.save_data(calendar, listings, reviews, city)
 
     return calendar, listings, reviews
 
 
-def fill_listings_na(listings, save_listings_cols=True):
-    """ A specific function to fill the listings missing values."""
-    listings_cols_df = pd.read_pickle(SEATTLE_LISTINGS_COLS)
-    listings, listings_cols_df = fill_num_cols(listings, listings_cols_df)
-    listings, listings_cols_df = fill_price_cols(listings, listings_cols_df)
-    listings, listings_cols_df = fill_tf_cols(listings, listings_cols_df)
-    listings, listings_cols_df = fill_free_text_cols(listings,
-                                                     listings_cols_df)
-    listings, listings_cols_df = fill_url_cols(listings, listings_cols_df)
-    listings, listings_cols_df = fill_location_cols(listings, listings_cols_df)
-    listings, listings_cols_df = fill_date_cols(listings, listings_cols_df)
-    listings, listings_cols_df = fill_percent_cols(listings, listings_cols_df)
-    listings, listings_cols_df = fill_time_cols(listings, listings_cols_df)
-    listings, listings_cols_df = fill_cat_cols(listings, listings_cols_df)
+@profiled
+def fill_listings_na(listings, imputer=None, city='seattle'):
+    """
+    A specific function to fill the listings missing values. It fits a
+    ListingsImputer on the listings. Nothing is saved: to fill new batches
+    of listings with the same statistics (see fill_new_listings), pass an
+    imputer and save it to imputer_path(city) after the call.
 
-    if save_listings_cols:
-        listings_cols_df.to_pickle(SEATTLE_LISTINGS_COLS)
+    Args:
+        listings (pandas.DataFrame): The transformed listings.
+        imputer (ListingsImputer): The imputer to fit (by default, a new one
+            with the column kinds saved by schema.load_column_kinds).
+        city (str): The city of the column kinds.
+    Returns:
+        pandas.DataFrame: The filled listings.
+    """
+    if imputer is None:
+        imputer = ListingsImputer(pd.read_pickle(listings_cols_path(city)))
+    return imputer.fit_transform(listings)
 
-    return listings
+
+def fill_new_listings(listings, city='seattle'):
+    """
+    Fills the missing values of a batch of new (transformed) listings, with
+    the imputer that was fitted by fill_listings_na.
+    """
+    return ListingsImputer.load(imputer_path(city)).transform(listings)
 
 
+@profiled
 def fill_reviews_na(reviews):
     """ A specific function to fill the reviews missing values."""
     return reviews.dropna()
 
 
+@profiled
 def fill_calendar_na(calendar, listings):
     """
     A specific function to fill the calendar missing values.
@@ -58,51 +73,216 @@ def fill_calendar_na(calendar, listings):
     Returns:
         pandas.DataFrame: The filled calendar.
     """
-    new_cal = calendar.copy()
-    new_cal = fill_df_in_time(new_cal)
+    new_cal = fill_df_in_time(calendar)
     return fill_with_listings(new_cal, listings)
 
 
+def fill_calendar_chunks(chunks, listings):
+    """
+    Fills the missing values of a calendar that comes in chunks, one chunk at
+    a time. The rows of the last listing of each chunk are held back until the
+    listing is complete, so the calendar must be grouped by listing_id (as
+    in the raw files). The results are the same as with 'fill_calendar_na'.
+
+    Args:
+        chunks (iterable(pandas.DataFrame)): The chunks of the calendar.
+        listings (pandas.DataFrame): Contains the static features of each
+            listing.
+    Returns:
+        generator(pandas.DataFrame): The filled chunks (with the original
+            index).
+    """
+    done = set()
+    pending = None
+    for chunk in chunks:
+        if pending is not None:
+            chunk = pd.concat([pending, chunk])
+        is_last = chunk.listing_id == chunk.listing_id.iloc[-1]
+        pending = chunk[is_last]
+        complete = chunk[~is_last]
+        if complete.shape[0] == 0:
+            continue
+        ids = set(complete.listing_id.unique())
+        if len(done.intersection(ids)) > 0:
+            raise ValueError('The calendar is not grouped by listing_id.')
+        done.update(ids)
+        yield _fill_calendar_block(complete, listings)
+    if pending is not None and pending.shape[0] > 0:
+        yield _fill_calendar_block(pending, listings)
+
+
+def _fill_calendar_block(calendar, listings):
+    """ Fills a part of the calendar that contains complete listings. """
+    filled = fill_calendar_na(calendar, listings)
+    filled.index = calendar.index
+    return filled
+
+
 def fill_in_time(ts):
     """ Fills a time series by forward filling and then backfilling"""
-    return ts.fillna(method='ffill').fillna(method='bfill')
+    return ts.ffill().bfill()
 
 
-def get_ts(df, values_col='price'):
+def get_ts(df, values_col='price', dropna=True):
     """
     Extracts one time series per listing.
     Args:
         df(pd.DataFrame): a dataframe with listing_id, date, and a value that
         changes in time (price, as default).
         values_col(str): the column to take as dependent variable.
+        dropna(bool): whether to drop the dates and listings without values.
     Returns:
         pd.DataFrame: A time series, indexed in dates, has one column per
         listing.
+    The prices of the processed calendar are also stored in this form, as a
+    memory-mapped file (see src.data.price_cube).
     """
     return pd.pivot_table(data=df,
                           index='date',
                           columns='listing_id',
-                          values=values_col)
+                          values=values_col,
+                          dropna=dropna)
 
 
+@profiled
 def fill_df_in_time(df, idx_col='listing_id', value_col='price'):
     """
     Fills an entire dataframe in time, by forward filling and then backfilling.
     It first groups the dataframe by idx_col.
     The df must have a 'date' column with timestamps.
+    The fill works on the long format: the rows are sorted once by (idx_col,
+    date) (unless they already are), and filled with vectorized operations
+    that don't cross from one group to another. The results are the same as
+    filling the (date x idx_col) table of get_ts, where repeated (idx_col,
+    date) pairs are averaged, except on the dates where no group has a
+    value: get_ts drops those dates, so the pivot fill left them missing,
+    and they are now filled within each group, like any other date. That way
+    the fill of a group doesn't depend on the others, and a calendar filled
+    in chunks or partitions gets the same results as the whole calendar.
     Args:
         df (pandas.DataFrame): The dataframe to fill
         idx_col (str): A column name to group by.
         value_col (str): The name of the column that has the values to fill.
-    """
-    tmp_df = df.copy()
-    ts = get_ts(tmp_df, values_col=value_col)
-    ts = ts.apply(fill_in_time)
-    tmp_df = tmp_df.set_index([idx_col, 'date'])
-    tmp_df.price = tmp_df.price.fillna(ts.unstack())
-    return tmp_df.reset_index()
-
+    Returns:
+        pandas.DataFrame: The filled dataframe, with idx_col and 'date' as the
+            first columns, and a new index.
+    """
+    order, new_group, new_cell = _time_order(df[idx_col].values,
+                                             df.date.values)
+    values = df[value_col].values.astype(float)
+    sorted_values = values if order is None else values[order]
+    missing = np.isnan(sorted_values)
+    if new_cell.all():
+        cells = sorted_values
+    else:
+        cells = _cell_means(sorted_values, new_cell)
+    filled = _group_fill(cells, new_group)[missing]
+    if order is None:
+        values[missing] = filled
+    else:
+        values[order[missing]] = filled
+    del order, sorted_values, cells, filled
+
+    columns = [idx_col, 'date'] + [col for col in df.columns
+                                   if col not in (idx_col, 'date')]
+    filled_df = df.reindex(columns=columns)
+    filled_df.index = pd.RangeIndex(filled_df.shape[0])
+    filled_df[value_col] = values
+    return filled_df
+
+
+def _time_order(ids, dates):
+    """
+    Finds the order of the rows by (id, date).
 
+    Args:
+        ids (numpy.ndarray): The id of each row.
+        dates (numpy.ndarray): The date of each row.
+    Returns:
+        numpy.ndarray: The positions of the rows, in order (None if the rows
+            are already grouped by id and sorted in time). The rows without
+            id or date are left out.
+        numpy.ndarray: Whether each row (in order) starts a new id.
+        numpy.ndarray: Whether each row (in order) starts a new (id, date).
+    """
+    is_valid = ~(pd.isnull(ids) | pd.isnull(dates))
+    if is_valid.all():
+        new_group, new_cell = _boundaries(ids, dates)
+        is_grouped = np.count_nonzero(new_group) == pd.unique(ids).size
+        if is_grouped and not np.any(~new_group[1:] &
+                                     (dates[1:] < dates[:-1])):
+            return None, new_group, new_cell
+        rows = None
+    else:
+        rows = np.flatnonzero(is_valid)
+        ids, dates = ids[rows], dates[rows]
+    del is_valid
+
+    id_codes = pd.factorize(ids, sort=True)[0]
+    date_codes = pd.factorize(dates, sort=True)[0]
+    order = np.lexsort((date_codes, id_codes))
+    new_group, new_cell = _boundaries(id_codes[order], date_codes[order])
+    if rows is not None:
+        order = rows[order]
+    return order, new_group, new_cell
+
+
+def _boundaries(ids, dates):
+    """ Whether each row starts a new id, and a new (id, date). """
+    new_group = np.ones(ids.size, dtype=bool)
+    new_group[1:] = ids[1:] != ids[:-1]
+    new_cell = new_group.copy()
+    new_cell[1:] |= dates[1:] != dates[:-1]
+    return new_group, new_cell
+
+
+def _cell_means(values, new_cell):
+    """
+    Replaces the values of the rows that share (id, date) with their mean
+    (ignoring NaNs), like pivot_table does.
+    """
+    cell = np.cumsum(new_cell) - 1
+    is_value = ~np.isnan(values)
+    sums = np.bincount(cell, weights=np.where(is_value, values, 0))
+    counts = np.bincount(cell, weights=is_value)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+    return means[cell]
+
+
+def _group_fill(values, new_group):
+    """
+    Forward fills and then backfills values that are sorted by group,
+    without crossing from one group to another.
+    """
+    n = values.size
+    int_dtype = np.int32 if n < np.iinfo(np.int32).max else np.int64
+    positions = np.arange(n, dtype=int_dtype)
+    is_value = ~np.isnan(values)
+
+    # The last value before each row, if it is in the same group
+    previous = np.where(is_value, positions, -1)
+    np.maximum.accumulate(previous, out=previous)
+    bound = np.where(new_group, positions, 0)
+    np.maximum.accumulate(bound, out=bound)
+    previous[previous < bound] = -1
+
+    # The first value after each row, if it is in the same group
+    following = np.where(is_value, positions, n)[::-1]
+    np.minimum.accumulate(following, out=following)
+    is_end = np.append(new_group[1:], True)
+    bound = np.where(is_end, positions, n)[::-1]
+    np.minimum.accumulate(bound, out=bound)
+    following[following > bound] = -1
+    del bound, positions
+
+    source = np.where(previous >= 0, previous, following[::-1])
+    filled = values[source]
+    filled[source < 0] = np.nan
+    return filled
+
+
+@profiled
 def fill_with_listings(calendar, listings):
     """
     Fills the missing prices in the calendar dataframe,
@@ -142,56 +322,31 @@ def create_is_missing(df, cols):
     return df.join(missing_df)
 
 
+# The per-kind helpers below fill the listings in steps, like
+# fill_listings_na did before the ListingsImputer. They are thin wrappers of
+# the imputer: each one fits it on the listings it gets, and fills only its
+# columns.
+
 def fill_num_cols(listings, listings_cols_df):
     """
-    Fills the missing data in the numeric features of the listings dataframe.
+    Fills the missing data in the numeric features of the listings dataframe,
+    adds the missing indicators and drops the features with too little data.
 
     Args:
         listings (pandas.DataFrame): Contains the static features of each
             listing.
-        num_cols (list(str)): The list of numeric column names to fill.
+        listings_cols_df (pandas.DataFrame): A dataframe with the 'kind' of
+            columns that each column is.
     Returns:
         pandas.DataFrame: The filled 'listings' dataframe.
         pandas.DataFrame: A dataframe with the 'kind' of
             columns that each column is.
     """
-    num_cols = pp.get_column_by_kind(listings_cols_df, 'num_cols')
-    num_listings = listings[num_cols]
-    has_missing = num_listings.columns[
-        num_listings.isnull().sum() > 0].tolist()
-    drop = [
-        'license',
-        'square_feet'
-    ]
-    most_frequent = [
-        'bathrooms',
-        'bedrooms',
-        'beds',
-        'host_listings_count',
-        'host_total_listings_count'
-    ]
-    # Others: mean
-    mean = list(
-        set(listings[has_missing].columns) - set(drop) - set(most_frequent))
-
-    # Create the "is_missing" feature for features with medium missing data
-    feat_cols = num_listings.columns[
-        (num_listings.isnull().mean() > 0.1) &
-        (num_listings.isnull().mean() < 0.9)].tolist()
-    listings = create_is_missing(listings, feat_cols)
-
-    # Drop the features that have too little data
-    drop = list(set(listings.columns).intersection(set(drop)))
-    listings = listings.drop(drop, axis=1)
-    drop = list(set(listings_cols_df.index).intersection(set(drop)))
-    listings_cols_df = listings_cols_df.drop(drop)
-
-    # Fill with the most frequent or the mean
-    listings[most_frequent] = listings[most_frequent].fillna(
-        listings[most_frequent].median())
-    listings[mean] = listings[mean].fillna(listings[mean].mean())
-
-    return listings, listings_cols_df
+    imputer = ListingsImputer(listings_cols_df).fit(listings)
+    listings = create_is_missing(listings, imputer.missing_indicators)
+    listings = listings.drop(imputer.drop_cols, axis=1)
+    return _fill_cols(listings, imputer, pp.get_column_by_kind(
+        imputer.listings_cols_df, 'num_cols')), imputer.listings_cols_df
 
 
 def fill_price_cols(listings, listings_cols_df):
@@ -206,25 +361,9 @@ def fill_price_cols(listings, listings_cols_df):
     Returns:
         The same arguments, with listings filled.
     """
-    # Fill the long-term prices with the daily price
-    week_factor = (listings.weekly_price / listings.price).mean()
-    listings.weekly_price = listings.weekly_price.fillna(
-        listings.price * week_factor)
-
-    month_factor = (listings.monthly_price / listings.price).mean()
-    listings.monthly_price = listings.monthly_price.fillna(
-        listings.price * month_factor)
-
-    # Fill the cleaning fee proportionally to the price
-    cleaning_coef = (listings.cleaning_fee / listings.price).mean()
-    listings.cleaning_fee = listings.cleaning_fee.fillna(
-        cleaning_coef * listings.price)
-
-    # Fill the security deposit with the mean
-    listings.security_deposit = listings.security_deposit.fillna(
-        listings.security_deposit.mean())
-
-    return listings, listings_cols_df
+    imputer = ListingsImputer(listings_cols_df).fit(listings)
+    cols = list(imputer.price_ratios) + ['security_deposit']
+    return _fill_cols(listings, imputer, cols), listings_cols_df
 
 
 def fill_tf_cols(listings, listings_cols_df):
@@ -239,10 +378,7 @@ def fill_tf_cols(listings, listings_cols_df):
     Returns:
         The same arguments, with listings filled.
     """
-    tf_cols = pp.get_column_by_kind(listings_cols_df, 'tf_cols')
-    listings[tf_cols] = listings[tf_cols].fillna(listings[tf_cols].median())
-
-    return listings, listings_cols_df
+    return _fill_kind(listings, listings_cols_df, 'tf_cols')
 
 
 def fill_free_text_cols(listings, listings_cols_df):
@@ -257,9 +393,7 @@ def fill_free_text_cols(listings, listings_cols_df):
     Returns:
         The same arguments, with listings filled.
     """
-    free_text_cols = pp.get_column_by_kind(listings_cols_df, 'free_text_cols')
-    listings[free_text_cols] = listings[free_text_cols].fillna('')
-    return listings, listings_cols_df
+    return _fill_kind(listings, listings_cols_df, 'free_text_cols')
 
 
 def fill_url_cols(listings, listings_cols_df):
@@ -274,9 +408,7 @@ def fill_url_cols(listings, listings_cols_df):
     Returns:
         The same arguments, with listings filled.
     """
-    url_cols = pp.get_column_by_kind(listings_cols_df, 'url_cols')
-    listings[url_cols] = listings[url_cols].fillna('')
-    return listings, listings_cols_df
+    return _fill_kind(listings, listings_cols_df, 'url_cols')
 
 
 def fill_location_cols(listings, listings_cols_df):
@@ -291,18 +423,10 @@ def fill_location_cols(listings, listings_cols_df):
     Returns:
         The same arguments, with listings filled.
     """
-    listings.neighbourhood = listings.neighbourhood.fillna(
-        listings.neighbourhood_cleansed)
-    listings.host_neighbourhood = listings.host_neighbourhood.fillna(
-        listings.neighbourhood)
-    listings.host_location = listings.host_location.fillna(
-        listings.host_location.value_counts().index[0])
-    listings.zipcode = listings.zipcode.fillna('')
-
-    # Fix a mistake
-    listings.loc[listings.zipcode == '99\n98122', 'zipcode'] = '98122'
-
-    return listings, listings_cols_df
+    imputer = ListingsImputer(listings_cols_df).fit(listings)
+    listings = _fill_cols(listings, imputer, [
+        'neighbourhood', 'host_neighbourhood', 'host_location', 'zipcode'])
+    return fix_zipcodes(listings), listings_cols_df
 
 
 def fill_date_cols(listings, listings_cols_df):
@@ -317,10 +441,9 @@ def fill_date_cols(listings, listings_cols_df):
     Returns:
         The same arguments, with listings filled.
     """
-    listings[['first_review', 'last_review']] = listings[
-        ['first_review', 'last_review']].fillna(listings.last_scraped.max())
-    listings = listings[~listings.host_since.isnull()]
-    return listings, listings_cols_df
+    imputer = ListingsImputer(listings_cols_df).fit(listings)
+    listings = _fill_cols(listings, imputer, ['first_review', 'last_review'])
+    return listings[~listings.host_since.isnull()], listings_cols_df
 
 
 def fill_percent_cols(listings, listings_cols_df):
@@ -335,10 +458,7 @@ def fill_percent_cols(listings, listings_cols_df):
     Returns:
         The same arguments, with listings filled.
     """
-    percent_cols = pp.get_column_by_kind(listings_cols_df, 'percent_cols')
-    listings[percent_cols] = listings[percent_cols].fillna(
-        listings[percent_cols].mean())
-    return listings, listings_cols_df
+    return _fill_kind(listings, listings_cols_df, 'percent_cols')
 
 
 def fill_time_cols(listings, listings_cols_df):
@@ -353,13 +473,15 @@ def fill_time_cols(listings, listings_cols_df):
     Returns:
         The same arguments, with listings filled.
     """
-    listings.host_response_time = listings.host_response_time.fillna('no data')
-    return listings, listings_cols_df
+    imputer = ListingsImputer(listings_cols_df).fit(listings)
+    return _fill_cols(listings, imputer,
+                      ['host_response_time']), listings_cols_df
 
 
 def fill_cat_cols(listings, listings_cols_df):
     """
-    Fill the missing data for the 'categorical simple' columns.
+    Fill the missing data for the 'categorical simple' columns (only the
+    MODE_COLS, with their most frequent value).
 
     Args:
         listings (pandas.DataFrame): Contains the static features of each
@@ -369,6 +491,19 @@ def fill_cat_cols(listings, listings_cols_df):
     Returns:
         The same arguments, with listings filled.
     """
-    listings.property_type = listings.property_type.fillna(
-        listings.property_type.value_counts().index[0])
-    return listings, listings_cols_df
+    imputer = ListingsImputer(listings_cols_df).fit(listings)
+    return _fill_cols(listings, imputer, MODE_COLS), listings_cols_df
+
+
+def _fill_kind(listings, listings_cols_df, kind):
+    """ Fills the columns of one kind with a fitted ListingsImputer. """
+    imputer = ListingsImputer(listings_cols_df).fit(listings)
+    return _fill_cols(listings, imputer, pp.get_column_by_kind(
+        listings_cols_df, kind)), listings_cols_df
+
+
+def _fill_cols(listings, imputer, cols):
+    """ Fills some columns of the listings with the values of an imputer. """
+    fill_values = imputer.batch_fill_values(listings)
+    return listings.fillna({col: fill_values[col] for col in cols
+                            if col in fill_values and col in listings})
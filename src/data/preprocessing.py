@@ -1,159 +1,198 @@
 """ A collection of functions to preprocess the data. """
 
-import numpy as np
 import pandas as pd
-from datetime import datetime
 import os
-from src.data import DATA_RAW, SEATTLE_CALENDAR_TEMP, SEATTLE_LISTINGS_TEMP,\
-    SEATTLE_REVIEWS_TEMP
-from src.utils import pandify
-
-DOLLAR_SIGN = '\$'
-
-
-def transform_all(calendar, listings, reviews, save_results=False):
+from src.data import DATA_RAW, DATA_INTERIM, table_path
+from src.data import storage
+from src.data.dtypes import AVAILABLE_DTYPE
+from src.data.schema import infer_column_kinds
+from src.profiling import profiled
+from src.utils import columnwise
+
+DOLLAR_SIGN = r'\$'
+DATE_FORMAT = '%Y-%m-%d'
+BOOL_STRINGS = {'t': True, 'True': True, 'f': False, 'False': False}
+
+# The kind of the calendar and reviews columns that are transformed (see
+# CONVERTERS)
+CALENDAR_KINDS = {'price': 'price_cols', 'available': 'tf_cols',
+                  'date': 'date_cols'}
+REVIEWS_KINDS = {'date': 'date_cols'}
+
+
+@profiled
+def transform_all(calendar, listings, reviews, save_results=False,
+                  listings_cols_df=None, city='seattle'):
     """ Transforms all the columns. """
-    calendar, listings, reviews = transform_prices(calendar, listings, reviews)
-    calendar, listings, reviews = transform_booleans(calendar, listings,
-                                                     reviews)
-    calendar, listings, reviews = transform_dates(calendar, listings,
-                                                  reviews)
-    calendar, listings, reviews = transform_percent(calendar, listings,
-                                                    reviews)
+    calendar = transform_calendar(calendar)
+    listings = transform_listings(listings, listings_cols_df)
+    reviews = transform_reviews(reviews)
 
     if save_results:
-        save_data(calendar, listings, reviews)
+        save_data(calendar, listings, reviews, city)
 
     return calendar, listings, reviews
 
 
-def transform_prices(calendar, listings, reviews):
+@profiled
+def transform_calendar(calendar, kinds=None):
     """
-    Transforms all the prices in '$x' format to float.
+    Transforms the prices, booleans and dates of the calendar (the
+    availability to nullable booleans). All the transformations are
+    row-local, so it can be applied to chunks of the calendar.
 
     Args:
         calendar (pandas.DataFrame): Contains prices and availabilities in
             time for the listings.
+        kinds (list(str)): The kinds of columns to transform (all the kinds
+            of CONVERTERS by default).
+    Returns:
+        pandas.DataFrame: The transformed calendar.
+    """
+    for col, kind in CALENDAR_KINDS.items():
+        if kinds is None or kind in kinds:
+            calendar[col] = CONVERTERS[kind](calendar[col])
+    if kinds is None or 'tf_cols' in kinds:
+        # The same dtype in every chunk, even if some availabilities are
+        # missing
+        calendar['available'] = calendar.available.astype(AVAILABLE_DTYPE)
+    return calendar
+
+
+@profiled
+def transform_listings(listings, listings_cols_df=None, kinds=None):
+    """
+    Transforms the prices, booleans, dates and percentages of the listings.
+
+    Args:
         listings (pandas.DataFrame): Contains the static features of each
             listing.
-        reviews (pandas.DataFrame): Contains the customer reviews for the
-            listings.
+        listings_cols_df (pandas.DataFrame): A dataframe with the 'kind' of
+            columns that each column is. It is inferred from the listings if
+            not given (see schema.infer_column_kinds).
+        kinds (list(str)): The kinds of columns to transform (all the kinds
+            of CONVERTERS by default).
     Returns:
-        The same arguments, transformed.
+        pandas.DataFrame: The transformed listings.
     """
-    calendar.price = price_to_float(calendar.price)
-
-    # Find features that have dollar signs in all non-null entries
-    obj_listings = listings.select_dtypes(include='object')
-    has_dsign = find_str(obj_listings)
-    all_dsign = obj_listings[obj_listings.columns[has_dsign.all()]]
-    price_cols = all_dsign.columns.tolist()
-
-    listings[price_cols] = price_to_float(listings[price_cols])
-
-    return calendar, listings, reviews
+    if listings_cols_df is None:
+        listings_cols_df = infer_column_kinds(listings)
+    for kind, converter in CONVERTERS.items():
+        if kinds is None or kind in kinds:
+            cols = get_column_by_kind(listings_cols_df, kind)
+            listings[cols] = converter(listings[cols])
+    return listings
 
 
-def transform_booleans(calendar, listings, reviews):
+@profiled
+def transform_reviews(reviews, kinds=None):
     """
-    Transforms all the 'boolean string' values (t/f) to booleans.
+    Transforms the dates of the reviews. It can be applied to chunks of the
+    reviews.
 
     Args:
-        calendar (pandas.DataFrame): Contains prices and availabilities in
-            time for the listings.
-        listings (pandas.DataFrame): Contains the static features of each
-            listing.
         reviews (pandas.DataFrame): Contains the customer reviews for the
             listings.
+        kinds (list(str)): The kinds of columns to transform (all the kinds
+            of CONVERTERS by default).
     Returns:
-        The same arguments, transformed.
+        pandas.DataFrame: The transformed reviews.
     """
-    # Calendar
-    calendar.available = string2bool(calendar.available)
+    for col, kind in REVIEWS_KINDS.items():
+        if kinds is None or kind in kinds:
+            reviews[col] = CONVERTERS[kind](reviews[col])
+    return reviews
 
-    # Listings
-    tf_any = is_tf(listings).sum() > 0
-    positive_tfs = is_tf(listings).mean()[tf_any]
-    tf_cols = positive_tfs.index.tolist()
-    listings[tf_cols] = string2bool(listings[tf_cols])
 
-    return calendar, listings, reviews
+def transform_prices(calendar, listings, reviews, listings_cols_df=None):
+    """
+    Transforms all the prices in '$x' format to float (one step of
+    transform_all, as in notebook 002).
+    """
+    return _transform_kind(calendar, listings, reviews, listings_cols_df,
+                           'price_cols')
 
 
-def transform_dates(calendar, listings, reviews):
+def transform_booleans(calendar, listings, reviews, listings_cols_df=None):
+    """
+    Transforms all the 'boolean string' values (t/f) to booleans (one step
+    of transform_all, as in notebook 002).
     """
-    Transforms all the 'date strings' to date format.
+    return _transform_kind(calendar, listings, reviews, listings_cols_df,
+                           'tf_cols')
 
-    Args:
-        calendar (pandas.DataFrame): Contains prices and availabilities in
-            time for the listings.
-        listings (pandas.DataFrame): Contains the static features of each
-            listing.
-        reviews (pandas.DataFrame): Contains the customer reviews for the
-            listings.
-    Returns:
-        The same arguments, transformed.
+
+def transform_dates(calendar, listings, reviews, listings_cols_df=None):
+    """
+    Transforms all the 'date strings' to date format (one step of
+    transform_all, as in notebook 002).
     """
-    # Calendar
-    calendar.date = string2date(calendar.date)
+    return _transform_kind(calendar, listings, reviews, listings_cols_df,
+                           'date_cols')
 
-    # Listings
-    is_date = listings.iloc[0].str.contains('\d{4}-\d{2}-\d{2}').fillna(False)
-    date_cols = listings.columns[is_date].tolist()
-    listings[date_cols] = string2date(listings[date_cols])
 
-    # Reviews
-    reviews.date = string2date(reviews.date)
+def transform_percent(calendar, listings, reviews, listings_cols_df=None):
+    """
+    Transforms all the 'percent strings' to floats (one step of
+    transform_all, as in notebook 002).
+    """
+    return _transform_kind(calendar, listings, reviews, listings_cols_df,
+                           'percent_cols')
 
-    return calendar, listings, reviews
+
+def _transform_kind(calendar, listings, reviews, listings_cols_df, kind):
+    """ Transforms the columns of one kind of the three tables. """
+    return (transform_calendar(calendar, [kind]),
+            transform_listings(listings, listings_cols_df, [kind]),
+            transform_reviews(reviews, [kind]))
 
 
-def transform_percent(calendar, listings, reviews):
+def load_data(raw_dir=DATA_RAW, city='seattle', chunksize=None):
     """
-    Transforms all the 'percent strings' to floats.
+    Loads the raw data.
 
     Args:
-        calendar (pandas.DataFrame): Contains prices and availabilities in
-            time for the listings.
-        listings (pandas.DataFrame): Contains the static features of each
-            listing.
-        reviews (pandas.DataFrame): Contains the customer reviews for the
-            listings.
+        raw_dir (str): The directory that contains one folder per city.
+        city (str): The name of the city folder.
+        chunksize (int): If given, the calendar and the reviews are returned
+            as iterators of dataframes with (at most) chunksize rows each. The
+            listings are always loaded at once.
     Returns:
-        The same arguments, transformed.
+        The calendar, listings and reviews.
     """
-    percent_cols = ['host_response_rate', 'host_acceptance_rate']
-    listings[percent_cols] = percent2num(listings[percent_cols])
+    calendar = pd.read_csv(os.path.join(raw_dir, city, 'calendar.csv'),
+                           chunksize=chunksize)
+    listings = pd.read_csv(os.path.join(raw_dir, city, 'listings.csv'))
+    reviews = pd.read_csv(os.path.join(raw_dir, city, 'reviews.csv'),
+                          chunksize=chunksize)
 
     return calendar, listings, reviews
 
 
-def load_data(raw_dir=DATA_RAW, city='seattle'):
-    """ Loads the raw data. """
-    calendar = pd.read_csv(os.path.join(raw_dir, city, 'calendar.csv'))
-    listings = pd.read_csv(os.path.join(raw_dir, city, 'listings.csv'))
-    reviews = pd.read_csv(os.path.join(raw_dir, city, 'reviews.csv'))
-
-    return calendar, listings, reviews
+def _strings(series):
+    """
+    Returns the string accessor of a series. Columns that are entirely NaN
+    are read as floats by pandas, so they are cast to object first.
+    """
+    return series.astype(object).str
 
 
-@pandify
+@columnwise
 def price_to_float(price_str):
     """
-    Converts a price string to float.
+    Converts price strings to floats.
     Args:
-        price_str (str): A price string like $67
+        price_str (pandas.Series): Price strings like $1,067 (or NaN)
     Returns:
-        float: The same price in float representation
+        pandas.Series: The same prices in float representation
     """
-    if price_str is np.nan:
-        return np.nan
-    return float(price_str[1:].replace(',', ''))
+    return _strings(price_str)[1:].str.replace(',', '', regex=False).astype(
+        float)
 
 
 def find_str(df, string=DOLLAR_SIGN):
     """
-    Finds substrings in a dataframe.
+    Finds substrings in a dataframe, one column at a time.
     By default it searches for the dollar sign.
 
     Args:
@@ -161,27 +200,32 @@ def find_str(df, string=DOLLAR_SIGN):
         string (str): A string pattern to find.
     Returns:
         pandas.DataFrame: A dataframe with 'True' in the positions where the
-            string pattern was found.
+            string pattern was found (False in the values that are not
+            strings).
     """
-    return df.apply(lambda x: x.str.contains(string), axis=1)
+    return df.apply(_contains, string=string)
+
 
+def _contains(column, string):
+    """ Whether each value of a column is a string that contains 'string'. """
+    if pd.api.types.infer_dtype(column, skipna=True) not in (
+            'string', 'mixed', 'mixed-integer'):
+        return pd.Series(False, index=column.index)
+    return _strings(column).contains(string, na=False)
 
-@pandify
+
+@columnwise
 def string2bool(text):
     """
     Convert 'boolean strings' (like 't', 'f', 'True', 'False') to booleans.
 
     Args:
-        text (str): Represents a boolean. Can be: 't', 'f', 'True', or 'False'.
+        text (pandas.Series): Represents booleans. Can be: 't', 'f', 'True',
+            or 'False'. Any other value is converted to NaN.
     Returns:
-        boolean: The corresponding boolean.
+        pandas.Series: The corresponding booleans.
     """
-    if (text == 't') or (text == 'True'):
-        return True
-    elif (text == 'f') or (text == 'False'):
-        return False
-    else:
-        return np.nan
+    return text.map(BOOL_STRINGS)
 
 
 def is_tf(df):
@@ -193,22 +237,23 @@ def is_tf(df):
         pandas.DataFrame: A dataframe of booleans that is True if the entry
             is any of the valid 'boolean string' values.
     """
-    return (df == 't') | (df == 'f') | (df == 'True') | (df == 'False')
+    return df.isin(list(BOOL_STRINGS))
 
 
-@pandify
+@columnwise
 def string2date(text):
     """
     Convert 'date strings' to dates.
 
     Args:
-        text (str): A string with a date in %Y-%m-%d format
+        text (pandas.Series): Strings with dates in %Y-%m-%d format
     Returns:
-        datetime.datetime: The converted date (ignores NaNs).
+        pandas.Series: The converted dates (NaNs become NaT).
     """
-    if text is np.nan:
-        return np.nan
-    return datetime.strptime(text, '%Y-%m-%d')
+    # pandas reads empty strings as NaT, but they are not dates
+    if (text.astype(object) == '').any():
+        raise ValueError('Empty date strings in {}'.format(text.name))
+    return pd.to_datetime(text, format=DATE_FORMAT)
 
 
 def get_column_by_kind(listing_cols_df, kind):
@@ -226,23 +271,28 @@ def get_column_by_kind(listing_cols_df, kind):
         listing_cols_df.kind == kind].tolist()
 
 
-@pandify
+@columnwise
 def percent2num(text):
     """
     Convert 'percent strings' to floats.
 
     Args:
-        text (str): A string with a percentage like '14%'
+        text (pandas.Series): Strings with percentages like '14%' (or NaN)
     Returns:
-        float: The percentage as a float.
+        pandas.Series: The percentages as floats.
     """
-    if text is np.nan:
-        return np.nan
-    return float(text[:-1])
+    return _strings(text)[:-1].astype(float)
+
+
+# The function that transforms each kind of column
+CONVERTERS = {'price_cols': price_to_float,
+              'tf_cols': string2bool,
+              'date_cols': string2date,
+              'percent_cols': percent2num}
 
 
-def save_data(calendar, listings, reviews):
-    """ Save the usual variables to pickles in the interim folder. """
-    calendar.to_pickle(SEATTLE_CALENDAR_TEMP)
-    listings.to_pickle(SEATTLE_LISTINGS_TEMP)
-    reviews.to_pickle(SEATTLE_REVIEWS_TEMP)
+def save_data(calendar, listings, reviews, city='seattle'):
+    """ Save the usual variables to the interim folder. """
+    storage.save_table(calendar, table_path(DATA_INTERIM, city, 'calendar'))
+    storage.save_table(listings, table_path(DATA_INTERIM, city, 'listings'))
+    storage.save_table(reviews, table_path(DATA_INTERIM, city, 'reviews'))
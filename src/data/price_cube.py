@@ -0,0 +1,161 @@
+"""
+A dense (listing x date) table of the calendar prices, stored as memory-mapped
+numpy files, so that it can be opened instantly and shared by many processes
+through the page cache.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from src.data import DATA_PROCESSED, price_cube_dir, table_path
+from src.data import storage
+
+CUBE_FILES = {
+    'values': 'prices.npy',
+    'listing_ids': 'listing_ids.npy',
+    'dates': 'dates.npy',
+}
+
+
+def build_price_cube(city='seattle', data_dir=DATA_PROCESSED):
+    """
+    Builds the price cube of a city from its processed calendar, and saves it
+    in the same data directory (see price_cube_dir). The prices are float32,
+    with NaN where the calendar has no price. If a (listing_id, date) pair
+    appears more than once, its prices are averaged (like pivot_table does),
+    and the rows without a listing_id or a date are left out. The files are
+    replaced atomically, so that processes that have the previous cube open
+    keep reading it.
+
+    Args:
+        city (str): The city.
+        data_dir (str): The directory of the processed data.
+    Returns:
+        PriceCube: The new cube.
+    """
+    calendar = storage.load_table(table_path(data_dir, city, 'calendar'),
+                                  columns=['listing_id', 'date', 'price'])
+    # pd.factorize gives them the code -1, that would be the last cell
+    calendar = calendar.dropna(subset=['listing_id', 'date'])
+    id_codes, listing_ids = pd.factorize(calendar.listing_id, sort=True)
+    date_codes, dates = pd.factorize(calendar.date, sort=True)
+    prices = calendar.price.values.astype(np.float32)
+    del calendar
+    cell = id_codes.astype(np.int64) * len(dates) + date_codes
+    if pd.Index(cell).has_duplicates:
+        means = pd.Series(prices).groupby(cell).mean()
+        cell, prices = means.index.values, means.values.astype(np.float32)
+
+    cube_dir = price_cube_dir(city, data_dir)
+    os.makedirs(cube_dir, exist_ok=True)
+    paths = {name: os.path.join(cube_dir, file_name)
+             for name, file_name in CUBE_FILES.items()}
+    values = np.lib.format.open_memmap(
+        _temp_path(paths['values']), mode='w+', dtype=np.float32,
+        shape=(len(listing_ids), len(dates)))
+    values[:] = np.nan
+    values.reshape(-1)[cell] = prices
+    values.flush()
+    del values
+    np.save(_temp_path(paths['listing_ids']), np.asarray(listing_ids))
+    np.save(_temp_path(paths['dates']),
+            np.asarray(dates, dtype='datetime64[ns]'))
+    for path in paths.values():
+        os.replace(_temp_path(path), path)
+    return open_price_cube(city, data_dir)
+
+
+def _temp_path(path):
+    """ The path where a file is written before it replaces 'path'. """
+    root, extension = os.path.splitext(path)
+    return root + '.tmp' + extension
+
+
+def open_price_cube(city='seattle', data_dir=DATA_PROCESSED):
+    """
+    Opens the price cube of a city, memory-mapped and read-only.
+
+    Args:
+        city (str): The city.
+        data_dir (str): The directory of the processed data.
+    Returns:
+        PriceCube: The cube.
+    """
+    cube_dir = price_cube_dir(city, data_dir)
+    return PriceCube(**{
+        name: np.load(os.path.join(cube_dir, file_name), mmap_mode='r')
+        for name, file_name in CUBE_FILES.items()})
+
+
+class PriceCube(object):
+    """
+    The prices of each listing (rows) in each date (columns).
+
+    Attributes:
+        values (numpy.ndarray): The (listing x date) float32 prices.
+        listing_ids (numpy.ndarray): The sorted listing ids of the rows.
+        dates (numpy.ndarray): The sorted dates of the columns.
+    """
+
+    def __init__(self, values, listing_ids, dates):
+        self.values = values
+        self.listing_ids = listing_ids
+        self.dates = dates
+
+    def select(self, listing_ids=None, start=None, end=None):
+        """
+        Selects the prices of some listings, between two dates. The result
+        is a view of the cube (without copying) unless the listings are not
+        consecutive in the cube (the ids between two listings are all
+        selected, or none of them).
+
+        Args:
+            listing_ids (list): The listings to select (all of them by
+                default), in the order of the result.
+            start: The first date (the first date of the cube by default).
+            end: The last date, included (the last date of the cube by
+                default).
+        Returns:
+            numpy.ndarray: The (listing x date) prices.
+        """
+        return self.values[self._rows(listing_ids), self._columns(start, end)]
+
+    def to_frame(self, listing_ids=None, start=None, end=None):
+        """
+        The same as 'select', as a (date x listing) dataframe, like
+        missing_data.get_ts (without dropping the missing values). The
+        dataframe is a view of the cube when 'select' returns one.
+        """
+        rows = self._rows(listing_ids)
+        columns = self._columns(start, end)
+        return pd.DataFrame(self.values[rows, columns].T,
+                            index=pd.DatetimeIndex(self.dates[columns],
+                                                   name='date'),
+                            columns=pd.Index(self.listing_ids[rows],
+                                             name='listing_id'),
+                            copy=False)
+
+    def _rows(self, listing_ids):
+        """ The rows of some listings: a slice if they are consecutive. """
+        if listing_ids is None:
+            return slice(None)
+        listing_ids = np.asarray(listing_ids)
+        if len(listing_ids) == 0:
+            return slice(0, 0)
+        rows = np.searchsorted(self.listing_ids, listing_ids)
+        rows = np.minimum(rows, len(self.listing_ids) - 1)
+        missing = self.listing_ids[rows] != listing_ids
+        if missing.any():
+            raise KeyError('Unknown listings: {}'.format(
+                listing_ids[missing].tolist()))
+        if np.array_equal(rows, np.arange(rows[0], rows[0] + len(rows))):
+            return slice(rows[0], rows[0] + len(rows))
+        return rows
+
+    def _columns(self, start, end):
+        """ The slice of the dates between start and end (included). """
+        first = 0 if start is None else np.searchsorted(
+            self.dates, np.datetime64(pd.Timestamp(start), 'ns'))
+        last = len(self.dates) if end is None else np.searchsorted(
+            self.dates, np.datetime64(pd.Timestamp(end), 'ns'), side='right')
+        return slice(first, last)
@@ -0,0 +1,145 @@
+""" Functions to infer the 'kind' of each column of the listings. """
+
+import json
+import os
+import re
+import sys
+import pandas as pd
+from src.data import cache
+from src.data import SEATTLE_LISTINGS_COLS
+from src.utils import file_fingerprint
+
+# Rows used to classify the columns.
+SAMPLE_SIZE = 1000
+
+# Text columns with more unique values than this fraction of their
+# non-null values are 'free text', the others are categorical.
+FREE_TEXT_MIN_UNIQUE = 0.3
+
+# The 'kinds' that can be recognized by the format of the values, in order
+# of precedence. All the non-null values of a column must match.
+KIND_PATTERNS = [
+    ('price_cols', r'\$[\d,]+(?:\.\d+)?'),
+    ('percent_cols', r'\d+(?:\.\d+)?%'),
+    ('tf_cols', r't|f|True|False'),
+    ('date_cols', r'\d{4}-\d{2}-\d{2}'),
+    ('url_cols', r'https?://\S*'),
+    ('list_cols', r'\[.*\]'),
+    ('dict_cols', r'\{.*\}'),
+]
+KINDS_REGEX = '^(?:' + '|'.join('(?P<{}>{})'.format(kind, pattern)
+                                for kind, pattern in KIND_PATTERNS) + ')$'
+
+# Columns whose kind can't be recognized by the format of their values (the
+# free text, location and time columns of notebook 001). The free text
+# columns can have few unique values in small or synthetic data.
+KNOWN_KINDS = {
+    'name': 'free_text_cols',
+    'summary': 'free_text_cols',
+    'space': 'free_text_cols',
+    'description': 'free_text_cols',
+    'neighborhood_overview': 'free_text_cols',
+    'notes': 'free_text_cols',
+    'transit': 'free_text_cols',
+    'host_about': 'free_text_cols',
+    'host_name': 'free_text_cols',
+    'street': 'location_cols',
+    'host_location': 'location_cols',
+    'host_neighbourhood': 'location_cols',
+    'neighbourhood': 'location_cols',
+    'neighbourhood_cleansed': 'location_cols',
+    'neighbourhood_group_cleansed': 'location_cols',
+    'city': 'location_cols',
+    'state': 'location_cols',
+    'zipcode': 'location_cols',
+    'market': 'location_cols',
+    'smart_location': 'location_cols',
+    'country_code': 'location_cols',
+    'country': 'location_cols',
+    'host_response_time': 'time_cols',
+    'calendar_updated': 'time_cols',
+}
+
+
+def infer_column_kinds(listings, sample_size=SAMPLE_SIZE):
+    """
+    Classifies the columns of the raw listings in 'kinds': 'num_cols',
+    'price_cols', 'percent_cols', 'tf_cols', 'date_cols', 'url_cols',
+    'list_cols', 'dict_cols', 'free_text_cols' or 'categorical_simple_cols'.
+    The text columns are classified with one regular expression over a
+    sample of the rows, and the kinds found by format are then confirmed on
+    the full columns. The KNOWN_KINDS are assigned by name.
+
+    Args:
+        listings (pandas.DataFrame): The raw listings.
+        sample_size (int): The maximum number of rows to classify.
+    Returns:
+        pandas.DataFrame: A dataframe with the 'kind' of each column (the
+            'listings_cols_df').
+    """
+    kinds = pd.Series('num_cols', index=listings.columns, name='kind')
+    text = listings.select_dtypes(include='object')
+    if len(text.columns) > 0:
+        kinds[text.columns] = _text_kinds(text, sample_size)
+    known = [col for col in KNOWN_KINDS if col in kinds.index]
+    kinds[known] = [KNOWN_KINDS[col] for col in known]
+    return kinds.to_frame()
+
+
+def _text_kinds(text, sample_size):
+    """ Classifies the text columns of the listings. """
+    sample = text.sample(min(sample_size, text.shape[0]), random_state=0)
+    values = sample.melt(var_name='column').dropna()
+    values = values.value.astype(str).groupby(values.column.values)
+    matches = values.obj.str.extract(KINDS_REGEX, flags=re.DOTALL).notnull()
+    matches = matches.groupby(values.keys).all()
+
+    unique_frac = values.nunique() / values.count()
+    kinds = pd.Series('categorical_simple_cols', index=text.columns)
+    kinds[unique_frac.index[unique_frac > FREE_TEXT_MIN_UNIQUE]] = \
+        'free_text_cols'
+    for kind, pattern in reversed(KIND_PATTERNS):
+        for col in matches.index[matches[kind]]:
+            if _all_match(text[col], pattern):
+                kinds[col] = kind
+    return kinds
+
+
+def _all_match(series, pattern):
+    """ Whether all the non-null values of a column match a pattern. """
+    values = series.dropna().astype(str)
+    return values.str.fullmatch(pattern, flags=re.DOTALL).all()
+
+
+def load_column_kinds(listings_path, listings=None,
+                      cols_path=SEATTLE_LISTINGS_COLS):
+    """
+    Gets the 'listings_cols_df' of a raw listings file. It is inferred and
+    saved to cols_path the first time; if neither the file nor the code of
+    this module changed after that, the saved version is loaded.
+
+    Args:
+        listings_path (str): The path of the raw listings csv.
+        listings (pandas.DataFrame): The raw listings, if they were already
+            loaded.
+        cols_path (str): Where the 'listings_cols_df' is saved.
+    Returns:
+        pandas.DataFrame: A dataframe with the 'kind' of each column.
+    """
+    fingerprint = {'listings': file_fingerprint(listings_path),
+                   'code': cache.source_fingerprint(sys.modules[__name__])}
+    meta_path = os.path.splitext(cols_path)[0] + '.json'
+    if os.path.exists(cols_path) and os.path.exists(meta_path):
+        with open(meta_path) as meta_file:
+            if json.load(meta_file).get('fingerprint') == fingerprint:
+                return pd.read_pickle(cols_path)
+
+    if listings is None:
+        listings = pd.read_csv(listings_path)
+    listings_cols_df = infer_column_kinds(listings)
+    os.makedirs(os.path.dirname(cols_path), exist_ok=True)
+    listings_cols_df.to_pickle(cols_path)
+    with open(meta_path, 'w') as meta_file:
+        json.dump({'fingerprint': fingerprint,
+                   'source': os.path.abspath(listings_path)}, meta_file)
+    return listings_cols_df
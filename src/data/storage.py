@@ -0,0 +1,359 @@
+""" Functions to save and load the data tables in different file formats. """
+
+import logging
+import os
+import shutil
+from glob import glob
+import operator
+import pandas as pd
+from src.data import EXTENSIONS
+
+ROW_GROUP_SIZE = 100000
+
+FILTER_OPS = {
+    '==': operator.eq,
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+def get_format(path):
+    """
+    Finds the format of a table from the extension of its path.
+
+    Args:
+        path (str): The path of a table.
+    Returns:
+        str: 'pickle', 'parquet' or 'feather'.
+    """
+    extension = os.path.splitext(path)[1]
+    for data_format, format_extension in EXTENSIONS.items():
+        if extension == format_extension:
+            return data_format
+    raise ValueError('Unknown data format for {}'.format(path))
+
+
+def chunks_dir(path):
+    """ The directory where a pickled table that was saved by chunks is. """
+    return os.path.splitext(path)[0]
+
+
+def save_table(df, path):
+    """
+    Saves a dataframe in the format given by the extension of 'path'.
+    Parquet files are written in row groups of ROW_GROUP_SIZE rows, and
+    feather files are not compressed, so that they can be memory-mapped.
+
+    Args:
+        df (pandas.DataFrame): The table to save.
+        path (str): The path of the file.
+    """
+    data_format = get_format(path)
+    remove_table(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if data_format == 'pickle':
+        df.to_pickle(path)
+    elif data_format == 'parquet':
+        import pyarrow.parquet as pq
+        pq.write_table(_to_arrow(df), path, row_group_size=ROW_GROUP_SIZE)
+    else:
+        import pyarrow.feather as feather
+        feather.write_feather(_to_arrow(df), path,
+                              compression='uncompressed')
+
+
+def save_chunks(chunks, paths):
+    """
+    Saves a table that comes in chunks, so that only one chunk needs to be in
+    memory at a time. Parquet and feather tables are appended to a single
+    file; pickled tables are saved one pickle per chunk, in a directory with
+    the same name as the path, without the extension.
+
+    Args:
+        chunks (iterable(pandas.DataFrame)): The chunks of the table. They
+            must all have the same columns and dtypes.
+        paths (list(str) or dict): The paths where the table is saved (any
+            previous version of the table is removed), or a dict with a
+            function for each path, that converts the chunks before they are
+            saved there (None to save them as they are).
+    Returns:
+        int: The number of rows that were saved.
+    """
+    if not isinstance(paths, dict):
+        paths = dict.fromkeys(paths)
+    writers = [(_ChunkWriter(path), convert)
+               for path, convert in paths.items()]
+    n_rows = 0
+    try:
+        for chunk in chunks:
+            for writer, convert in writers:
+                writer.write(chunk if convert is None else convert(chunk))
+            n_rows += chunk.shape[0]
+    finally:
+        for writer, _ in writers:
+            writer.close()
+    return n_rows
+
+
+def load_table(path, columns=None, filters=None, memory_map=False):
+    """
+    Loads a table saved with 'save_table' or 'save_chunks' (or a directory
+    of parquet files written by dask).
+
+    Args:
+        path (str): The path of the table.
+        columns (list(str)): The columns to read (all of them by default).
+            For the columnar formats only those columns are read from disk.
+        filters (list(tuple)): Conditions that the rows must meet, all of
+            them, like [('date', '>=', pd.Timestamp('2016-06-01')),
+            ('listing_id', 'in', ids)]. The operators are '==', '!=', '<',
+            '<=', '>', '>=', 'in' and 'not in'. In parquet files, the row
+            groups that can't meet them are not read.
+        memory_map (bool): Whether to memory-map the file instead of reading
+            it (parquet and feather only). The uncompressed feather columns
+            without missing values are not copied.
+    Returns:
+        pandas.DataFrame: The loaded table.
+    """
+    data_format = get_format(path)
+    if data_format == 'pickle':
+        return _load_pickle(path, columns, filters)
+
+    if data_format == 'parquet':
+        import pyarrow.parquet as pq
+        table = pq.read_table(path, columns=columns, filters=filters,
+                              memory_map=memory_map, use_pandas_metadata=True)
+    else:
+        table = _read_feather(path, columns, filters, memory_map)
+    return table.to_pandas(types_mapper=_pandas_dtype)
+
+
+def iter_table(path, columns=None, filters=None, chunk_rows=ROW_GROUP_SIZE):
+    """
+    Reads a table saved with 'save_table' or 'save_chunks' (or a directory
+    of parquet files written by dask) in chunks, so that only one chunk is in
+    memory at a time.
+
+    Args:
+        path (str): The path of the table.
+        columns (list(str)): The columns to read (see load_table).
+        filters (list(tuple)): Conditions that the rows must meet (see
+            load_table). In parquet files, the row groups that can't meet
+            them are not read.
+        chunk_rows (int): The maximum number of rows of a chunk (the chunks
+            of a pickled table are the saved chunks).
+    Yields:
+        pandas.DataFrame: The chunks of the table (with the stored index).
+    """
+    data_format = get_format(path)
+    if data_format == 'pickle':
+        parts = [path] if os.path.exists(path) else sorted(
+            glob(os.path.join(chunks_dir(path), 'part-*.pkl')))
+        for part in parts:
+            yield _load_pickle(part, columns, filters)
+        return
+
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    dataset = ds.dataset(path, format='parquet' if data_format == 'parquet'
+                         else 'ipc')
+    metadata = dataset.schema.metadata
+    index_cols = [c for c in (dataset.schema.pandas_metadata or {}).get(
+        'index_columns', []) if isinstance(c, str)]
+    if columns is not None:
+        columns = list(columns) + [c for c in index_cols if c not in columns]
+    scanner = dataset.scanner(
+        columns=columns, batch_size=chunk_rows,
+        filter=_filters_to_expression(filters) if filters else None)
+    for batch in scanner.to_batches():
+        if batch.num_rows == 0:
+            continue
+        table = pa.Table.from_batches([batch])
+        if index_cols:
+            table = table.replace_schema_metadata(metadata)
+        yield table.to_pandas(types_mapper=_pandas_dtype)
+
+
+def _pandas_dtype(arrow_type):
+    """ Keeps the arrow strings as arrow strings in pandas. """
+    import pyarrow as pa
+    if arrow_type in (pa.string(), pa.large_string()):
+        return pd.StringDtype('pyarrow')
+    return None
+
+
+def _load_pickle(path, columns, filters):
+    """ Loads a pickled table, and selects the rows and columns. """
+    if os.path.exists(path):
+        df = pd.read_pickle(path)
+    else:
+        parts = sorted(glob(os.path.join(chunks_dir(path), 'part-*.pkl')))
+        df = pd.concat([pd.read_pickle(part) for part in parts])
+    if filters:
+        df = df[_filters_mask(df, filters)]
+    if columns is not None:
+        df = df[columns]
+    return df
+
+
+def _read_feather(path, columns, filters, memory_map):
+    """ Reads a feather file (Arrow IPC) as an arrow table. """
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    if memory_map:
+        table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+    else:
+        filter_cols = [f[0] for f in filters or []]
+        table = feather.read_table(path,
+                                   columns=_with_index(path, columns,
+                                                       filter_cols))
+    if filters:
+        table = table.filter(_filters_to_expression(filters))
+    if columns is not None:
+        table = table.select(_with_index(path, columns))
+    return table
+
+
+def _with_index(path, columns, extra_cols=()):
+    """
+    Adds the stored index columns (if any), and some extra columns, to a list
+    of columns of a feather file.
+    """
+    if columns is None:
+        return None
+    import pyarrow as pa
+    schema = pa.ipc.open_file(path).schema
+    index_cols = [c for c in (schema.pandas_metadata or {}).get(
+        'index_columns', []) if isinstance(c, str)]
+    selected = list(columns)
+    return selected + [c for c in index_cols + list(extra_cols)
+                       if c not in selected]
+
+
+def _filters_to_expression(filters):
+    """ Converts a list of (column, op, value) to an arrow expression. """
+    import pyarrow.dataset as ds
+    expression = None
+    for column, op, value in filters:
+        field = ds.field(column)
+        if op == 'in':
+            condition = field.isin(list(value))
+        elif op == 'not in':
+            condition = ~field.isin(list(value))
+        else:
+            condition = FILTER_OPS[op](field, value)
+        expression = condition if expression is None else \
+            expression & condition
+    return expression
+
+
+def _filters_mask(df, filters):
+    """ Evaluates a list of (column, operator, value) on a dataframe. """
+    mask = pd.Series(True, index=df.index)
+    for column, op, value in filters:
+        if op == 'in':
+            mask &= df[column].isin(value)
+        elif op == 'not in':
+            mask &= ~df[column].isin(value)
+        else:
+            mask &= FILTER_OPS[op](df[column], value)
+    return mask
+
+
+def _to_arrow(df, schema=None, preserve_index=None):
+    """ Converts a dataframe to an arrow table. """
+    import pyarrow as pa
+    return pa.Table.from_pandas(_arrow_compatible(df), schema=schema,
+                                preserve_index=preserve_index)
+
+
+def _arrow_compatible(df):
+    """
+    Arrow columns have only one type, so the object columns that mix types
+    are converted: to floats if all the values are numbers or booleans (like
+    the 'tf' columns filled with their median), and to strings otherwise.
+    They are loaded back with the new type, so the converted columns are
+    logged as a warning.
+    """
+    mixed_cols = [col for col in df.select_dtypes(include='object').columns
+                  if pd.api.types.infer_dtype(df[col], skipna=True) in
+                  ('mixed', 'mixed-integer')]
+    if len(mixed_cols) == 0:
+        return df
+    df = df.copy()
+    converted = {'float': [], 'str': []}
+    for col in mixed_cols:
+        try:
+            df[col] = df[col].astype(float)
+            converted['float'].append(col)
+        except (TypeError, ValueError):
+            df[col] = df[col].where(df[col].isnull(), df[col].astype(str))
+            converted['str'].append(col)
+    logger = logging.getLogger(__name__)
+    for dtype, cols in converted.items():
+        if cols:
+            logger.warning('The columns {} mix types: they are saved as '
+                           '{}'.format(cols, dtype))
+    return df
+
+
+def remove_table(path):
+    """
+    Removes any previous version of a table (file, chunks, or a directory of
+    parquet files written by dask).
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+    if get_format(path) == 'pickle':
+        shutil.rmtree(chunks_dir(path), ignore_errors=True)
+
+
+class _ChunkWriter(object):
+    """ Appends chunks of a dataframe to a table. """
+
+    def __init__(self, path):
+        self.path = path
+        self.data_format = get_format(path)
+        self.schema = None
+        self.writer = None
+        self.n_chunks = 0
+        remove_table(path)
+        if self.data_format == 'pickle':
+            os.makedirs(chunks_dir(path))
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def write(self, chunk):
+        """ Appends one chunk. """
+        if self.data_format == 'pickle':
+            chunk.to_pickle(os.path.join(
+                chunks_dir(self.path),
+                'part-{:05d}.pkl'.format(self.n_chunks)))
+        else:
+            # The index is always stored as a column, so that the index of
+            # every chunk is kept.
+            table = _to_arrow(chunk, schema=self.schema, preserve_index=True)
+            if self.writer is None:
+                self.schema = table.schema
+                self.writer = self._open(table.schema)
+            self.writer.write_table(table)
+        self.n_chunks += 1
+
+    def _open(self, schema):
+        """ Opens an arrow writer for the file. """
+        if self.data_format == 'parquet':
+            import pyarrow.parquet as pq
+            return pq.ParquetWriter(self.path, schema)
+        import pyarrow as pa
+        return pa.ipc.new_file(self.path, schema)
+
+    def close(self):
+        """ Closes the file. """
+        if self.writer is not None:
+            self.writer.close()
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+""" Generates synthetic raw data with the schema of Inside Airbnb. """
+
+import click
+import logging
+import os
+import numpy as np
+import pandas as pd
+from src.data import DATA_SYNTHETIC
+
+# The size of the Seattle data (scale 1)
+SEATTLE_N_LISTINGS = 3818
+SEATTLE_N_REVIEWS = 84849
+N_DAYS = 365
+START_DATE = '2016-01-04'
+
+# The calendar and reviews are generated and written in blocks of this many
+# listings, so that large scales don't need to fit in memory.
+BLOCK_LISTINGS = 2000
+
+NEIGHBOURHOODS = ['Ballard', 'Belltown', 'Capitol Hill', 'Central District',
+                  'Fremont', 'Green Lake', 'Minor', 'Queen Anne',
+                  'University District', 'Wallingford']
+ZIPCODES = ['98101', '98102', '98103', '98105', '98107', '98109', '98112',
+            '98115', '98117', '98122']
+PROPERTY_TYPES = ['House', 'Apartment', 'Townhouse', 'Condominium', 'Loft']
+ROOM_TYPES = ['Entire home/apt', 'Private room', 'Shared room']
+BED_TYPES = ['Real Bed', 'Futon', 'Pull-out Sofa', 'Airbed', 'Couch']
+RESPONSE_TIMES = ['within an hour', 'within a few hours', 'within a day',
+                  'a few days or more']
+CANCELLATION_POLICIES = ['flexible', 'moderate', 'strict']
+VERIFICATIONS = ["['email', 'phone', 'reviews']",
+                 "['email', 'phone', 'facebook', 'reviews', 'kba']",
+                 "['email', 'phone', 'reviews', 'jumio']"]
+AMENITIES = ['{TV,"Wireless Internet",Kitchen,Heating}',
+             '{Internet,"Wireless Internet",Kitchen,"Free Parking on '
+             'Premises",Washer,Dryer}',
+             '{TV,"Cable TV",Internet,"Wireless Internet","Air '
+             'Conditioning",Kitchen,Heating,"Smoke Detector"}']
+WORDS = np.array(['great', 'place', 'clean', 'cozy', 'host', 'location',
+                  'quiet', 'walk', 'coffee', 'view', 'comfortable', 'bed',
+                  'kitchen', 'friendly', 'neighborhood', 'recommend',
+                  'stay', 'easy', 'downtown', 'lovely'])
+
+
+@click.command()
+@click.option('--scale', type=float, default=1,
+              help='The size of the data, relative to Seattle.')
+@click.option('--output', type=click.Path(), default=DATA_SYNTHETIC,
+              help='The directory where the city folder is created.')
+@click.option('--seed', type=int, default=0)
+def main(scale, output, seed):
+    """ Creates a synthetic city in the output folder. """
+    logger = logging.getLogger(__name__)
+    city_dir = create_synthetic_city(scale, output, seed=seed)
+    logger.info('The synthetic data is in {}'.format(city_dir))
+
+
+def city_name(scale):
+    """ The name of the synthetic city of a scale, like 'synthetic_10x'. """
+    return 'synthetic_{:g}x'.format(scale)
+
+
+def create_synthetic_city(scale=1, raw_dir=DATA_SYNTHETIC, city=None,
+                          seed=0):
+    """
+    Writes the calendar.csv, listings.csv and reviews.csv of a synthetic
+    city, with the schema of the raw Inside Airbnb files: prices like
+    '$1,250.00', 't'/'f' booleans, percentages like '96%', '%Y-%m-%d' dates,
+    and missing values in the same columns and proportions as in Seattle.
+
+    Args:
+        scale (float): The number of listings and reviews, relative to
+            Seattle (the calendar always has N_DAYS days).
+        raw_dir (str): The directory where the city folder is created.
+        city (str): The name of the city folder (city_name(scale) by
+            default).
+        seed (int): The seed of the random generator.
+    Returns:
+        str: The path of the city folder.
+    """
+    rng = np.random.RandomState(seed)
+    city_dir = os.path.join(raw_dir, city or city_name(scale))
+    os.makedirs(city_dir, exist_ok=True)
+
+    listings = synthetic_listings(int(round(SEATTLE_N_LISTINGS * scale)), rng)
+    listings.to_csv(os.path.join(city_dir, 'listings.csv'), index=False)
+    _write_blocks(synthetic_calendar(listings, rng),
+                  os.path.join(city_dir, 'calendar.csv'))
+    _write_blocks(synthetic_reviews(listings,
+                                    int(round(SEATTLE_N_REVIEWS * scale)),
+                                    rng),
+                  os.path.join(city_dir, 'reviews.csv'))
+    return city_dir
+
+
+def _write_blocks(blocks, path):
+    """ Writes dataframes to one csv file. """
+    for i, block in enumerate(blocks):
+        block.to_csv(path, index=False, header=i == 0,
+                     mode='w' if i == 0 else 'a')
+
+
+def synthetic_listings(n_listings, rng):
+    """
+    Generates the raw listings.
+
+    Args:
+        n_listings (int): The number of listings.
+        rng (numpy.random.RandomState): The random generator.
+    Returns:
+        pandas.DataFrame: The listings, with the raw formats.
+    """
+    ids = np.sort(rng.choice(np.arange(1, 20 * n_listings + 1000),
+                             n_listings, replace=False))
+    host_ids = rng.randint(1, 50 * n_listings, n_listings)
+    scraped = pd.Timestamp(START_DATE)
+    host_since = scraped - pd.to_timedelta(rng.randint(30, 2500, n_listings),
+                                           unit='D')
+    room_type = rng.choice(ROOM_TYPES, n_listings, p=[0.66, 0.31, 0.03])
+    accommodates = rng.randint(1, 9, n_listings)
+    price = np.round(np.exp(rng.normal(4.7, 0.55, n_listings)))
+    n_reviews = rng.poisson(22, n_listings) * (rng.rand(n_listings) > 0.16)
+    has_reviews = n_reviews > 0
+    first_review = scraped - pd.to_timedelta(
+        rng.randint(200, 2000, n_listings), unit='D')
+    last_review = scraped - pd.to_timedelta(rng.randint(1, 200, n_listings),
+                                            unit='D')
+    neighbourhood = rng.choice(NEIGHBOURHOODS, n_listings)
+    rate = rng.randint(50, 101, n_listings)
+
+    def missing(values, frac):
+        return with_missing(values, frac, rng)
+
+    def dates(values, mask=None):
+        text = pd.Series(values).dt.strftime('%Y-%m-%d').values
+        return text if mask is None else np.where(mask, text, None)
+
+    def scores(low, high, mask):
+        return np.where(mask, rng.randint(low, high + 1, n_listings),
+                        np.nan)
+
+    listings = pd.DataFrame({
+        'id': ids,
+        'listing_url': ['https://www.airbnb.com/rooms/{}'.format(i)
+                        for i in ids],
+        'scrape_id': 20160104002432,
+        'last_scraped': START_DATE,
+        'name': ['{} {} in {}'.format(adjective, kind, place) for
+                 adjective, kind, place in zip(
+                     rng.choice(['Cozy', 'Sunny', 'Modern', 'Charming'],
+                                n_listings),
+                     rng.choice(['Studio', 'Home', 'Room', 'Loft'],
+                                n_listings),
+                     neighbourhood)],
+        'summary': missing(random_text(n_listings, 30, rng), 0.05),
+        'description': random_text(n_listings, 120, rng),
+        'experiences_offered': 'none',
+        'host_id': host_ids,
+        'host_name': missing(rng.choice(['Ann', 'Bob', 'Carla', 'Dan', 'Eve',
+                                         'Frank'], n_listings), 0.001),
+        'host_since': missing(dates(host_since), 0.001),
+        'host_location': missing(rng.choice(
+            ['Seattle, Washington, United States', 'US',
+             'Portland, Oregon, United States'], n_listings,
+            p=[0.9, 0.05, 0.05]), 0.002),
+        'host_about': missing(random_text(n_listings, 40, rng), 0.22),
+        'host_response_time': missing(rng.choice(RESPONSE_TIMES,
+                                                 n_listings), 0.14),
+        'host_response_rate': missing(format_percent(rate), 0.14),
+        'host_acceptance_rate': missing(format_percent(
+            np.minimum(rate + 10, 100)), 0.2),
+        'host_is_superhost': missing(rng.choice(['t', 'f'], n_listings,
+                                                p=[0.2, 0.8]), 0.001),
+        'host_neighbourhood': missing(neighbourhood, 0.08),
+        'host_listings_count': missing(rng.randint(1, 6, n_listings) * 1.0,
+                                       0.001),
+        'host_total_listings_count': missing(
+            rng.randint(1, 6, n_listings) * 1.0, 0.001),
+        'host_verifications': rng.choice(VERIFICATIONS, n_listings),
+        'host_has_profile_pic': missing(rng.choice(['t', 'f'], n_listings,
+                                                   p=[0.99, 0.01]), 0.001),
+        'host_identity_verified': missing(rng.choice(['t', 'f'], n_listings,
+                                                     p=[0.78, 0.22]), 0.001),
+        'neighbourhood': missing(neighbourhood, 0.11),
+        'neighbourhood_cleansed': neighbourhood,
+        'city': 'Seattle',
+        'state': 'WA',
+        'zipcode': missing(rng.choice(ZIPCODES, n_listings), 0.002),
+        'market': 'Seattle',
+        'country': 'United States',
+        'latitude': 47.6 + 0.05 * rng.randn(n_listings),
+        'longitude': -122.33 + 0.04 * rng.randn(n_listings),
+        'is_location_exact': rng.choice(['t', 'f'], n_listings,
+                                        p=[0.9, 0.1]),
+        'property_type': missing(rng.choice(
+            PROPERTY_TYPES, n_listings, p=[0.45, 0.45, 0.04, 0.03, 0.03]),
+            0.001),
+        'room_type': room_type,
+        'accommodates': accommodates,
+        'bathrooms': missing(rng.choice([1.0, 1.5, 2.0, 2.5], n_listings),
+                             0.004),
+        'bedrooms': missing(np.maximum(accommodates // 2, 1) * 1.0, 0.002),
+        'beds': missing(np.maximum(accommodates // 2, 1) * 1.0, 0.001),
+        'bed_type': rng.choice(BED_TYPES, n_listings,
+                               p=[0.96, 0.01, 0.01, 0.01, 0.01]),
+        'amenities': rng.choice(AMENITIES, n_listings),
+        'square_feet': missing(rng.randint(300, 2500, n_listings) * 1.0,
+                               0.97),
+        'price': format_price(price),
+        'weekly_price': missing(format_price(np.round(price * 6.3)), 0.47),
+        'monthly_price': missing(format_price(np.round(price * 23)), 0.6),
+        'security_deposit': missing(format_price(
+            rng.choice([100, 150, 200, 300, 500], n_listings)), 0.51),
+        'cleaning_fee': missing(format_price(rng.randint(10, 150,
+                                                         n_listings)), 0.27),
+        'guests_included': rng.randint(1, 4, n_listings),
+        'extra_people': format_price(rng.choice([0, 10, 20, 25],
+                                                n_listings)),
+        'minimum_nights': rng.randint(1, 5, n_listings),
+        'maximum_nights': 1125,
+        'calendar_updated': rng.choice(['today', 'yesterday', '2 weeks ago',
+                                        'a week ago', '3 months ago'],
+                                       n_listings),
+        'has_availability': 't',
+        'availability_30': rng.randint(0, 31, n_listings),
+        'availability_365': rng.randint(0, 366, n_listings),
+        'calendar_last_scraped': START_DATE,
+        'number_of_reviews': n_reviews,
+        'first_review': dates(first_review, has_reviews),
+        'last_review': dates(last_review, has_reviews),
+        'review_scores_rating': scores(60, 100, has_reviews),
+        'review_scores_accuracy': scores(6, 10, has_reviews),
+        'review_scores_cleanliness': scores(6, 10, has_reviews),
+        'review_scores_location': scores(6, 10, has_reviews),
+        'review_scores_value': scores(6, 10, has_reviews),
+        'requires_license': 'f',
+        'license': np.nan,
+        'jurisdiction_names': 'WASHINGTON',
+        'instant_bookable': rng.choice(['t', 'f'], n_listings,
+                                       p=[0.15, 0.85]),
+        'cancellation_policy': rng.choice(CANCELLATION_POLICIES, n_listings),
+        'require_guest_profile_picture': 'f',
+        'require_guest_phone_verification': 'f',
+        'calculated_host_listings_count': rng.randint(1, 4, n_listings),
+        'reviews_per_month': np.where(has_reviews,
+                                      np.round(rng.rand(n_listings) * 5, 2),
+                                      np.nan),
+    })
+    return listings
+
+
+def synthetic_calendar(listings, rng, block_listings=BLOCK_LISTINGS):
+    """
+    Generates the raw calendar, grouped by listing as in the raw files. The
+    prices follow the listing price, with a yearly season and higher prices
+    on weekends; they are missing when the listing is not available, and
+    about 5% of the listings are never available.
+
+    Args:
+        listings (pandas.DataFrame): The raw listings.
+        rng (numpy.random.RandomState): The random generator.
+        block_listings (int): The number of listings in each block.
+    Returns:
+        generator(pandas.DataFrame): The calendar, in blocks.
+    """
+    days = pd.date_range(START_DATE, periods=N_DAYS)
+    day_factor = (1 + 0.15 * np.sin(2 * np.pi * days.dayofyear.values /
+                                    365.25)) * \
+        np.where(days.dayofweek >= 4, 1.1, 1.0)
+    day_text = days.strftime('%Y-%m-%d').values
+    base_price = listings.price.str[1:].str.replace(',', '').astype(float)
+
+    for start in range(0, listings.shape[0], block_listings):
+        ids = listings.id.values[start:start + block_listings]
+        base = base_price.values[start:start + block_listings]
+        n = ids.size
+        availability = rng.rand(n) * (rng.rand(n) > 0.05)
+        available = rng.rand(n, N_DAYS) < availability[:, None]
+        prices = np.round(base[:, None] * day_factor[None, :] *
+                          (1 + 0.05 * rng.randn(n, N_DAYS)))
+        price = np.where(available.ravel(), format_price(prices.ravel()),
+                         None)
+        yield pd.DataFrame({'listing_id': np.repeat(ids, N_DAYS),
+                            'date': np.tile(day_text, n),
+                            'available': np.where(available.ravel(), 't',
+                                                  'f'),
+                            'price': price})
+
+
+def synthetic_reviews(listings, n_reviews, rng,
+                      block_listings=BLOCK_LISTINGS):
+    """
+    Generates the raw reviews, for the listings that have reviews.
+
+    Args:
+        listings (pandas.DataFrame): The raw listings.
+        n_reviews (int): The number of reviews.
+        rng (numpy.random.RandomState): The random generator.
+        block_listings (int): The reviews are generated for this many
+            listings at a time.
+    Returns:
+        generator(pandas.DataFrame): The reviews, in blocks.
+    """
+    weights = listings.number_of_reviews.values.astype(float)
+    counts = rng.multinomial(n_reviews, weights / weights.sum())
+    review_ids = 0
+    for start in range(0, listings.shape[0], block_listings):
+        block = listings.iloc[start:start + block_listings]
+        block_counts = counts[start:start + block_listings]
+        n = block_counts.sum()
+        first = pd.to_datetime(np.repeat(block.first_review.fillna(
+            START_DATE).values, block_counts))
+        last = pd.to_datetime(np.repeat(block.last_review.fillna(
+            START_DATE).values, block_counts))
+        date = first + (last - first) * rng.rand(n)
+        yield pd.DataFrame({
+            'listing_id': np.repeat(block.id.values, block_counts),
+            'id': np.arange(review_ids, review_ids + n) + 1,
+            'date': date.strftime('%Y-%m-%d'),
+            'reviewer_id': rng.randint(1, 5 * 10 ** 7, n),
+            'reviewer_name': rng.choice(['Ann', 'Bob', 'Carla', 'Dan', 'Eve',
+                                         'Frank'], n),
+            'comments': with_missing(random_text(n, 50, rng), 0.0002, rng),
+        })
+        review_ids += n
+
+
+def format_price(values):
+    """ Formats numbers as raw prices, like '$1,250.00'. """
+    dollars = pd.Series(np.asarray(values, dtype=np.int64)).astype(str)
+    thousands = dollars.str.len() > 3
+    dollars[thousands] = dollars[thousands].str[:-3] + ',' + \
+        dollars[thousands].str[-3:]
+    return ('$' + dollars + '.00').values
+
+
+def format_percent(values):
+    """ Formats numbers as raw percentages, like '96%'. """
+    return (pd.Series(values).astype(str) + '%').values
+
+
+def random_text(n, max_words, rng):
+    """ Random texts of 1 to max_words words. """
+    lengths = rng.randint(1, max_words + 1, n)
+    words = WORDS[rng.randint(0, len(WORDS), lengths.sum())]
+    ends = np.cumsum(lengths)
+    return np.array([' '.join(words[end - length:end])
+                     for end, length in zip(ends, lengths)], dtype=object)
+
+
+def with_missing(values, frac, rng):
+    """ Replaces a random fraction of the values with NaN. """
+    values = np.array(values, dtype=object)
+    values[rng.rand(values.size) < frac] = np.nan
+    return values
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
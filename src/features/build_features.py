@@ -0,0 +1,497 @@
+# -*- coding: utf-8 -*-
+"""
+The features of the listings, built from the processed data of each city:
+    - listing_features: the seasonality, weekday and occupancy features of
+      each listing, computed from the processed calendar in one vectorized
+      pass (with group codes and numpy.bincount, instead of a loop over the
+      listings).
+    - MultiHotEncoder: a sparse multi-hot encoding of the LIST_COLS (the
+      amenities and the host verifications).
+    - ListingsFeaturizer: builds the model matrix of the listings (see
+      src.features.feature_matrix), with dense numeric, date and category
+      features and the sparse multi-hot features.
+    - load_feature_matrix: loads the model matrix, building it only if the
+      processed listings or the code changed.
+'main' creates all of them for the processed cities, and assigns the
+listings to the neighbourhoods of the city map, if there is one (see
+src.geo.create_listing_neighbourhoods).
+"""
+
+import click
+import logging
+import os
+import pickle
+import sys
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+import src.data.preprocessing as pp
+import src.features.feature_matrix as fm
+import src.utils as utils
+import src.geo as geo
+from src.data import cache
+from src.data import storage
+from src.data import DATA_PROCESSED, feature_matrix_dir, featurizer_path, \
+    listings_cols_path, neighbourhoods_map_path, table_path
+
+# The number of days of the rolling statistics
+ROLLING_WINDOW = 7
+
+# The nights before a weekend day are the most expensive ones (Friday and
+# Saturday; Monday is 0).
+WEEKEND_DAYS = [4, 5]
+
+CALENDAR_COLS = ['listing_id', 'date', 'available', 'price']
+
+# The listings columns that contain lists, like '{TV,"Cable TV"}' or
+# "['email', 'phone']"
+LIST_COLS = ['amenities', 'host_verifications']
+
+# Identifiers, and dates that are the same for all the listings
+NON_FEATURE_COLS = ['id', 'scrape_id', 'host_id', 'last_scraped',
+                    'calendar_last_scraped']
+
+
+@click.command()
+@click.option('--city', 'cities', multiple=True,
+              help='A city to process (can be repeated). All the cities in '
+                   'the processed data folder are processed by default.')
+@click.option('--no-cache', is_flag=True,
+              help='Compute the features again, without using the stage '
+                   'cache.')
+def main(cities, no_cache):
+    """
+    Creates the listing features, the model matrix and the listing
+    neighbourhoods (if the city has a neighbourhoods map) of the processed
+    cities.
+    """
+    logger = logging.getLogger(__name__)
+    for city in cities or find_cities_with_calendar():
+        logger.info('Creating the listing features of {}'.format(city))
+        create_listing_features(city, use_cache=not no_cache)
+        logger.info('Creating the model matrix of {}'.format(city))
+        load_feature_matrix(city, use_cache=not no_cache)
+        map_path = neighbourhoods_map_path(city)
+        if os.path.exists(map_path):
+            logger.info('Assigning the listings of {} to the '
+                        'neighbourhoods of {}'.format(city, map_path))
+            geo.create_listing_neighbourhoods(city, map_path,
+                                              use_cache=not no_cache)
+        else:
+            logger.info('There is no neighbourhoods map of {} ({})'.format(
+                city, map_path))
+
+
+def find_cities_with_calendar(data_dir=DATA_PROCESSED):
+    """ The cities that have a processed calendar. """
+    return sorted(city for city in os.listdir(data_dir)
+                  if os.path.exists(table_path(data_dir, city, 'calendar')))
+
+
+def create_listing_features(city='seattle', data_dir=DATA_PROCESSED,
+                            use_cache=True):
+    """
+    Computes the features of the listings of a city, and saves them to the
+    'listing_features' table of the city. The features are kept in the stage
+    cache, keyed by the contents of the processed calendar and the code of
+    this module, so they are only computed again when one of them changes.
+
+    Args:
+        city (str): The city.
+        data_dir (str): The directory of the processed data.
+        use_cache (bool): Whether to use the stage cache.
+    Returns:
+        pandas.DataFrame: The features, indexed by listing_id.
+    """
+    calendar_path = table_path(data_dir, city, 'calendar')
+
+    def build():
+        calendar = storage.load_table(calendar_path, columns=CALENDAR_COLS)
+        return (listing_features(calendar),)
+
+    if use_cache:
+        stages = [('listing_features', build, [sys.modules[__name__]],
+                   {'city': city})]
+        features, = cache.run_pipeline(stages,
+                                       utils.table_fingerprints(calendar_path))
+    else:
+        features, = build()
+    storage.save_table(features.reset_index(),
+                       table_path(data_dir, city, 'listing_features'))
+    return features
+
+
+def load_listing_features(city='seattle', data_dir=DATA_PROCESSED):
+    """ Loads the features saved by create_listing_features. """
+    return storage.load_table(table_path(
+        data_dir, city, 'listing_features')).set_index('listing_id')
+
+
+def listing_features(calendar):
+    """
+    Computes the features of all the listings of a calendar. The rolling
+    statistics use the last ROLLING_WINDOW rows of each listing (one per
+    day); the premiums and indexes are relative to the mean price of the
+    listing, and the missing prices are ignored.
+
+    Args:
+        calendar (pandas.DataFrame): A processed calendar, with the
+            CALENDAR_COLS columns.
+    Returns:
+        pandas.DataFrame: One row per listing_id, with the columns:
+            mean_price, std_price: The statistics of the price.
+            rolling_std: The standard deviation of the rolling mean price,
+                relative to the mean price.
+            weekly_deviation: The mean absolute deviation of the price from
+                its rolling mean, relative to the rolling mean.
+            weekday_<d>_premium: The relative difference between the mean
+                price of the weekday d (Monday is 0) and the mean price.
+            weekend_premium: The relative difference between the mean price
+                of the WEEKEND_DAYS and of the other days.
+            month_<m>_index: The mean price of the month m (January is 1),
+                relative to the mean price.
+            occupancy_rate, weekend_occupancy_rate: The fraction of the days
+                (or the WEEKEND_DAYS) that are not available.
+    """
+    calendar = calendar[CALENDAR_COLS].sort_values(['listing_id', 'date'],
+                                                   kind='stable')
+    ids, listing_ids = pd.factorize(calendar.listing_id.values, sort=True)
+    n_listings = len(listing_ids)
+    price = calendar.price.values.astype(np.float64)
+    dates = pd.DatetimeIndex(calendar.date.values)
+    weekday = dates.weekday.values
+    month = dates.month.values - 1
+    is_weekend = np.isin(weekday, WEEKEND_DAYS)
+    booked = 1 - calendar.available.astype(float).values
+
+    features = pd.DataFrame(index=pd.Index(listing_ids, name='listing_id'))
+    mean_price = _group_mean(ids, price, n_listings)
+    features['mean_price'] = mean_price
+    features['std_price'] = _group_std(ids, price, n_listings)
+
+    rolling_mean = _rolling_mean(ids, price, ROLLING_WINDOW)
+    features['rolling_std'] = _group_std(
+        ids, rolling_mean, n_listings) / mean_price
+    features['weekly_deviation'] = _group_mean(
+        ids, np.abs(price / rolling_mean - 1), n_listings)
+
+    weekday_means = _group_mean(ids * 7 + weekday, price, n_listings * 7)
+    premiums = weekday_means.reshape(-1, 7) / mean_price[:, None] - 1
+    for day in range(7):
+        features['weekday_{}_premium'.format(day)] = premiums[:, day]
+    weekend_means = _group_mean(ids * 2 + is_weekend, price, n_listings * 2)
+    weekend_means = weekend_means.reshape(-1, 2)
+    features['weekend_premium'] = weekend_means[:, 1] / weekend_means[:, 0] - 1
+
+    month_means = _group_mean(ids * 12 + month, price, n_listings * 12)
+    indexes = month_means.reshape(-1, 12) / mean_price[:, None]
+    for m in range(12):
+        features['month_{}_index'.format(m + 1)] = indexes[:, m]
+
+    features['occupancy_rate'] = _group_mean(ids, booked, n_listings)
+    features['weekend_occupancy_rate'] = _group_mean(
+        ids[is_weekend], booked[is_weekend], n_listings)
+    return features.astype(np.float32)
+
+
+def _group_mean(codes, values, n_groups):
+    """
+    The mean of the values of each group (NaN if the group has no values).
+    """
+    is_valid = ~np.isnan(values)
+    sums = np.bincount(codes[is_valid], values[is_valid], minlength=n_groups)
+    counts = np.bincount(codes[is_valid], minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+def _group_std(codes, values, n_groups):
+    """ The standard deviation (ddof=1) of the values of each group. """
+    is_valid = ~np.isnan(values)
+    codes, values = codes[is_valid], values[is_valid]
+    counts = np.bincount(codes, minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.bincount(codes, values, minlength=n_groups) / counts
+        squares = np.bincount(codes, (values - means[codes]) ** 2,
+                              minlength=n_groups)
+        return np.sqrt(squares / (counts - 1))
+
+
+def _rolling_mean(ids, values, window):
+    """
+    The mean of the last 'window' values of each row, within its group (the
+    rows are sorted by group). It is NaN for the first rows of each group,
+    and for the windows with missing values.
+    """
+    is_valid = ~np.isnan(values)
+    sums = np.concatenate([[0], np.cumsum(np.where(is_valid, values, 0))])
+    counts = np.concatenate([[0], np.cumsum(is_valid)])
+    end = np.arange(1, len(values) + 1)
+    start = np.maximum(end - window, 0)
+    full = ((end - np.searchsorted(ids, ids) >= window) &
+            (counts[end] - counts[start] == window))
+    return np.where(full, (sums[end] - sums[start]) / window, np.nan)
+
+
+def split_list_strings(series):
+    """
+    Splits strings that represent lists or sets, like '{TV,"Cable TV"}' or
+    "['email', 'phone']", into their items (without quotes), in bulk.
+
+    Args:
+        series (pandas.Series): The strings (NaN for missing lists).
+    Returns:
+        pandas.Series: One item per row, indexed by the position of its
+            string in the series.
+    """
+    items = pd.Series(series.values, dtype=object).str.strip('{}[]').str.split(
+        ',').explode()
+    items = items.str.strip(' "\'')
+    return items[items.notnull() & (items != '')]
+
+
+class MultiHotEncoder(object):
+    """
+    Encodes a column of list-like strings (see split_list_strings) as a
+    sparse multi-hot matrix: one column per item of the vocabulary, with 1
+    in the rows whose list contains it. 'fit' learns the vocabulary, and
+    'transform' encodes any batch of listings with it (the unknown items are
+    ignored). Each distinct string is split only once.
+
+    Attributes:
+        name (str): The prefix of the feature names (the name of the column).
+        min_count (int): The minimum number of rows of an item to be in the
+            vocabulary.
+        vocabulary (pandas.Index): The sorted items.
+    """
+
+    def __init__(self, name='', min_count=1):
+        self.name = name
+        self.min_count = min_count
+        self.vocabulary = None
+
+    def fit(self, series):
+        """ Learns the vocabulary of a column. """
+        codes, uniques = pd.factorize(series)
+        items = split_list_strings(pd.Series(uniques))
+        rows = np.bincount(codes[codes >= 0], minlength=len(uniques))
+        counts = pd.Series(rows[items.index.values]).groupby(
+            items.values).sum()
+        self.vocabulary = pd.Index(
+            sorted(counts.index[counts >= self.min_count]))
+        return self
+
+    def transform(self, series, dtype=np.int8):
+        """
+        Encodes a column.
+
+        Args:
+            series (pandas.Series): The list-like strings.
+            dtype (numpy.dtype): The dtype of the matrix.
+        Returns:
+            scipy.sparse.csr_matrix: A (row x item) matrix, with the columns
+                of feature_names.
+        """
+        if self.vocabulary is None:
+            raise ValueError('The encoder is not fitted.')
+        codes, uniques = pd.factorize(series)
+        items = split_list_strings(pd.Series(uniques))
+        columns = self.vocabulary.get_indexer(items.values)
+        known = columns >= 0
+        # The last row is empty, for the missing values.
+        unique_matrix = sparse.csr_matrix(
+            (np.ones(known.sum(), dtype=dtype),
+             (items.index.values[known], columns[known])),
+            shape=(len(uniques) + 1, len(self.vocabulary)))
+        unique_matrix.sum_duplicates()
+        unique_matrix.data[:] = 1
+        return unique_matrix[np.where(codes >= 0, codes, len(uniques))]
+
+    def fit_transform(self, series, dtype=np.int8):
+        """ Learns the vocabulary and encodes a column. """
+        return self.fit(series).transform(series, dtype)
+
+    @property
+    def feature_names(self):
+        """ The names of the columns of the encoded matrices. """
+        return ['{}_{}'.format(self.name, item) for item in self.vocabulary]
+
+
+def fit_list_encoders(listings, min_count=1):
+    """ Fits a MultiHotEncoder for each of the LIST_COLS of the listings. """
+    return {col: MultiHotEncoder(col, min_count).fit(listings[col])
+            for col in LIST_COLS}
+
+
+def list_features(listings, encoders, dtype=np.int8):
+    """
+    Encodes the LIST_COLS of some listings with fitted encoders.
+
+    Returns:
+        scipy.sparse.csr_matrix: The multi-hot features of all the columns.
+        list(str): The names of the features.
+    """
+    matrix = sparse.hstack([encoders[col].transform(listings[col], dtype)
+                            for col in LIST_COLS], format='csr')
+    names = [name for col in LIST_COLS
+             for name in encoders[col].feature_names]
+    return matrix, names
+
+
+class ListingsFeaturizer(object):
+    """
+    Builds the model matrix of the processed listings, from the kind of
+    each column (see schema). 'fit' learns which columns are features, the
+    categories, the date origin and the vocabularies of the LIST_COLS;
+    'transform' builds the matrix of any batch of listings with them.
+
+    The dense features are the numeric, price, percent and true/false
+    columns (and the '<column>_missing' indicators), the dates (in days
+    since the earliest date of the fitted listings) and the category codes
+    of the categorical, location and time columns. The constant columns,
+    and the categorical columns with a different value in each listing, are
+    left out. The LIST_COLS are sparse multi-hot features.
+
+    Attributes:
+        listings_cols_df (pandas.DataFrame): The 'kind' of each column.
+        numeric_cols (list(str)): The numeric features.
+        date_cols (list(str)): The date features.
+        date_origin (pandas.Timestamp): The date that is day 0.
+        categories (dict): The sorted categories of each categorical
+            feature (the unknown categories are missing values).
+        list_encoders (dict): The MultiHotEncoder of each of the LIST_COLS.
+    """
+
+    def __init__(self, listings_cols_df):
+        self.listings_cols_df = listings_cols_df
+        self.numeric_cols = None
+        self.date_cols = None
+        self.date_origin = None
+        self.categories = None
+        self.list_encoders = None
+
+    def fit(self, listings):
+        """ Learns the features of the processed listings. """
+        numeric = self._columns(
+            listings, ['num_cols', 'price_cols', 'percent_cols', 'tf_cols'])
+        numeric += [col for col in listings.columns
+                    if col.endswith('_missing')]
+        categorical = self._columns(
+            listings, ['categorical_simple_cols', 'location_cols',
+                       'time_cols'])
+        n_unique = listings[numeric + categorical].nunique()
+        self.numeric_cols = [col for col in numeric if n_unique[col] > 1]
+        self.categories = {
+            col: sorted(listings[col].dropna().astype(str).unique())
+            for col in categorical if 1 < n_unique[col] < len(listings)}
+        self.date_cols = self._columns(listings, ['date_cols'])
+        self.date_origin = listings[self.date_cols].min().min()
+        self.list_encoders = fit_list_encoders(listings)
+        return self
+
+    def _columns(self, listings, kinds):
+        """ The feature columns of some kinds. """
+        return [col for kind in kinds
+                for col in pp.get_column_by_kind(self.listings_cols_df, kind)
+                if col in listings.columns and col not in NON_FEATURE_COLS]
+
+    @property
+    def dense_names(self):
+        """ The names of the dense features. """
+        return self.numeric_cols + self.date_cols + list(self.categories)
+
+    def transform(self, listings):
+        """
+        Builds the model matrix of some processed listings.
+
+        Returns:
+            feature_matrix.FeatureMatrix: The features.
+        """
+        if self.numeric_cols is None:
+            raise ValueError('The featurizer is not fitted.')
+        dense = np.empty((len(listings), len(self.dense_names)),
+                         dtype=np.float32)
+        i = 0
+        for col in self.numeric_cols:
+            dense[:, i] = listings[col].to_numpy(dtype=np.float32,
+                                                 na_value=np.nan)
+            i += 1
+        for col in self.date_cols:
+            dense[:, i] = (listings[col] - self.date_origin) / pd.Timedelta(
+                days=1)
+            i += 1
+        for col, categories in self.categories.items():
+            codes = pd.Categorical(listings[col].astype(str).where(
+                listings[col].notnull()), categories=categories).codes
+            dense[:, i] = np.where(codes >= 0, codes, np.nan)
+            i += 1
+        sparse_matrix, sparse_names = list_features(listings,
+                                                    self.list_encoders)
+        return fm.FeatureMatrix(dense, sparse_matrix, self.dense_names,
+                                sparse_names, list(self.categories),
+                                listings.id.values)
+
+    def fit_transform(self, listings):
+        """ Fits the featurizer and builds the matrix of the listings. """
+        return self.fit(listings).transform(listings)
+
+    def save(self, path):
+        """ Saves the featurizer with pickle. """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'wb') as featurizer_file:
+            pickle.dump(self, featurizer_file)
+
+    @staticmethod
+    def load(path):
+        """ Loads a featurizer that was saved with 'save'. """
+        with open(path, 'rb') as featurizer_file:
+            return pickle.load(featurizer_file)
+
+
+def load_feature_matrix(city='seattle', data_dir=DATA_PROCESSED,
+                        use_cache=True, memory_map=True):
+    """
+    Loads the model matrix of the processed listings of a city, building it
+    (and fitting the featurizer) only if the processed listings, the column
+    kinds or the code changed since it was saved.
+
+    Args:
+        city (str): The city.
+        data_dir (str): The directory of the processed data.
+        use_cache (bool): Whether to load the saved matrix when it is fresh.
+        memory_map (bool): Whether to memory-map the saved matrix.
+    Returns:
+        feature_matrix.FeatureMatrix: The features of the listings.
+    """
+    logger = logging.getLogger(__name__)
+    listings_path = table_path(data_dir, city, 'listings')
+    fingerprint = {
+        'listings': utils.table_fingerprints(listings_path),
+        'listings_cols': utils.file_fingerprint(listings_cols_path(city)),
+        'code': [cache.source_fingerprint(module)
+                 for module in [sys.modules[__name__], fm, pp]],
+    }
+    matrix_dir = feature_matrix_dir(city)
+    if use_cache and os.path.exists(featurizer_path(city)):
+        matrix = fm.load_if_fresh(matrix_dir, fingerprint, memory_map)
+        if matrix is not None:
+            logger.info('Loading the saved model matrix')
+            return matrix
+
+    listings = storage.load_table(listings_path)
+    featurizer = ListingsFeaturizer(pd.read_pickle(listings_cols_path(city)))
+    matrix = featurizer.fit_transform(listings)
+    featurizer.save(featurizer_path(city))
+    matrix.save(matrix_dir, fingerprint)
+    return fm.FeatureMatrix.load(matrix_dir, memory_map)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    # Run the importable module, so that the featurizer is pickled as
+    # src.features.build_features.ListingsFeaturizer (and not as a class of
+    # __main__, that other processes can't load).
+    from src.features import build_features
+    build_features.main()
@@ -0,0 +1,144 @@
+"""
+The model matrix of the listings: a dense block of numeric features and a
+sparse block of multi-hot features, stored as numpy files that are loaded
+memory-mapped.
+"""
+
+import json
+import os
+import shutil
+import uuid
+import numpy as np
+import scipy.sparse as sparse
+
+ARRAY_FILES = {
+    'dense': 'dense.npy',
+    'data': 'sparse_data.npy',
+    'indices': 'sparse_indices.npy',
+    'indptr': 'sparse_indptr.npy',
+    'listing_ids': 'listing_ids.npy',
+}
+META_FILE = 'meta.json'
+
+
+class FeatureMatrix(object):
+    """
+    The features of some listings.
+
+    Attributes:
+        dense (numpy.ndarray): The (listing x feature) float32 dense features
+            (NaN where missing).
+        sparse (scipy.sparse.csr_matrix): The (listing x feature) sparse
+            features.
+        dense_names (list(str)): The names of the dense features.
+        sparse_names (list(str)): The names of the sparse features.
+        categorical (list(str)): The dense features that are category codes.
+        listing_ids (numpy.ndarray): The listing of each row.
+    """
+
+    def __init__(self, dense, sparse_matrix, dense_names, sparse_names,
+                 categorical, listing_ids):
+        self.dense = dense
+        self.sparse = sparse_matrix
+        self.dense_names = list(dense_names)
+        self.sparse_names = list(sparse_names)
+        self.categorical = list(categorical)
+        self.listing_ids = listing_ids
+
+    @property
+    def names(self):
+        """ The names of all the features (dense first). """
+        return self.dense_names + self.sparse_names
+
+    @property
+    def shape(self):
+        return self.dense.shape[0], len(self.names)
+
+    def column(self, name):
+        """ The values of a dense feature. """
+        return self.dense[:, self.dense_names.index(name)]
+
+    def to_csr(self, drop=()):
+        """
+        All the features as one sparse matrix (the missing values of the
+        dense features are kept as explicit NaNs).
+
+        Args:
+            drop (list(str)): The dense features to leave out.
+        Returns:
+            scipy.sparse.csr_matrix: The features.
+            list(str): Their names.
+        """
+        kept = [i for i, name in enumerate(self.dense_names)
+                if name not in drop]
+        matrix = sparse.hstack([sparse.csr_matrix(self.dense[:, kept]),
+                                self.sparse.astype(np.float32)],
+                               format='csr')
+        return matrix, [self.dense_names[i] for i in kept] + self.sparse_names
+
+    def save(self, path, fingerprint=None):
+        """
+        Saves the matrix to a directory. It is written to a temporary
+        directory first, so that an interrupted run doesn't leave an
+        incomplete matrix.
+
+        Args:
+            path (str): The directory.
+            fingerprint: A JSON-serializable fingerprint of the data that the
+                matrix was built from (see load_if_fresh).
+        """
+        temp_path = os.path.join(os.path.dirname(os.path.abspath(path)),
+                                 'tmp-' + uuid.uuid4().hex)
+        os.makedirs(temp_path)
+        arrays = {'dense': self.dense, 'data': self.sparse.data,
+                  'indices': self.sparse.indices,
+                  'indptr': self.sparse.indptr,
+                  'listing_ids': np.asarray(self.listing_ids)}
+        for name, file_name in ARRAY_FILES.items():
+            np.save(os.path.join(temp_path, file_name), arrays[name])
+        meta = {'dense_names': self.dense_names,
+                'sparse_names': self.sparse_names,
+                'categorical': self.categorical,
+                'fingerprint': fingerprint}
+        with open(os.path.join(temp_path, META_FILE), 'w') as meta_file:
+            json.dump(meta, meta_file)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(temp_path, path)
+
+    @staticmethod
+    def load(path, memory_map=True):
+        """ Loads a matrix saved with 'save' (memory-mapped by default). """
+        mmap_mode = 'r' if memory_map else None
+        arrays = {name: np.load(os.path.join(path, file_name),
+                                mmap_mode=mmap_mode)
+                  for name, file_name in ARRAY_FILES.items()}
+        meta = load_meta(path)
+        sparse_matrix = sparse.csr_matrix(
+            (arrays['data'], arrays['indices'], arrays['indptr']),
+            shape=(arrays['dense'].shape[0], len(meta['sparse_names'])),
+            copy=False)
+        return FeatureMatrix(arrays['dense'], sparse_matrix,
+                             meta['dense_names'], meta['sparse_names'],
+                             meta['categorical'], arrays['listing_ids'])
+
+
+def load_meta(path):
+    """ The names and fingerprint of a saved matrix. """
+    with open(os.path.join(path, META_FILE)) as meta_file:
+        return json.load(meta_file)
+
+
+def load_if_fresh(path, fingerprint, memory_map=True):
+    """
+    Loads a saved matrix if it was built from data with the given
+    fingerprint.
+
+    Returns:
+        FeatureMatrix: The matrix, or None if it doesn't exist or it is
+            stale.
+    """
+    if not os.path.exists(os.path.join(path, META_FILE)):
+        return None
+    if load_meta(path)['fingerprint'] != fingerprint:
+        return None
+    return FeatureMatrix.load(path, memory_map)
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Text features of the review comments (length, language, sentiment and
+keywords), extracted from the raw reviews in chunks by a pool of processes,
+and aggregated per listing.
+"""
+
+import click
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import pandas as pd
+from src.data import storage
+from src.data import DATA_PROCESSED, DATA_RAW, find_cities, table_path
+
+CHUNKSIZE = 20000
+
+# The most frequent words of each language, to guess the language of a
+# comment (the language with most of them).
+STOPWORDS = {
+    'en': ['the', 'and', 'was', 'is', 'with', 'for', 'very', 'we', 'to'],
+    'fr': ['le', 'la', 'et', 'est', 'tres', 'très', 'nous', 'avec', 'pour'],
+    'es': ['el', 'la', 'y', 'es', 'muy', 'con', 'para', 'que', 'fue'],
+    'de': ['die', 'der', 'und', 'ist', 'sehr', 'wir', 'mit', 'für', 'war'],
+}
+
+# A small sentiment lexicon: the score of a comment is the number of
+# positive words minus the number of negative words, per word.
+POSITIVE_WORDS = ['great', 'lovely', 'clean', 'comfortable', 'cozy',
+                  'friendly', 'easy', 'recommend', 'perfect', 'beautiful',
+                  'wonderful', 'amazing', 'nice', 'quiet', 'helpful',
+                  'excellent', 'spacious', 'welcoming']
+NEGATIVE_WORDS = ['dirty', 'noisy', 'noise', 'loud', 'small', 'cold',
+                  'uncomfortable', 'smell', 'broken', 'bad', 'disappointed',
+                  'rude', 'problem', 'issue', 'cancelled', 'canceled']
+
+# The keywords that are counted, as regular expressions
+KEYWORDS = {
+    'clean': r'clean',
+    'location': r'location|neighbo|walk',
+    'host': r'host',
+    'kitchen': r'kitchen',
+    'view': r'view',
+    'noise': r'nois|loud',
+    'recommend': r'recommend',
+}
+
+# The columns of chunk_sums
+SUM_COLS = (['length', 'words', 'sentiment'] +
+            [keyword + '_count' for keyword in KEYWORDS] +
+            ['lang_' + lang for lang in STOPWORDS] + ['n_reviews'])
+
+SENTIMENT = pd.Series(
+    dict([(word, 1) for word in POSITIVE_WORDS] +
+         [(word, -1) for word in NEGATIVE_WORDS]), dtype=np.int8)
+LANGUAGE_OF_WORD = pd.Series(
+    {word: lang for lang, words in reversed(list(STOPWORDS.items()))
+     for word in words})
+
+
+@click.command()
+@click.argument('raw_dir', type=click.Path(exists=True), required=False)
+@click.option('--city', 'cities', multiple=True,
+              help='A city to process (can be repeated). All the cities in '
+                   'the raw data folder are processed by default.')
+@click.option('--chunksize', type=int, default=CHUNKSIZE,
+              help='The number of reviews of each chunk.')
+@click.option('--workers', type=int, default=None,
+              help='The number of processes (one per CPU by default).')
+def main(raw_dir, cities, chunksize, workers):
+    """ Creates the review features of the raw cities. """
+    logger = logging.getLogger(__name__)
+    raw_dir = raw_dir or DATA_RAW
+    for city in cities or find_cities(raw_dir):
+        logger.info('Creating the review features of {}'.format(city))
+        create_review_features(raw_dir, city, chunksize, workers)
+
+
+def create_review_features(raw_dir=DATA_RAW, city='seattle',
+                           chunksize=CHUNKSIZE, n_workers=None):
+    """
+    Streams the raw reviews of a city in chunks, extracts the features of
+    each comment in a pool of processes, and saves their aggregates per
+    listing as the 'review_features' table of the city (see
+    aggregate_features). Only n_workers chunks are processed at the same
+    time, and the aggregates have one row per listing, so the memory
+    doesn't grow with the size of the file.
+
+    Args:
+        raw_dir (str): The directory that contains one folder per city.
+        city (str): The city.
+        chunksize (int): The number of reviews of each chunk.
+        n_workers (int): The number of processes (one per CPU by default).
+            With one worker the chunks are processed in this process.
+    Returns:
+        pandas.DataFrame: The review features, indexed by listing_id.
+    """
+    logger = logging.getLogger(__name__)
+    start = time.time()
+    n_workers = n_workers or os.cpu_count()
+    chunks = pd.read_csv(os.path.join(raw_dir, city, 'reviews.csv'),
+                         usecols=['listing_id', 'comments'],
+                         chunksize=chunksize)
+    if n_workers == 1:
+        sums = add_sums(chunk_sums(chunk) for chunk in chunks)
+    else:
+        sums = add_sums(_sums_in_pool(chunks, n_workers))
+    features = aggregate_features(sums)
+    storage.save_table(features.reset_index(),
+                       table_path(DATA_PROCESSED, city, 'review_features'))
+    logger.info('Extracted the features of {} reviews in {:.1f}s'.format(
+        int(sums.n_reviews.sum()), time.time() - start))
+    return features
+
+
+def _sums_in_pool(chunks, n_workers):
+    """
+    Yields the chunk_sums of the chunks, computed in a process pool, with at
+    most n_workers chunks read and not yet processed.
+    """
+    with ProcessPoolExecutor(n_workers) as executor:
+        running = set()
+        for chunk in chunks:
+            if len(running) >= n_workers:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            running.add(executor.submit(chunk_sums, chunk))
+        for future in running:
+            yield future.result()
+
+
+def add_sums(sums):
+    """
+    Adds the chunk_sums of many chunks, one at a time (without chunks, the
+    sums of no reviews: an empty table with the SUM_COLS).
+    """
+    total = None
+    for chunk in sums:
+        total = chunk if total is None else total.add(chunk, fill_value=0)
+    if total is None:
+        total = pd.DataFrame(columns=SUM_COLS, dtype=np.int64)
+    return total
+
+
+def comment_features(comments):
+    """
+    Extracts the features of some comments, with vectorized string methods.
+
+    Args:
+        comments (pandas.Series): The comments (without missing values).
+    Returns:
+        pandas.DataFrame: The 'length' (in characters), 'words', 'sentiment'
+            and 'language' (or '' if unknown) of each comment, and the
+            number of matches of each of the KEYWORDS ('<keyword>_count').
+    """
+    comments = comments.astype(str).str.lower()
+    words = comments.str.findall(r"[^\W\d_]+").explode()
+    words = words[words.notnull()]
+    features = pd.DataFrame({'length': comments.str.len(),
+                             'words': words.groupby(level=0).size()},
+                            index=comments.index).fillna(0)
+    features['sentiment'] = words.map(SENTIMENT).groupby(level=0).sum()
+    features['sentiment'] = (features.sentiment.fillna(0) /
+                             features.words.clip(lower=1))
+    languages = words.map(LANGUAGE_OF_WORD).dropna()
+    language = pd.Series(dtype=object)
+    if len(languages) > 0:
+        language = pd.crosstab(languages.index, languages.values).idxmax(
+            axis=1)
+    features['language'] = language.reindex(comments.index).fillna('')
+    for keyword, pattern in KEYWORDS.items():
+        features[keyword + '_count'] = comments.str.count(pattern)
+    return features
+
+
+def chunk_sums(reviews):
+    """
+    The sums of the features of the reviews of a chunk, per listing_id: the
+    'n_reviews', the sums of the numeric comment_features, and the number of
+    comments of each language ('lang_<language>').
+    """
+    reviews = reviews.dropna(subset=['comments'])
+    features = comment_features(reviews.comments)
+    languages = pd.get_dummies(features.pop('language')).reindex(
+        columns=list(STOPWORDS), fill_value=0).add_prefix('lang_')
+    features = features.join(languages.astype(int))
+    features['n_reviews'] = 1
+    return features.groupby(reviews.listing_id.values).sum()[SUM_COLS]
+
+
+def aggregate_features(sums):
+    """
+    The review features of each listing, from the sums of its reviews: the
+    number of reviews, the mean of each numeric feature, and the fraction of
+    the comments in each language.
+
+    Returns:
+        pandas.DataFrame: The compact features, indexed by listing_id.
+    """
+    n_reviews = sums.n_reviews
+    features = sums.drop('n_reviews', axis=1).div(n_reviews, axis=0)
+    features = features.rename(columns={'length': 'mean_length',
+                                        'words': 'mean_words',
+                                        'sentiment': 'mean_sentiment'})
+    features.insert(0, 'n_reviews', n_reviews.astype(np.int32))
+    features.index.name = 'listing_id'
+    return features.astype({col: np.float32 for col in features.columns
+                            if col != 'n_reviews'}).sort_index()
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
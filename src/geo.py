@@ -0,0 +1,213 @@
+"""
+Assigns the listings to the neighbourhood polygons of a GeoJSON map, by
+their coordinates, with a grid index over the polygons and a vectorized
+point-in-polygon test (numpy only, without the geo environment).
+"""
+
+import json
+import sys
+import numpy as np
+import pandas as pd
+import src.utils as utils
+from src.data import cache
+from src.data import storage
+from src.data import DATA_PROCESSED, neighbourhoods_map_path, table_path
+
+# The maximum number of (point, edge) pairs that are tested at once
+MAX_PAIRS = 10 ** 7
+
+
+def load_polygons(path):
+    """
+    Reads the (multi)polygons of a GeoJSON file.
+
+    Args:
+        path (str): The path of a GeoJSON FeatureCollection.
+    Returns:
+        list(list(numpy.ndarray)): The rings of each polygon, as (point x 2)
+            arrays of (longitude, latitude). The parts and holes of a
+            polygon are all rings of it.
+        pandas.DataFrame: The properties of each polygon.
+    """
+    with open(path) as map_file:
+        features = json.load(map_file)['features']
+    polygons = list()
+    for feature in features:
+        geometry = feature['geometry']
+        if geometry['type'] == 'Polygon':
+            parts = [geometry['coordinates']]
+        elif geometry['type'] == 'MultiPolygon':
+            parts = geometry['coordinates']
+        else:
+            raise ValueError('Unsupported geometry: {}'.format(
+                geometry['type']))
+        polygons.append([np.asarray(ring, dtype=np.float64)[:, :2]
+                         for part in parts for ring in part])
+    properties = pd.DataFrame([feature.get('properties') or dict()
+                               for feature in features])
+    return polygons, properties
+
+
+class PolygonIndex(object):
+    """
+    A uniform grid over the bounding box of some polygons. Each cell keeps
+    the polygons whose bounding boxes overlap it, so that a point is only
+    tested against the polygons of its cell. The test is the even-odd rule
+    over all the edges of a polygon, vectorized over the points.
+
+    Attributes:
+        edges (list(numpy.ndarray)): The (edge x 4) x1, y1, x2, y2 of each
+            polygon.
+        origin (numpy.ndarray): The lower left corner of the grid.
+        cell_size (numpy.ndarray): The width and height of the cells.
+        shape (tuple): The number of cells in x and y.
+        cell_starts (numpy.ndarray): The start of the polygons of each cell
+            (flattened, with one more item at the end) in cell_polygons.
+        cell_polygons (numpy.ndarray): The polygons of the cells.
+    """
+
+    def __init__(self, polygons, cells_per_polygon=4):
+        self.edges = [np.vstack([np.hstack([ring[:-1], ring[1:]])
+                                 for ring in _closed(rings)])
+                      for rings in polygons]
+        boxes = np.array([[e[:, [0, 2]].min(), e[:, [1, 3]].min(),
+                           e[:, [0, 2]].max(), e[:, [1, 3]].max()]
+                          for e in self.edges])
+        self.origin = boxes[:, :2].min(axis=0)
+        extent = np.maximum(boxes[:, 2:].max(axis=0) - self.origin, 1e-12)
+        n_side = max(1, int(np.ceil(np.sqrt(
+            cells_per_polygon * len(polygons)))))
+        self.shape = (n_side, n_side)
+        self.cell_size = extent / n_side
+
+        first = self._cells(boxes[:, :2])
+        last = self._cells(boxes[:, 2:])
+        pairs = [(x * n_side + y, polygon)
+                 for polygon in range(len(polygons))
+                 for x in range(first[polygon, 0], last[polygon, 0] + 1)
+                 for y in range(first[polygon, 1], last[polygon, 1] + 1)]
+        cells, cell_polygons = np.array(pairs, dtype=np.int64).T
+        order = np.argsort(cells, kind='stable')
+        self.cell_polygons = cell_polygons[order]
+        self.cell_starts = np.searchsorted(cells[order],
+                                           np.arange(n_side * n_side + 1))
+
+    def _cells(self, points):
+        """ The (x, y) cell of each point (clipped to the grid). """
+        cells = np.floor((points - self.origin) / self.cell_size)
+        return np.clip(cells, 0, np.array(self.shape) - 1).astype(np.int64)
+
+    def query(self, x, y):
+        """
+        Finds the polygon that contains each point.
+
+        Args:
+            x (array-like): The longitudes.
+            y (array-like): The latitudes.
+        Returns:
+            numpy.ndarray: The index of the polygon of each point (the first
+                one, if they overlap), or -1.
+        """
+        points = np.column_stack([x, y]).astype(np.float64)
+        result = np.full(len(points), -1, dtype=np.int64)
+        valid = np.flatnonzero(~np.isnan(points).any(axis=1))
+        cells = self._cells(points[valid])
+        cells = cells[:, 0] * self.shape[1] + cells[:, 1]
+        counts = self.cell_starts[cells + 1] - self.cell_starts[cells]
+        candidates = np.repeat(valid, counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) -
+                                                      counts, counts)
+        polygons = self.cell_polygons[np.repeat(self.cell_starts[cells],
+                                                counts) + offsets]
+        order = np.argsort(polygons, kind='stable')
+        candidates, polygons = candidates[order], polygons[order]
+        bounds = np.searchsorted(polygons, np.arange(len(self.edges) + 1))
+        for polygon in reversed(range(len(self.edges))):
+            rows = candidates[bounds[polygon]:bounds[polygon + 1]]
+            inside = self._contains(polygon, points[rows])
+            result[rows[inside]] = polygon
+        return result
+
+    def _contains(self, polygon, points):
+        """ Whether each point is inside a polygon (the even-odd rule). """
+        edges = self.edges[polygon]
+        inside = np.zeros(len(points), dtype=bool)
+        block = max(1, MAX_PAIRS // len(edges))
+        for start in range(0, len(points), block):
+            px = points[start:start + block, :1]
+            py = points[start:start + block, 1:]
+            x1, y1, x2, y2 = edges.T
+            crosses = (y1 > py) != (y2 > py)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x_cross = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+            inside[start:start + block] = (
+                (crosses & (px < x_cross)).sum(axis=1) % 2 == 1)
+        return inside
+
+
+def _closed(rings):
+    """ The rings, with the first point repeated at the end if needed. """
+    return [ring if np.array_equal(ring[0], ring[-1])
+            else np.vstack([ring, ring[:1]]) for ring in rings]
+
+
+def assign_neighbourhoods(listings, map_path):
+    """
+    Finds the neighbourhood polygon of each listing, by its latitude and
+    longitude.
+
+    Args:
+        listings (pandas.DataFrame): Listings with 'id', 'latitude' and
+            'longitude'.
+        map_path (str): The GeoJSON map of the neighbourhoods.
+    Returns:
+        pandas.DataFrame: The 'id', the 'polygon' (its position in the map,
+            or -1) and the properties of the polygon of each listing.
+    """
+    polygons, properties = load_polygons(map_path)
+    index = PolygonIndex(polygons)
+    polygon = index.query(listings.longitude.values,
+                          listings.latitude.values)
+    assigned = properties.reindex(polygon).reset_index(drop=True)
+    assigned.insert(0, 'polygon', polygon.astype(np.int32))
+    assigned.insert(0, 'id', listings.id.values)
+    return assigned
+
+
+def create_listing_neighbourhoods(city='seattle', map_path=None,
+                                  data_dir=DATA_PROCESSED, use_cache=True):
+    """
+    Assigns the processed listings of a city to the neighbourhoods of a map,
+    and saves the result as the 'listing_neighbourhoods' table of the city.
+    The assignment is kept in the stage cache, keyed by the contents of the
+    processed listings and the map, and the code of this module.
+
+    Args:
+        city (str): The city.
+        map_path (str): The GeoJSON map (see neighbourhoods_map_path by
+            default).
+        data_dir (str): The directory of the processed data.
+        use_cache (bool): Whether to use the stage cache.
+    Returns:
+        pandas.DataFrame: The neighbourhood of each listing (see
+            assign_neighbourhoods).
+    """
+    map_path = map_path or neighbourhoods_map_path(city)
+    listings_path = table_path(data_dir, city, 'listings')
+
+    def assign():
+        listings = storage.load_table(
+            listings_path, columns=['id', 'latitude', 'longitude'])
+        return (assign_neighbourhoods(listings, map_path),)
+
+    if use_cache:
+        stages = [('listing_neighbourhoods', assign, [sys.modules[__name__]],
+                   {'city': city})]
+        inputs = utils.table_fingerprints(listings_path) + [
+            utils.file_fingerprint(map_path)]
+        assigned, = cache.run_pipeline(stages, inputs)
+    else:
+        assigned, = assign()
+    storage.save_table(assigned, table_path(data_dir, city,
+                                            'listing_neighbourhoods'))
+    return assigned
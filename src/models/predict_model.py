@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+"""
+Scores listings with the trained review score models (see train_model),
+from the command line over a processed table, or from a local HTTP
+endpoint that groups concurrent requests into micro-batches.
+"""
+
+import click
+import collections
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+from src.data import storage
+from src.data import DATA_PROCESSED, featurizer_path, table_path
+from src.features.build_features import ListingsFeaturizer
+from src.models.train_model import SCORE_PREFIX, TARGET, load_boosters
+
+BATCH_SIZE = 10000
+
+# A micro-batch is scored when it has this many listings, or when its first
+# request has waited MAX_WAIT seconds.
+MAX_BATCH_SIZE = 256
+MAX_WAIT = 0.005
+
+# The number of latencies kept for the statistics
+LATENCY_WINDOW = 10000
+
+
+@click.group()
+def main():
+    """ Scores listings with the review score models. """
+
+
+@main.command()
+@click.option('--city', default='seattle', help='The city of the models.')
+@click.option('--target', default=TARGET, help='The review score.')
+@click.option('--input', 'input_path', type=click.Path(exists=True),
+              default=None,
+              help='A table of processed listings (the processed listings '
+                   'of the city by default).')
+@click.option('--output', 'output_path', type=click.Path(), default=None,
+              help='Where to save the scores (data/processed/<city>/'
+                   '<target>_scores by default).')
+@click.option('--batch-size', type=int, default=BATCH_SIZE,
+              help='The number of listings scored at once.')
+def score(city, target, input_path, output_path, batch_size):
+    """ Scores a table of processed listings. """
+    logger = logging.getLogger(__name__)
+    scorer = Scorer(city, target)
+    listings = storage.load_table(
+        input_path or table_path(DATA_PROCESSED, city, 'listings'))
+    scores, stats = score_table(scorer, listings, batch_size)
+    storage.save_table(scores, output_path or table_path(
+        DATA_PROCESSED, city, target + '_scores'))
+    logger.info('Scored {} listings: {}'.format(len(scores), stats))
+
+
+@main.command()
+@click.option('--city', default='seattle', help='The city of the models.')
+@click.option('--target', default=TARGET, help='The review score.')
+@click.option('--host', default='127.0.0.1', help='The address to listen.')
+@click.option('--port', type=int, default=8000, help='The port to listen.')
+@click.option('--max-batch-size', type=int, default=MAX_BATCH_SIZE,
+              help='The maximum number of listings in a micro-batch.')
+@click.option('--max-wait', type=float, default=MAX_WAIT,
+              help='The maximum time (in seconds) that a request waits for '
+                   'others to join its micro-batch.')
+def serve(city, target, host, port, max_batch_size, max_wait):
+    """
+    Serves the scores on http://<host>:<port>/score (POST a JSON list of
+    processed listings). GET /stats returns the latency and throughput.
+    """
+    logger = logging.getLogger(__name__)
+    batcher = MicroBatcher(Scorer(city, target), max_batch_size, max_wait)
+    server = make_server(batcher, host, port)
+    logger.info('Serving on http://{}:{}'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+
+class Scorer(object):
+    """
+    The models of a review score, loaded once: the fitted featurizer and the
+    boosters of the folds. The score of a listing is the mean prediction of
+    the boosters.
+
+    Attributes:
+        featurizer (build_features.ListingsFeaturizer): The featurizer that
+            built the training matrix.
+        boosters (list(lightgbm.Booster)): The boosters of the folds.
+        drop (list(str)): The dense features that are not model features
+            (the review scores).
+    """
+
+    def __init__(self, city='seattle', target=TARGET, num_threads=0):
+        self.featurizer = ListingsFeaturizer.load(featurizer_path(city))
+        self.boosters = load_boosters(city, target)
+        self.drop = [name for name in self.featurizer.dense_names
+                     if name.startswith(SCORE_PREFIX)]
+        self.num_threads = num_threads
+        n_features = len(self.featurizer.dense_names) - len(self.drop) + \
+            sum(len(encoder.vocabulary)
+                for encoder in self.featurizer.list_encoders.values())
+        if any(booster.num_feature() != n_features
+               for booster in self.boosters):
+            raise ValueError('The models were not trained with the features '
+                             'of the saved featurizer.')
+
+    def score(self, listings):
+        """
+        Scores a batch of processed listings.
+
+        Returns:
+            numpy.ndarray: The score of each listing.
+        """
+        if len(listings) == 0:
+            return np.empty(0)
+        X, _ = self.featurizer.transform(listings).to_csr(drop=self.drop)
+        return np.mean([booster.predict(X, num_threads=self.num_threads)
+                        for booster in self.boosters], axis=0)
+
+    def frame(self, records):
+        """ The processed listings of some JSON records (see validate). """
+        return self.validate(pd.DataFrame.from_records(records))
+
+    def validate(self, listings):
+        """
+        Checks that some processed listings have the columns of the features,
+        and converts the numeric and date columns (a value that can't be
+        converted, like a price of 'n/a', raises a ValueError).
+
+        Returns:
+            pandas.DataFrame: The converted listings.
+        """
+        featurizer = self.featurizer
+        columns = (['id'] + featurizer.numeric_cols + featurizer.date_cols +
+                   list(featurizer.categories) + list(
+                       featurizer.list_encoders))
+        missing = [col for col in columns if col not in listings.columns]
+        if missing:
+            raise ValueError('Missing columns: {}'.format(missing))
+        listings = listings.copy()
+        for col in featurizer.numeric_cols:
+            if not pd.api.types.is_numeric_dtype(listings[col]):
+                try:
+                    listings[col] = pd.to_numeric(listings[col])
+                except (TypeError, ValueError):
+                    raise ValueError('The column {} is not numeric'.format(
+                        col))
+        for col in featurizer.date_cols:
+            if not pd.api.types.is_datetime64_any_dtype(listings[col]):
+                listings[col] = pd.to_datetime(listings[col])
+        return listings
+
+
+def score_table(scorer, listings, batch_size=BATCH_SIZE):
+    """
+    Scores a table of listings in batches.
+
+    Returns:
+        pandas.DataFrame: The 'id' and 'score' of each listing.
+        dict: The latency of the batches and the throughput (see
+            LatencyStats).
+    """
+    stats = LatencyStats()
+    scores = list()
+    for start in range(0, len(listings), batch_size):
+        batch = listings.iloc[start:start + batch_size]
+        batch_start = time.perf_counter()
+        scores.append(scorer.score(batch))
+        stats.add(time.perf_counter() - batch_start, len(batch))
+    return (pd.DataFrame({'id': listings.id.values,
+                          'score': np.concatenate(scores or [[]])}),
+            stats.summary())
+
+
+class LatencyStats(object):
+    """
+    The latencies of the last LATENCY_WINDOW requests (or batches), and the
+    number of listings scored since the start. It can be shared by threads.
+    """
+
+    def __init__(self):
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.n_requests = 0
+        self.n_listings = 0
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def add(self, latency, n_listings):
+        """ Records a request of n_listings that took 'latency' seconds. """
+        with self.lock:
+            self.latencies.append(latency)
+            self.n_requests += 1
+            self.n_listings += n_listings
+
+    def summary(self):
+        """ The p50 and p99 latencies (in ms), and the listings/second. """
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            elapsed = time.perf_counter() - self.start
+            n_requests, n_listings = self.n_requests, self.n_listings
+        p50, p99 = (np.percentile(latencies, [50, 99]).tolist()
+                    if len(latencies) else (None, None))
+        return {'requests': n_requests, 'listings': n_listings,
+                'p50_ms': p50, 'p99_ms': p99,
+                'listings_per_s': n_listings / elapsed}
+
+
+class MicroBatcher(object):
+    """
+    Groups the listings of concurrent requests into micro-batches, that are
+    scored at once by a background thread: a batch is scored when it has
+    max_batch_size listings, or when its first request has waited max_wait
+    seconds.
+
+    Attributes:
+        scorer (Scorer): The models.
+        max_batch_size (int): The maximum number of listings of a batch (a
+            larger request is scored alone).
+        max_wait (float): The maximum wait for other requests, in seconds.
+        stats (LatencyStats): The latencies of the requests.
+    """
+
+    def __init__(self, scorer, max_batch_size=MAX_BATCH_SIZE,
+                 max_wait=MAX_WAIT):
+        self.scorer = scorer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stats = LatencyStats()
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, listings, validate=True):
+        """
+        Scores a request of processed listings (from any thread), waiting for
+        its micro-batch. The listings are validated first (see
+        Scorer.validate), so that an invalid request fails alone.
+
+        Args:
+            listings (pandas.DataFrame): The processed listings.
+            validate (bool): Whether to validate the listings (False if they
+                were already validated, like by Scorer.frame).
+        Returns:
+            numpy.ndarray: The scores of the listings.
+        """
+        start = time.perf_counter()
+        if validate:
+            listings = self.scorer.validate(listings)
+        future = Future()
+        self.requests.put((listings, future))
+        scores = future.result()
+        self.stats.add(time.perf_counter() - start, len(listings))
+        return scores
+
+    def close(self):
+        """ Stops the background thread. """
+        self.requests.put(None)
+        self.thread.join()
+
+    def _run(self):
+        """ Collects and scores the micro-batches, until close. """
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            batch = [request]
+            size = len(request[0])
+            deadline = time.perf_counter() + self.max_wait
+            while size < self.max_batch_size:
+                try:
+                    request = self.requests.get(
+                        timeout=max(0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                if request is None:
+                    self.requests.put(None)
+                    break
+                batch.append(request)
+                size += len(request[0])
+            self._score(batch)
+
+    def _score(self, batch):
+        """
+        Scores a micro-batch, and sets the results of its requests. If the
+        batch fails, its requests are scored one by one, so that only the
+        ones that fail get the error.
+        """
+        try:
+            scores = self.scorer.score(pd.concat(
+                [listings for listings, _ in batch], ignore_index=True,
+                sort=False))
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+            else:
+                for request in batch:
+                    self._score([request])
+            return
+        ends = np.cumsum([len(listings) for listings, _ in batch])
+        for (listings, future), end in zip(batch, ends):
+            future.set_result(scores[end - len(listings):end])
+
+
+def make_server(batcher, host='127.0.0.1', port=8000):
+    """
+    An HTTP server of the scores: POST /score with a JSON list of processed
+    listings returns {"scores": [...]}; GET /stats returns the latency and
+    throughput of the requests (see ScoreHandler).
+    """
+    server = ThreadingHTTPServer((host, port), ScoreHandler)
+    server.batcher = batcher
+    return server
+
+
+class ScoreHandler(BaseHTTPRequestHandler):
+    """
+    The requests of the server of make_server, scored by its 'batcher'. An
+    invalid request (bad JSON, or listings that don't pass Scorer.validate)
+    gets a 400 error, and a failure of the scoring a 500 error.
+    """
+
+    def do_POST(self):
+        if self.path != '/score':
+            return self._reply(404, {'error': 'Not found'})
+        batcher = self.server.batcher
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            listings = batcher.scorer.frame(json.loads(self.rfile.read(
+                length)))
+        except (TypeError, ValueError) as e:
+            return self._reply(400, {'error': repr(e)})
+        try:
+            scores = batcher.submit(listings, validate=False)
+        except Exception as e:
+            logging.getLogger(__name__).exception('Scoring failed')
+            return self._reply(500, {'error': repr(e)})
+        self._reply(200, {'scores': scores.tolist()})
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self._reply(404, {'error': 'Not found'})
+        self._reply(200, self.server.batcher.stats.summary())
+
+    def _reply(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug(format, *args)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Functions to train the models of the review scores of the listings, on the
+model matrix of the listings (see build_features). Each model is a LightGBM
+cross-validation: one booster per fold, trained in parallel.
+"""
+
+import click
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import src.features.feature_matrix as fm
+from src.data import DATA_INTERIM, DATA_PROCESSED, feature_matrix_dir, \
+    model_dir, table_path
+from src.data import storage
+from src.features.build_features import find_cities_with_calendar, \
+    load_feature_matrix
+from src.profiling import peak_rss_mb
+
+TARGET = 'review_scores_rating'
+
+# The review scores are targets, not features
+SCORE_PREFIX = 'review_scores_'
+
+N_FOLDS = 5
+
+PARAMS = {
+    'objective': 'regression',
+    'learning_rate': 0.05,
+    'num_leaves': 31,
+    'min_data_in_leaf': 20,
+    'feature_fraction': 0.8,
+    'verbosity': -1,
+}
+
+# The parameters that determine the binned Dataset
+DATASET_PARAMS = {'max_bin': 255, 'verbosity': -1}
+
+MAX_BOOST_ROUNDS = 2000
+EARLY_STOPPING_ROUNDS = 50
+
+CV_REPORT = 'cv_report.json'
+FOLD_FILE = re.compile(r'fold_(\d+)\.txt$')
+
+
+@click.command()
+@click.option('--city', 'cities', multiple=True,
+              help='A city to train (can be repeated). All the cities in '
+                   'the processed data folder are trained by default.')
+@click.option('--target', 'targets', multiple=True,
+              help='A review score to predict (can be repeated; {} by '
+                   'default).'.format(TARGET))
+@click.option('--folds', type=int, default=N_FOLDS,
+              help='The number of cross-validation folds.')
+@click.option('--workers', type=int, default=None,
+              help='The number of folds trained at the same time (one per '
+                   'CPU, up to the number of folds, by default).')
+def main(cities, targets, folds, workers):
+    """ Trains the review score models of the processed cities. """
+    logger = logging.getLogger(__name__)
+    for city in cities or find_cities_with_calendar():
+        for target in targets or [TARGET]:
+            logger.info('Training {} of {}'.format(target, city))
+            report = train_cv(city, target, folds, workers)
+            logger.info('Folds:\n{}'.format(report.to_string()))
+
+
+def training_data(city='seattle', target=TARGET):
+    """
+    The features and the target of the listings that have the target (the
+    imputed targets are left out, see target_mask). None of the review
+    scores (or their missing indicators) are features.
+
+    Args:
+        city (str): The city.
+        target (str): The review score to predict.
+    Returns:
+        scipy.sparse.csr_matrix: The features.
+        numpy.ndarray: The target.
+        list(str): The names of the features.
+    """
+    matrix = load_feature_matrix(city)
+    y = np.array(matrix.column(target))
+    has_target = target_mask(city, target, matrix.listing_ids)
+    X, names = matrix.to_csr(drop=[name for name in matrix.dense_names
+                                   if name.startswith(SCORE_PREFIX)])
+    return X[has_target], y[has_target], names
+
+
+def target_mask(city, target, listing_ids):
+    """
+    Whether each listing had the target before the imputation, from its
+    '<target>_missing' indicator in the processed listings. The imputer
+    fills the missing review scores, so they are not NaN in the model
+    matrix, and the indicator is not a feature when it is constant.
+
+    Args:
+        city (str): The city.
+        target (str): The review score to predict.
+        listing_ids (numpy.ndarray): The listings.
+    Returns:
+        numpy.ndarray: A boolean mask of the listings.
+    """
+    indicator = target + '_missing'
+    listings = storage.load_table(table_path(DATA_PROCESSED, city,
+                                             'listings'),
+                                  columns=['id', indicator])
+    missing = listings.set_index('id')[indicator].reindex(listing_ids)
+    return (missing == 0).values
+
+
+def lgb_name(name):
+    """ A feature name that LightGBM accepts (no spaces or punctuation). """
+    return re.sub('[^0-9a-zA-Z_]', '_', name)
+
+
+def dataset_path(city='seattle', target=TARGET):
+    """
+    The path of the LightGBM binary Dataset of a target, named after the
+    fingerprint of the model matrix (it is built if needed).
+    """
+    load_feature_matrix(city)
+    content = {'matrix': fm.load_meta(feature_matrix_dir(city))[
+                   'fingerprint'],
+               'target': target,
+               'params': DATASET_PARAMS}
+    key = hashlib.sha1(json.dumps(content, sort_keys=True).encode())
+    return os.path.join(DATA_INTERIM, city, 'lgb_{}_{}.bin'.format(
+        target, key.hexdigest()[:12]))
+
+
+def create_lgb_dataset(city='seattle', target=TARGET, data=None):
+    """
+    Saves the training data of a target as a LightGBM binary Dataset (with
+    the features already binned), unless it is already saved. The Datasets
+    of older versions of the model matrix are removed.
+
+    Args:
+        city (str): The city.
+        target (str): The review score to predict.
+        data (tuple): The training data (see training_data), if it was
+            already computed.
+    Returns:
+        str: The path of the Dataset.
+    """
+    import lightgbm as lgb
+    path = dataset_path(city, target)
+    if os.path.exists(path):
+        return path
+    X, y, names = data or training_data(city, target)
+    categorical = fm.load_meta(feature_matrix_dir(city))['categorical']
+    dataset = lgb.Dataset(X, y, feature_name=[lgb_name(n) for n in names],
+                          categorical_feature=[lgb_name(n) for n in names
+                                               if n in categorical],
+                          params=DATASET_PARAMS)
+    prefix = 'lgb_{}_'.format(target)
+    for name in os.listdir(os.path.dirname(path)):
+        if name.startswith(prefix) and name.endswith('.bin'):
+            os.remove(os.path.join(os.path.dirname(path), name))
+    temp_path = path + '.tmp'
+    dataset.save_binary(temp_path)
+    os.replace(temp_path, path)
+    return path
+
+
+def cv_folds(n_rows, n_folds=N_FOLDS, seed=0):
+    """ The (train, validation) row indexes of each fold. """
+    rows = np.random.RandomState(seed).permutation(n_rows)
+    folds = np.array_split(rows, n_folds)
+    return [(np.sort(np.concatenate(folds[:i] + folds[i + 1:])),
+             np.sort(folds[i])) for i in range(n_folds)]
+
+
+def train_cv(city='seattle', target=TARGET, n_folds=N_FOLDS, n_workers=None,
+             params_override=None, seed=0):
+    """
+    Trains a LightGBM booster per cross-validation fold, with early stopping
+    on the validation fold. The folds are trained in parallel processes,
+    and the CPUs are shared among them (each booster uses
+    cpu_count // n_workers threads), so that they are not oversubscribed.
+    The boosters are saved to the model directory of the target, with a
+    report of the validation error, time and peak memory of each fold.
+
+    Args:
+        city (str): The city.
+        target (str): The review score to predict.
+        n_folds (int): The number of folds.
+        n_workers (int): The number of processes (one per CPU, up to the
+            number of folds, by default). With one worker the folds are
+            trained in this process.
+        params_override (dict): LightGBM parameters that replace the
+            defaults (PARAMS, the seed and the number of threads).
+        seed (int): The seed of the folds and the boosters.
+    Returns:
+        pandas.DataFrame: The report of each fold.
+    """
+    start = time.time()
+    data = training_data(city, target)
+    path = create_lgb_dataset(city, target, data)
+    n_rows = len(data[1])
+    n_workers = n_workers or min(n_folds, os.cpu_count())
+    params = dict(PARAMS, seed=seed,
+                  num_threads=max(1, os.cpu_count() // n_workers))
+    params.update(params_override or dict())
+    out_dir = model_dir(city, target)
+    os.makedirs(out_dir, exist_ok=True)
+    for name in os.listdir(out_dir):
+        if FOLD_FILE.match(name):
+            os.remove(os.path.join(out_dir, name))
+    tasks = [(path, train_rows, valid_rows, params,
+              os.path.join(out_dir, 'fold_{}.txt'.format(fold)))
+             for fold, (train_rows, valid_rows)
+             in enumerate(cv_folds(n_rows, n_folds, seed))]
+
+    if n_workers == 1:
+        results = [_train_fold(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(n_workers, max_tasks_per_child=1) as pool:
+            results = list(pool.map(_train_fold, *zip(*tasks)))
+
+    report = pd.DataFrame(results)
+    report.index.name = 'fold'
+    summary = {'city': city, 'target': target, 'params': params,
+               'n_workers': n_workers, 'wall_s': time.time() - start,
+               'valid_rmse': report.valid_rmse.mean(),
+               'folds': report.reset_index().to_dict(orient='records')}
+    with open(os.path.join(out_dir, CV_REPORT), 'w') as report_file:
+        json.dump(summary, report_file, indent=2)
+    return report
+
+
+def _train_fold(path, train_rows, valid_rows, params, model_path):
+    """
+    Trains and saves the booster of a fold, and returns its validation error,
+    number of rounds, time and peak memory (of the process, that only trains
+    this fold when it runs in the pool).
+    """
+    import lightgbm as lgb
+    start = time.time()
+    cpu_start = time.process_time()
+    dataset = lgb.Dataset(path, params=DATASET_PARAMS)
+    train = dataset.subset(train_rows)
+    valid = dataset.subset(valid_rows)
+    booster = lgb.train(params, train, MAX_BOOST_ROUNDS, valid_sets=[valid],
+                        callbacks=[lgb.early_stopping(EARLY_STOPPING_ROUNDS,
+                                                      verbose=False)])
+    booster.save_model(model_path, num_iteration=booster.best_iteration)
+    return {'valid_rmse': np.sqrt(booster.best_score['valid_0']['l2']),
+            'rounds': booster.best_iteration,
+            'wall_s': time.time() - start,
+            'cpu_s': time.process_time() - cpu_start,
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def load_boosters(city='seattle', target=TARGET):
+    """ Loads the boosters of the folds of a target. """
+    import lightgbm as lgb
+    out_dir = model_dir(city, target)
+    names = sorted((name for name in os.listdir(out_dir)
+                    if FOLD_FILE.match(name)),
+                   key=lambda name: int(FOLD_FILE.match(name).group(1)))
+    return [lgb.Booster(model_file=os.path.join(out_dir, name))
+            for name in names]
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
@@ -0,0 +1,186 @@
+""" Timing and memory instrumentation for the steps of the data pipeline. """
+
+from contextlib import contextmanager
+import json
+import logging
+import os
+import time
+import tracemalloc
+import pandas as pd
+from src.utils import decorator
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# The records of the profiled calls, while profiling is enabled (None when
+# it is disabled).
+_RECORDS = None
+
+# The peak traced memory of the profiled calls that are running.
+_PEAKS = list()
+
+
+@decorator
+def profiled(fun):
+    """
+    The decorated function records its wall time, CPU time, peak memory and
+    input/output row counts while profiling is enabled (see 'profiling').
+    When it is disabled, the only cost is one check per call.
+    """
+
+    def profiled_fun(*args, **kwargs):
+        if _RECORDS is None:
+            return fun(*args, **kwargs)
+        return _run_profiled(fun, args, kwargs)
+
+    return profiled_fun
+
+
+def profiled_call(step, fun, *args, **kwargs):
+    """
+    Calls a function and, while profiling is enabled, records it as 'step'.
+    It profiles the calls that can't be decorated, like the loads of the
+    stages from the stage cache (see cache.run_pipeline).
+    """
+    if _RECORDS is None:
+        return fun(*args, **kwargs)
+    return _run_profiled(fun, args, kwargs, step)
+
+
+@contextmanager
+def profiling(report_path=None, log_summary=True):
+    """
+    Enables the profiling of the decorated functions in the block. At the
+    end, the summary is logged and, if report_path is given, saved as JSON.
+    Tracing the memory allocations makes the code slower, so the times are
+    only comparable between profiled runs.
+
+    Args:
+        report_path (str): Where to save the JSON report.
+        log_summary (bool): Whether to log the summary.
+    Yields:
+        list(dict): The records of the profiled calls (see summary).
+    """
+    global _RECORDS
+    records = list()
+    _RECORDS = records
+    tracemalloc.start()
+    start = time.time()
+    try:
+        yield records
+    finally:
+        tracemalloc.stop()
+        _RECORDS = None
+        del _PEAKS[:]
+        table = summary(records)
+        if not records:
+            logging.getLogger(__name__).warning(
+                'No profiled step ran, the profile is empty')
+        if log_summary:
+            logging.getLogger(__name__).info(
+                'Profile:\n{}'.format(table.to_string()))
+        if report_path is not None:
+            save_report(table, report_path, time.time() - start)
+
+
+def _run_profiled(fun, args, kwargs, step=None):
+    """
+    Calls a function and records its resource usage, as 'step' (by default,
+    the module and name of the function).
+    """
+    start_memory, peak = tracemalloc.get_traced_memory()
+    if _PEAKS:
+        _PEAKS[-1] = max(_PEAKS[-1], peak)
+    _reset_peak()
+    _PEAKS.append(start_memory)
+    depth = len(_PEAKS) - 1
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    result = None
+    try:
+        result = fun(*args, **kwargs)
+        return result
+    finally:
+        wall = time.perf_counter() - start_wall
+        cpu = time.process_time() - start_cpu
+        peak = max(_PEAKS.pop(), tracemalloc.get_traced_memory()[1])
+        if _PEAKS:
+            _PEAKS[-1] = max(_PEAKS[-1], peak)
+        _RECORDS.append({
+            'step': step or '{}.{}'.format(fun.__module__, fun.__name__),
+            'depth': depth,
+            'wall_s': wall,
+            'cpu_s': cpu,
+            'peak_alloc_mb': (peak - start_memory) / 2 ** 20,
+            'peak_rss_mb': peak_rss_mb(),
+            'rows_in': _count_rows(args + tuple(kwargs.values())),
+            'rows_out': _count_rows(result),
+        })
+
+
+def _reset_peak():
+    """ Resets the peak of the traced memory (Python 3.9+). """
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+
+
+def _count_rows(values):
+    """
+    The rows of the first dataframe or series in a value or tuple (the main
+    table of the step, like the listings in the 'fill_*' functions).
+    """
+    if isinstance(values, (pd.DataFrame, pd.Series)):
+        return values.shape[0]
+    if isinstance(values, (tuple, list)):
+        for value in values:
+            if isinstance(value, (pd.DataFrame, pd.Series)):
+                return value.shape[0]
+    return None
+
+
+def peak_rss_mb():
+    """ The peak resident memory of the process, in MB (None if unknown). """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def summary(records):
+    """
+    Aggregates the records by step, in the order in which the steps first
+    finish (so the nested steps come before the steps that call them).
+
+    Args:
+        records (list(dict)): The records of the profiled calls.
+    Returns:
+        pandas.DataFrame: The calls, total times, maximum peaks and total
+            rows (of the main table) of each step.
+    """
+    columns = ['calls', 'wall_s', 'cpu_s', 'peak_alloc_mb', 'peak_rss_mb',
+               'rows_in', 'rows_out']
+    if not records:
+        return pd.DataFrame(columns=columns)
+    df = pd.DataFrame(records)
+    df['calls'] = 1
+    steps = df.groupby('step', sort=False)
+    table = steps[['calls', 'wall_s', 'cpu_s', 'rows_in', 'rows_out']].sum()
+    table['peak_alloc_mb'] = steps.peak_alloc_mb.max()
+    table['peak_rss_mb'] = steps.peak_rss_mb.max()
+    # Indent the nested steps
+    depth = steps.depth.min()
+    table.index = ['  ' * d + step for step, d in depth.items()]
+    return table[columns].round(3)
+
+
+def save_report(table, path, total_s):
+    """ Saves the summary of a profiled run as JSON. """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    steps = table.reset_index().rename(columns={'index': 'step'})
+    steps.step = steps.step.str.strip()
+    report = {'total_s': total_s,
+              'peak_rss_mb': peak_rss_mb(),
+              'steps': steps.to_dict(orient='records')}
+    with open(path, 'w') as report_file:
+        json.dump(report, report_file, indent=2, default=float)
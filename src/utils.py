@@ -1,9 +1,19 @@
 """ General utility functions. """
 
 from functools import update_wrapper
+import hashlib
+import os
+import warnings
+import numpy as np
 import pandas as pd
 import scipy.cluster.hierarchy as sch
 
+# The memory (in bytes) that cluster_corr uses for the pairwise distances
+CORR_MAX_MEMORY = 2 ** 30
+
+# Each pair of series has a float64 distance, and linkage makes a copy
+BYTES_PER_DISTANCE = 8
+
 
 def decorator(d):
     """
@@ -23,6 +33,8 @@ def pandify(scalar_fun):
     """
     The decorated function applies the scalar function to all values
     and accepts Series and DataFrames.
+    It calls a Python function per cell, so it should only be used as a
+    fallback for functions that cannot be vectorized (see 'columnwise').
     Args:
         scalar_fun(function): a scalar function
     Returns:
@@ -40,6 +52,49 @@ def pandify(scalar_fun):
     return df_fun
 
 
+@decorator
+def columnwise(series_fun):
+    """
+    The decorated function applies a vectorized Series function to a Series,
+    or to each column of a DataFrame.
+    Args:
+        series_fun(function): a function that takes and returns a Series
+    Returns:
+        df_fun(function): a matrix/vector function for pandas DFs and Series
+    """
+
+    def df_fun(df):
+        if isinstance(df, pd.Series):
+            return series_fun(df)
+        elif isinstance(df, pd.DataFrame):
+            return df.apply(series_fun)
+        else:
+            return None
+
+    return df_fun
+
+
+def file_fingerprint(path, block_size=2 ** 20):
+    """ The SHA-1 hash of the contents of a file (read in blocks). """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def table_fingerprints(path):
+    """
+    The fingerprints of the files of a table (a file, or a directory of
+    chunks).
+    """
+    if os.path.isfile(path):
+        return [file_fingerprint(path)]
+    return [file_fingerprint(os.path.join(root, name))
+            for root, _, names in sorted(os.walk(path))
+            for name in sorted(names)]
+
+
 def show_data(data):
     print('The data has shape: {}\n'.format(data.shape))
     print('There is {} missing data!\n'.format(data.isnull().sum().sum()))
@@ -63,17 +118,282 @@ def common_values(series1, series2):
     print('Total: {}'.format(len(total)))
 
 
-def cluster_corr(ts):
+def cluster_corr(ts, max_memory=CORR_MAX_MEMORY, n_components=None,
+                 sample_size=None, seed=0):
     """
-    Clusters the time series according to their correlation.
+    Clusters the time series according to their correlation: the rows of the
+    correlation matrix (ts.corr().fillna(0), computed with pairwise_corr)
+    are clustered with complete linkage, cut at half of the largest
+    distance.
     Part of the code was taken from here:
     https://github.com/TheLoneNut/CorrelationMatrixClustering/blob/master/
     CorrelationMatrixClustering.ipynb
+    Only the rows of a sample of the series are kept in memory: if their
+    rows and pairwise distances don't fit in max_memory, the sample is
+    random, and the other series are assigned to the cluster of the closest
+    series of the sample (their rows are computed in blocks).
+
+    Args:
+        ts (pandas.DataFrame): One time series per column (like the result
+            of missing_data.get_ts).
+        max_memory (int): The memory for the rows of the sample and their
+            distances, in bytes.
+        n_components (int): If given, the rows are projected on this number
+            of principal axes (those of the rows of the sample), which is
+            faster, but approximate.
+        sample_size (int): The number of series to link (all of them, if
+            their rows and distances fit in max_memory, by default).
+        seed (int): The seed of the random sample.
+    Returns:
+        pandas.DataFrame: The time series, with the columns sorted by
+            cluster.
+        numpy.ndarray: The cluster of each column of ts.
+    """
+    n_series = ts.shape[1]
+    if sample_size is None:
+        sample_size = int(min(np.sqrt(max_memory / BYTES_PER_DISTANCE),
+                              max_memory / (4 * max(n_series, 1))))
+    if n_series <= sample_size:
+        sample = np.arange(n_series)
+    else:
+        sample = np.sort(np.random.RandomState(seed).choice(
+            n_series, sample_size, replace=False))
+
+    def corr_rows(rows):
+        for _, corr, _ in iter_corr_rows(ts, rows, dtype=np.float32,
+                                         max_memory=max_memory):
+            yield np.nan_to_num(corr)
+
+    points = np.vstack(list(corr_rows(sample)))
+    axes = None
+    if n_components is not None:
+        axes = np.linalg.svd(points - points.mean(axis=0),
+                             full_matrices=False)[2][:n_components].T
+        points = points @ axes
+    if len(sample) < 2:
+        ind = np.ones(len(sample), dtype=np.int32)
+    else:
+        d = sch.distance.pdist(points)
+        L = sch.linkage(d, method='complete')
+        ind = sch.fcluster(L, 0.5 * d.max(), 'distance')
+    if len(sample) < n_series:
+        ind = ind[np.concatenate([
+            closest(rows if axes is None else rows @ axes, points,
+                    max_memory)
+            for rows in corr_rows(None)])]
+    columns = ts.columns[np.argsort(ind, kind='stable')]
+    return ts.reindex(columns=columns), ind
+
+
+def pairwise_corr(ts, method='pearson', min_periods=1, dtype=np.float64,
+                  max_memory=CORR_MAX_MEMORY):
+    """
+    The correlation of each pair of series, over the dates where both have
+    values (like ts.corr(), but without a loop over the pairs in Python; see
+    iter_corr_rows).
+
+    Args:
+        ts (pandas.DataFrame): One time series per column (like the result
+            of missing_data.get_ts(..., dropna=False)).
+        method (str): 'pearson' or 'spearman'.
+        min_periods (int): The minimum number of common dates of a pair (its
+            correlation is NaN with less).
+        dtype (numpy.dtype): The dtype of the computations and the
+            correlations (float64 or float32).
+        max_memory (int): The memory for the temporary matrices of each
+            block, in bytes.
+    Returns:
+        pandas.DataFrame: The correlations.
+        pandas.DataFrame: The number of common dates of each pair.
+    """
+    n_series = ts.shape[1]
+    corr = np.empty((n_series, n_series), dtype=dtype)
+    counts = np.empty((n_series, n_series), dtype=np.int32)
+    for rows, corr_rows, count_rows in iter_corr_rows(
+            ts, method=method, min_periods=min_periods, dtype=dtype,
+            max_memory=max_memory):
+        corr[rows], counts[rows] = corr_rows, count_rows
+    return (pd.DataFrame(corr, index=ts.columns, columns=ts.columns),
+            pd.DataFrame(counts, index=ts.columns, columns=ts.columns))
+
+
+def iter_corr_rows(ts, rows=None, method='pearson', min_periods=1,
+                   dtype=np.float64, max_memory=CORR_MAX_MEMORY):
+    """
+    The rows of the pairwise correlations of some series, in blocks of
+    series, so that the temporary matrices fit in max_memory.
+    For 'pearson', with the values x (0 where missing) and the masks m (1
+    where not missing), the sums over the common dates of all the pairs are
+    products: the counts are m'm, the sums x'm, the sums of squares (x*x)'m
+    and the sums of products x'x. The series are centered first, to lose
+    less precision in float32.
+    For 'spearman', both series of a pair are ranked over their common dates
+    (as ts.corr('spearman') does): the pairs of series with the same dates
+    are correlated as above, on the ranks of the series, and the other pairs
+    are ranked again, one series of the block at a time (see _spearman_row).
+
+    Args:
+        ts (pandas.DataFrame): One time series per column.
+        rows (numpy.ndarray): The positions of the series whose rows are
+            computed (all of them by default).
+        method (str): 'pearson' or 'spearman'.
+        min_periods (int): The minimum number of common dates of a pair.
+        dtype (numpy.dtype): The dtype of the computations and the
+            correlations.
+        max_memory (int): The memory for the temporary matrices of each
+            block, in bytes.
+    Yields:
+        numpy.ndarray: The positions of the series of the block.
+        numpy.ndarray: Their correlations with all the series.
+        numpy.ndarray: Their numbers of common dates with all the series.
+    """
+    if method not in ('pearson', 'spearman'):
+        raise ValueError("The method must be 'pearson' or 'spearman'.")
+    n_series = ts.shape[1]
+    rows = np.arange(n_series) if rows is None else np.asarray(rows)
+    series = _masked_series(ts.rank() if method == 'spearman' else ts,
+                            dtype)
+    if method == 'spearman':
+        values = np.array(ts.values, dtype=np.float64)
+        is_valid = ~np.isnan(values)
+        tie_index = _tie_index(values)
+        # The series with the same dates are ranked over all of them, so
+        # only the pairs with different dates are ranked again.
+        patterns = np.unique(is_valid, axis=1, return_inverse=True)[1]
+        patterns = patterns.ravel()
+
+    block = max(1, int(max_memory // (12 * n_series * series[0].itemsize)))
+    for start in range(0, len(rows), block):
+        block_rows = rows[start:start + block]
+        corr, counts = _corr_block(
+            tuple(array[:, block_rows] for array in series), series,
+            min_periods)
+        if method == 'spearman':
+            for k, i in enumerate(block_rows):
+                others = np.flatnonzero(patterns != patterns[i])
+                corr[k, others], counts[k, others] = _spearman_row(
+                    tie_index, is_valid, i, others, min_periods)
+        yield block_rows, corr, counts
+
+
+def _masked_series(ts, dtype):
+    """
+    The centered values (0 where missing), the masks and the squared values
+    of some series (see iter_corr_rows).
+    """
+    x = np.array(ts.values, dtype=dtype)
+    is_valid = ~np.isnan(x)
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        x -= np.nanmean(x, axis=0)
+    x[~is_valid] = 0
+    return x, is_valid.astype(dtype), x * x
+
+
+def _corr_block(block, series, min_periods):
+    """
+    The correlations and common counts of some series (block) with all the
+    series. Both are tuples of the centered values (0 where missing), the
+    masks and the squared values.
+    """
+    x_block, m_block, squares_block = block
+    x, m, squares = series
+    eps = np.finfo(x.dtype).eps * x.shape[0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        counts = m_block.T @ m
+        sum_x = x_block.T @ m
+        sum_y = m_block.T @ x
+        cov = x_block.T @ x - sum_x * sum_y / counts
+        sum_xx = squares_block.T @ m
+        sum_yy = m_block.T @ squares
+        var_x = sum_xx - sum_x * sum_x / counts
+        var_y = sum_yy - sum_y * sum_y / counts
+        corr = np.clip(cov / np.sqrt(var_x * var_y), -1, 1)
+    # Constant series (up to the rounding errors) have no correlation
+    corr[(var_x <= eps * sum_xx) | (var_y <= eps * sum_yy) |
+         (counts < max(min_periods, 2))] = np.nan
+    return corr, counts.round().astype(np.int32)
+
+
+def _tie_index(values):
+    """
+    The order of the values of each series (the missing ones last), the
+    inverse of that order, and the first and last positions (in that order)
+    of the group of ties of each value.
+    """
+    order = np.argsort(values, axis=0, kind='stable')
+    sorted_values = np.take_along_axis(values, order, axis=0)
+    positions = np.broadcast_to(np.arange(len(values))[:, None],
+                                values.shape)
+    is_new = sorted_values[1:] != sorted_values[:-1]
+    is_first = np.vstack([np.ones((1, values.shape[1]), bool), is_new])
+    is_last = np.vstack([is_new, np.ones((1, values.shape[1]), bool)])
+    first = np.maximum.accumulate(np.where(is_first, positions, 0), axis=0)
+    last = np.minimum.accumulate(
+        np.where(is_last, positions, len(values) - 1)[::-1], axis=0)[::-1]
+    inverse = np.empty_like(order)
+    np.put_along_axis(inverse, order, positions, axis=0)
+    return order, inverse, first, last
+
+
+def _common_ranks(is_common, first, last, inverse):
+    """
+    The ranks of some series over the dates in is_common, from the cumulative
+    counts of those dates in the order of each series (the ties get their
+    average rank). All the arguments are (date x series), in the order of
+    the series, except inverse, that takes them back to the order of the
+    dates.
+    """
+    counts = np.cumsum(is_common, axis=0, dtype=np.int32)
+    below = np.vstack([np.zeros((1, counts.shape[1]), np.int32), counts])
+    below = np.take_along_axis(below, first, axis=0)
+    ranks = below + (np.take_along_axis(counts, last, axis=0) - below + 1) / 2
+    return np.take_along_axis(ranks, inverse, axis=0)
+
+
+def _spearman_row(tie_index, is_valid, i, columns, min_periods):
+    """
+    The Spearman correlations and common counts of the series i with some
+    series (columns), each pair ranked over its common dates (see
+    _tie_index). The cumulative counts of the dates of the other series, in
+    the order of the values of the series i, give its ranks over the common
+    dates of each pair, and the cumulative counts of the dates of the series
+    i, in the order of each other series, give their ranks.
+    """
+    order, inverse, first, last = (array[:, columns] for array in tie_index)
+    is_common = is_valid[:, columns] & is_valid[:, [i]]
+    n_common = is_common.sum(axis=0)
+    corr = np.full(len(columns), np.nan)
+    if is_valid[:, i].sum() < max(min_periods, 2):
+        return corr, n_common
+
+    mean = (n_common + 1) / 2
+    i_order, i_inverse, i_first, i_last = (array[:, [i]]
+                                           for array in tie_index)
+    rank_i = _common_ranks(is_valid[np.ix_(i_order[:, 0], columns)],
+                           i_first, i_last, i_inverse)
+    rank_j = _common_ranks(is_valid[:, i][order], first, last, inverse)
+    rank_i = np.where(is_common, rank_i - mean, 0)
+    rank_j = np.where(is_common, rank_j - mean, 0)
+    cov = np.einsum('ij,ij->j', rank_i, rank_j)
+    var_i = np.einsum('ij,ij->j', rank_i, rank_i)
+    var_j = np.einsum('ij,ij->j', rank_j, rank_j)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr[:] = np.clip(cov / np.sqrt(var_i * var_j), -1, 1)
+    # The ranks are exact, so only constant series have no variance
+    corr[(var_i <= 0) | (var_j <= 0) | (n_common < max(min_periods, 2))] = \
+        np.nan
+    return corr, n_common
+
+
+def closest(points, centers, max_memory=CORR_MAX_MEMORY):
+    """
+    The index of the closest center to each point (in blocks of points, so
+    that the distances fit in max_memory).
     """
-    X = ts.corr().fillna(0).values
-    d = sch.distance.pdist(X)
-    L = sch.linkage(d, method='complete')
-    ind = sch.fcluster(L, 0.5*d.max(), 'distance')
-    columns = [ts.columns.tolist()[i] for i in list((np.argsort(ind)))]
-    clmts = ts.reindex_axis(columns, axis=1)
-    return clmts, ind
+    block = max(1, int(max_memory // (8 * len(centers))))
+    center_norms = (centers ** 2).sum(axis=1)
+    return np.concatenate([
+        np.argmin(center_norms - 2 * points[start:start + block] @ centers.T,
+                  axis=1)
+        for start in range(0, len(points), block)])
@@ -0,0 +1,28 @@
+import os
+import shutil
+import uuid
+import pytest
+from src.data import DATA_INTERIM, DATA_PROCESSED, MODELS_DIR
+from src.data import make_dataset
+from src.data import synthetic
+
+
+@pytest.fixture(scope='session')
+def processed_city(tmp_path_factory):
+    """
+    A small synthetic city, processed into the data folders under a unique
+    name (that is removed afterwards).
+
+    Returns:
+        str: The raw data directory.
+        str: The city.
+    """
+    raw_dir = str(tmp_path_factory.mktemp('raw'))
+    city = 'test_' + uuid.uuid4().hex[:8]
+    synthetic.create_synthetic_city(scale=0.05, raw_dir=raw_dir, city=city)
+    try:
+        make_dataset.create_dataset(raw_dir, use_cache=False, city=city)
+        yield raw_dir, city
+    finally:
+        for data_dir in [DATA_INTERIM, DATA_PROCESSED, MODELS_DIR]:
+            shutil.rmtree(os.path.join(data_dir, city), ignore_errors=True)
@@ -0,0 +1,13 @@
+import os
+from src.benchmark import run_benchmarks
+from src.data import DATA_INTERIM, DATA_PROCESSED
+from src.data.synthetic import city_name
+
+
+def test_benchmarks_leave_the_data_folders_alone(tmp_path):
+    results = run_benchmarks([0.02], ['fill_df_in_time'], data_dir=tmp_path)
+
+    assert [result['status'] for result in results] == ['ok']
+    assert os.listdir(os.path.join(tmp_path, city_name(0.02)))
+    for data_dir in [DATA_INTERIM, DATA_PROCESSED]:
+        assert not os.path.exists(os.path.join(data_dir, city_name(0.02)))
@@ -0,0 +1,21 @@
+import os
+import subprocess
+import sys
+from src.data import storage
+from src.data import DATA_PROCESSED, ROOT_DIR, featurizer_path, table_path
+from src.features.build_features import ListingsFeaturizer
+
+
+def test_cli_featurizer_loads_in_another_process(processed_city):
+    _, city = processed_city
+    env = dict(os.environ, PYTHONPATH=ROOT_DIR)
+    subprocess.run([sys.executable, 'src/features/build_features.py',
+                    '--city', city, '--no-cache'],
+                   cwd=ROOT_DIR, env=env, check=True)
+
+    featurizer = ListingsFeaturizer.load(featurizer_path(city))
+
+    assert type(featurizer) is ListingsFeaturizer
+    listings = storage.load_table(table_path(DATA_PROCESSED, city,
+                                             'listings'))
+    assert featurizer.transform(listings).shape[0] == len(listings)
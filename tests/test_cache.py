@@ -0,0 +1,22 @@
+import pandas as pd
+from src.data import cache
+from src.profiling import profiling
+
+
+def test_cached_stages_are_profiled_as_loads(tmp_path):
+    def double(values):
+        return (values * 2,)
+
+    stages = [('first', lambda: (pd.Series([1, 2, 3]),), [], None),
+              ('double', double, [], None)]
+    cache_dir = str(tmp_path)
+    with profiling(log_summary=False) as records:
+        first = cache.run_pipeline(stages, ['input'], cache_dir)
+    assert records == []
+    with profiling(log_summary=False) as records:
+        second = cache.run_pipeline(stages, ['input'], cache_dir)
+
+    pd.testing.assert_series_equal(second[0], first[0])
+    assert [record['step'] for record in records] == [
+        'double stage (cache)']
+    assert records[0]['rows_out'] == 3
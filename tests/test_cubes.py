@@ -0,0 +1,59 @@
+import os
+import numpy as np
+import pandas as pd
+from src.data import price_cube_dir, table_path
+from src.data import aggregate_cube, price_cube, storage
+
+DATES = pd.to_datetime(['2016-01-04', '2016-01-05'])
+
+
+def calendar_with_gaps():
+    """
+    A processed calendar with a row without listing_id and one without date.
+    """
+    return pd.DataFrame({
+        'listing_id': [1, 1, 2, 2, np.nan, 2],
+        'date': [DATES[0], DATES[1], DATES[0], DATES[1], DATES[0], pd.NaT],
+        'available': [True, True, False, True, True, True],
+        'price': [10.0, 11.0, 20.0, 21.0, 99.0, 99.0]})
+
+
+def test_price_cube_leaves_out_rows_without_listing_or_date(tmp_path):
+    data_dir = str(tmp_path)
+    storage.save_table(calendar_with_gaps(),
+                       table_path(data_dir, 'test', 'calendar'))
+
+    cube = price_cube.build_price_cube('test', data_dir=data_dir)
+
+    assert os.path.isdir(price_cube_dir('test', data_dir))
+    assert cube.listing_ids.tolist() == [1, 2]
+    assert (cube.dates == DATES.values).all()
+    assert cube.values.tolist() == [[10, 11], [20, 21]]
+
+
+def test_aggregate_leaves_out_rows_without_listing_or_date():
+    listings = pd.DataFrame({
+        'id': [1, 2], aggregate_cube.SCORE_COL: [9.0, 10.0],
+        'neighbourhood_cleansed': ['a', 'a'],
+        'room_type': ['Private room', 'Private room'],
+        'property_type': ['House', 'House']})
+    cells = aggregate_cube.aggregate(calendar_with_gaps(), listings)
+    assert (cells.date == DATES).all()
+    assert cells.listing_days.tolist() == [2, 2]
+    assert cells.price_sum.tolist() == [30, 32]
+
+
+def test_aggregate_keeps_the_missing_dimensions_missing():
+    listings = pd.DataFrame({
+        'id': [1, 2], aggregate_cube.SCORE_COL: [9.0, 10.0],
+        'neighbourhood_cleansed': ['a', 'a'],
+        'room_type': ['Private room', np.nan],
+        'property_type': ['House', 'House']})
+    cells = aggregate_cube.aggregate(calendar_with_gaps(), listings)
+
+    assert cells.room_type.cat.categories.tolist() == ['Private room']
+    assert cells.room_type.isnull().sum() == 2
+    by_room = aggregate_cube.AggregateCube(cells).query(by=['room_type'])
+    assert by_room.listing_days.sum() == 4
+    assert by_room.mean_price.tolist() == [10.5, 20.5]
+    assert pd.isnull(by_room.index[1])
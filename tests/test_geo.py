@@ -0,0 +1,95 @@
+import json
+import numpy as np
+import pandas as pd
+from src.geo import PolygonIndex, assign_neighbourhoods
+
+
+def square(x, y, size=1.0):
+    return np.array([[x, y], [x + size, y], [x + size, y + size],
+                     [x, y + size], [x, y]])
+
+
+def sample_polygons():
+    """
+    A 3 x 3 grid of unit squares, an L-shaped polygon, a square with a hole,
+    and a polygon of two parts.
+    """
+    squares = [[square(x, y)] for x in range(3) for y in range(3)]
+    l_shape = [np.array([[4, 0], [6, 0], [6, 1], [5, 1], [5, 3], [4, 3]],
+                        dtype=float)]
+    with_hole = [square(0, 4, 3), square(1, 5)[::-1]]
+    two_parts = [square(4, 4), square(6, 6, 0.5)]
+    return squares + [l_shape, with_hole, two_parts]
+
+
+def ray_cast(rings, x, y):
+    """ The even-odd rule, one edge at a time. """
+    inside = False
+    for ring in rings:
+        if not np.array_equal(ring[0], ring[-1]):
+            ring = np.vstack([ring, ring[:1]])
+        for (x1, y1), (x2, y2) in zip(ring[:-1], ring[1:]):
+            if (y1 > y) != (y2 > y):
+                if x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+                    inside = not inside
+    return inside
+
+
+def brute_force(polygons, x, y):
+    """ The first polygon that contains each point, or -1. """
+    return np.array([next((i for i, rings in enumerate(polygons)
+                           if ray_cast(rings, px, py)), -1)
+                     for px, py in zip(x, y)])
+
+
+def test_the_grid_index_as_brute_force():
+    polygons = sample_polygons()
+    rng = np.random.RandomState(0)
+    # Random points, many of them outside the bounding box of the map
+    x = rng.uniform(-2, 9, 2000)
+    y = rng.uniform(-2, 9, 2000)
+    # Points on the edges and the vertices, shared or not
+    grid = np.arange(0, 7.5, 0.5)
+    edge_x, edge_y = [values.ravel() for values in np.meshgrid(grid, grid)]
+    x = np.concatenate([x, edge_x, [np.nan, 1.5]])
+    y = np.concatenate([y, edge_y, [0.5, np.nan]])
+
+    # Few cells, so that most of them straddle the polygon boundaries
+    for cells_per_polygon in [0.1, 1, 4, 50]:
+        index = PolygonIndex(polygons, cells_per_polygon)
+        np.testing.assert_array_equal(index.query(x, y),
+                                      brute_force(polygons, x, y))
+
+
+def test_edge_points_are_in_one_polygon():
+    index = PolygonIndex(sample_polygons())
+    # On the edges shared by the squares of the grid
+    result = index.query([1, 1, 2, 0.5, 0.5, 1], [0.5, 1.5, 2.5, 1, 2, 1])
+    assert result.tolist() == [3, 4, 8, 1, 2, 4]
+    # The hole, and outside the bounding box
+    assert index.query([1.5, -1, 10], [5.5, 0.5, 0.5]).tolist() == [-1] * 3
+
+
+def test_assign_neighbourhoods(tmp_path):
+    map_path = str(tmp_path / 'map.geojson')
+    features = [
+        {'type': 'Feature', 'properties': {'name': 'a'},
+         'geometry': {'type': 'Polygon',
+                      'coordinates': [square(0, 0).tolist()]}},
+        {'type': 'Feature', 'properties': {'name': 'b'},
+         'geometry': {'type': 'MultiPolygon',
+                      'coordinates': [[square(1, 0).tolist()],
+                                      [square(3, 0).tolist()]]}}]
+    with open(map_path, 'w') as map_file:
+        json.dump({'type': 'FeatureCollection', 'features': features},
+                  map_file)
+    listings = pd.DataFrame({'id': [10, 11, 12, 13],
+                             'longitude': [0.5, 1.5, 3.5, 2.5],
+                             'latitude': [0.5, 0.5, 0.5, 0.5]})
+
+    assigned = assign_neighbourhoods(listings, map_path)
+
+    assert assigned.id.tolist() == [10, 11, 12, 13]
+    assert assigned.polygon.tolist() == [0, 1, 1, -1]
+    assert assigned.name.tolist()[:3] == ['a', 'b', 'b']
+    assert pd.isnull(assigned.name.iloc[3])
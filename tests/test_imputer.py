@@ -0,0 +1,41 @@
+import os
+import numpy as np
+import pandas as pd
+import src.data.missing_data as md
+import src.data.preprocessing as pp
+import src.data.schema as schema
+from src.data import listings_cols_path
+from src.data.imputer import ListingsImputer
+
+
+def transformed_listings(raw_dir, city):
+    _, listings, _ = pp.load_data(raw_dir, city)
+    cols_df = schema.load_column_kinds(
+        os.path.join(raw_dir, city, 'listings.csv'), listings,
+        listings_cols_path(city))
+    return pp.transform_listings(listings, cols_df), cols_df
+
+
+def test_only_the_property_type_is_filled_with_the_mode(processed_city):
+    listings, cols_df = transformed_listings(*processed_city)
+    rows = listings.index[listings.host_since.notnull()][:3]
+    listings.loc[rows, ['property_type', 'room_type']] = np.nan
+
+    filled = ListingsImputer(cols_df).fit_transform(listings)
+
+    assert filled.property_type.notnull().all()
+    assert filled.room_type.isnull().sum() == 3
+
+
+def test_the_fill_cols_helpers_as_the_imputer(processed_city):
+    listings, cols_df = transformed_listings(*processed_city)
+    expected = ListingsImputer(cols_df).fit_transform(listings)
+
+    steps = [md.fill_num_cols, md.fill_price_cols, md.fill_tf_cols,
+             md.fill_free_text_cols, md.fill_url_cols, md.fill_location_cols,
+             md.fill_date_cols, md.fill_percent_cols, md.fill_time_cols,
+             md.fill_cat_cols]
+    for fill_cols in steps:
+        listings, cols_df = fill_cols(listings, cols_df)
+
+    pd.testing.assert_frame_equal(listings, expected)
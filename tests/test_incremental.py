@@ -0,0 +1,34 @@
+import os
+import pandas as pd
+import src.data.incremental as inc
+
+
+def load_raw_listings(raw_dir, city):
+    return pd.read_csv(os.path.join(raw_dir, city, 'listings.csv'))
+
+
+def changed_listings(old, new):
+    keys = inc.KEYS['listings']
+    is_changed, removed = inc.diff_rows(inc.row_hashes(old, keys),
+                                        inc.row_hashes(new, keys), keys)
+    return is_changed.sum(), len(removed)
+
+
+def test_rescrape_with_only_metadata_changed(processed_city):
+    listings = load_raw_listings(*processed_city)
+    rescraped = listings.copy()
+    rescraped['scrape_id'] += 1
+    rescraped['last_scraped'] = '2016-02-04'
+    rescraped['calendar_last_scraped'] = '2016-02-04'
+    rescraped['calendar_updated'] = 'today'
+
+    assert changed_listings(listings, rescraped) == (0, 0)
+
+
+def test_rescrape_with_a_changed_price(processed_city):
+    listings = load_raw_listings(*processed_city)
+    rescraped = listings.copy()
+    rescraped['last_scraped'] = '2016-02-04'
+    rescraped.loc[3, 'price'] = '$1,234.00'
+
+    assert changed_listings(listings, rescraped) == (1, 0)
@@ -0,0 +1,54 @@
+import os
+import shutil
+import pandas as pd
+import pytest
+import src.data.incremental as inc
+from src.data import DATA_INTERIM, DATA_PROCESSED, MODELS_DIR, table_path
+from src.data import make_dataset, storage
+
+
+def test_chunks_give_the_same_dataset(processed_city):
+    raw_dir, city = processed_city
+    chunks_city = city + '_chunks'
+    shutil.copytree(os.path.join(raw_dir, city),
+                    os.path.join(raw_dir, chunks_city))
+    try:
+        make_dataset.create_dataset(raw_dir, chunksize=5000, use_cache=False,
+                                    city=chunks_city)
+        for data_dir in [DATA_INTERIM, DATA_PROCESSED]:
+            for table in make_dataset.TABLES:
+                pd.testing.assert_frame_equal(
+                    storage.load_table(table_path(data_dir, chunks_city,
+                                                  table)),
+                    storage.load_table(table_path(data_dir, city, table)))
+    finally:
+        for data_dir in [DATA_INTERIM, DATA_PROCESSED, MODELS_DIR]:
+            shutil.rmtree(os.path.join(data_dir, chunks_city),
+                          ignore_errors=True)
+
+
+def test_dask_gives_the_same_dataset(processed_city):
+    pytest.importorskip('dask.distributed')
+    from src.data import dask_pipeline
+    raw_dir, city = processed_city
+    dask_city = city + '_dask'
+    shutil.copytree(os.path.join(raw_dir, city),
+                    os.path.join(raw_dir, dask_city))
+    try:
+        # Stale hashes of a previous snapshot
+        inc.save_row_hashes({table: pd.DataFrame({'row_hash': [0]})
+                             for table in inc.KEYS}, dask_city)
+        results = dask_pipeline.create_datasets(raw_dir, [dask_city],
+                                                n_workers=2)
+        assert results[0][1] == 'ok'
+        assert not inc.has_row_hashes(dask_city)
+        for data_dir in [DATA_INTERIM, DATA_PROCESSED]:
+            for table in make_dataset.TABLES:
+                pd.testing.assert_frame_equal(
+                    storage.load_table(table_path(data_dir, dask_city,
+                                                  table)),
+                    storage.load_table(table_path(data_dir, city, table)))
+    finally:
+        for data_dir in [DATA_INTERIM, DATA_PROCESSED, MODELS_DIR]:
+            shutil.rmtree(os.path.join(data_dir, dask_city),
+                          ignore_errors=True)
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+from src.data.missing_data import fill_df_in_time, fill_in_time, get_ts
+
+
+def pivot_fill_df_in_time(df, idx_col='listing_id', value_col='price'):
+    """ The previous fill_df_in_time, through the (date x listing) table. """
+    tmp_df = df.copy()
+    ts = get_ts(tmp_df, values_col=value_col)
+    ts = ts.apply(fill_in_time)
+    tmp_df = tmp_df.set_index([idx_col, 'date'])
+    tmp_df[value_col] = tmp_df[value_col].fillna(ts.unstack())
+    return tmp_df.reset_index()
+
+
+def gappy_calendar():
+    """
+    Four listings: with leading, interior and trailing gaps, and one without
+    any price.
+    """
+    dates = pd.date_range('2016-01-04', periods=6)
+    prices = {1: [np.nan, np.nan, 10, 11, np.nan, 12],
+              2: [20, np.nan, np.nan, 21, np.nan, np.nan],
+              3: [np.nan] * 6,
+              4: [30, 31, 32, 33, 34, 35]}
+    return pd.DataFrame({
+        'listing_id': np.repeat(list(prices), len(dates)),
+        'date': np.tile(dates, len(prices)),
+        'available': True,
+        'price': np.concatenate(list(prices.values())).astype(float)})
+
+
+def test_fill_df_in_time_as_the_pivot():
+    calendar = gappy_calendar()
+    shuffled = calendar.sample(frac=1, random_state=0)
+    for df in [calendar, shuffled]:
+        expected = pivot_fill_df_in_time(df).sort_values(
+            ['listing_id', 'date']).reset_index(drop=True)
+        result = fill_df_in_time(df).sort_values(
+            ['listing_id', 'date']).reset_index(drop=True)
+        pd.testing.assert_frame_equal(result, expected)
+        assert result.price[result.listing_id == 3].isnull().all()
+
+
+def test_fill_df_in_time_fills_the_dates_without_prices():
+    calendar = gappy_calendar()
+    calendar.loc[calendar.listing_id == 4, 'price'] = [
+        30, 31, 32, 33, np.nan, 35]
+    empty_date = (calendar.date == calendar.date.unique()[4]).values
+    assert calendar.price[empty_date].isnull().all()
+    expected = pivot_fill_df_in_time(calendar)
+    result = fill_df_in_time(calendar)
+
+    # The pivot fill leaves the empty date missing; the other dates match
+    assert expected.price[empty_date].isnull().all()
+    pd.testing.assert_frame_equal(result[~empty_date],
+                                  expected[~empty_date])
+    # It is filled within each listing, as if it were one more gap
+    pd.testing.assert_series_equal(
+        result.price[empty_date].reset_index(drop=True),
+        pd.Series([11, 21, np.nan, 33], name='price'))
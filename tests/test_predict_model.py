@@ -0,0 +1,94 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+import numpy as np
+import pandas as pd
+from src.models.predict_model import MicroBatcher, make_server
+
+
+class FailingScorer(object):
+    """ Scores the price, and fails on the prices that aren't numbers. """
+
+    def validate(self, listings):
+        return listings
+
+    def score(self, listings):
+        return listings.price.astype(float).values
+
+
+def test_micro_batch_failure_only_fails_the_bad_request():
+    batcher = MicroBatcher(FailingScorer(), max_batch_size=100, max_wait=0.5)
+    requests = [pd.DataFrame({'price': [10, 20, 30]}),
+                pd.DataFrame({'price': ['n/a']})]
+    results = [None, None]
+
+    def submit(i):
+        try:
+            results[i] = batcher.submit(requests[i])
+        except ValueError as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    batcher.close()
+
+    np.testing.assert_array_equal(results[0], [10, 20, 30])
+    assert isinstance(results[1], ValueError)
+
+
+class CheckingScorer(object):
+    """
+    Requires a price, fails to score the negative ones, and counts the
+    validations.
+    """
+
+    def __init__(self):
+        self.n_validations = 0
+
+    def frame(self, records):
+        return self.validate(pd.DataFrame.from_records(records))
+
+    def validate(self, listings):
+        self.n_validations += 1
+        if 'price' not in listings.columns:
+            raise ValueError('Missing columns: price')
+        return listings
+
+    def score(self, listings):
+        if (listings.price < 0).any():
+            raise RuntimeError('The model failed')
+        return listings.price.astype(float).values
+
+
+def post(port, body):
+    request = urllib.request.Request(
+        'http://127.0.0.1:{}/score'.format(port), data=body.encode(),
+        method='POST')
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_server_errors_of_the_client_and_of_the_scoring():
+    scorer = CheckingScorer()
+    batcher = MicroBatcher(scorer, max_batch_size=100, max_wait=0.01)
+    server = make_server(batcher, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    port = server.server_address[1]
+    try:
+        assert post(port, '[{"price": 10}]') == (200, {'scores': [10.0]})
+        assert scorer.n_validations == 1
+        assert post(port, '[{"price": ')[0] == 400
+        assert post(port, '[{"beds": 1}]')[0] == 400
+        assert post(port, '[{"price": -1}]')[0] == 500
+    finally:
+        server.shutdown()
+        server.server_close()
+        batcher.close()
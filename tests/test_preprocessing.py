@@ -0,0 +1,81 @@
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import pytest
+import src.data.preprocessing as pp
+from src.utils import pandify
+
+
+# The per-cell converters that CONVERTERS replaced
+@pandify
+def scalar_price_to_float(price_str):
+    if price_str is np.nan:
+        return np.nan
+    return float(price_str[1:].replace(',', ''))
+
+
+@pandify
+def scalar_string2bool(text):
+    if (text == 't') or (text == 'True'):
+        return True
+    elif (text == 'f') or (text == 'False'):
+        return False
+    else:
+        return np.nan
+
+
+@pandify
+def scalar_string2date(text):
+    if text is np.nan:
+        return np.nan
+    return datetime.strptime(text, '%Y-%m-%d')
+
+
+@pandify
+def scalar_percent2num(text):
+    if text is np.nan:
+        return np.nan
+    return float(text[:-1])
+
+
+def cells(df):
+    """ The values of a dataframe, by row, with None for NaN and NaT. """
+    return [[None if pd.isnull(value) else value for value in row]
+            for row in df.itertuples(index=False)]
+
+
+@pytest.mark.parametrize('kind, scalar_converter, values', [
+    ('price_cols', scalar_price_to_float,
+     ['$1,067.00', '$5', '$12,345,678.50', np.nan]),
+    ('percent_cols', scalar_percent2num, ['14%', '100%', '0%', np.nan]),
+    ('tf_cols', scalar_string2bool, ['t', 'f', 'True', 'False', np.nan, '']),
+    ('date_cols', scalar_string2date, ['2016-01-04', '2015-12-31', np.nan]),
+])
+def test_converters_as_the_scalar_ones(kind, scalar_converter, values):
+    df = pd.DataFrame({'a': values, 'b': values[::-1]}, dtype=object)
+
+    result = pp.CONVERTERS[kind](df)
+    expected = scalar_converter(df)
+
+    assert cells(result) == cells(expected)
+
+
+@pytest.mark.parametrize('kind', ['price_cols', 'percent_cols', 'date_cols'])
+def test_converters_reject_empty_strings(kind):
+    with pytest.raises(ValueError):
+        pp.CONVERTERS[kind](pd.Series(['', np.nan], dtype=object))
+
+
+def test_find_str_and_is_tf_as_the_cell_checks():
+    df = pd.DataFrame({'price': ['$1,067.00', '$5', np.nan],
+                       'text': ['no dollars', 'cost: $3', 't'],
+                       'tf': ['t', 'False', np.nan],
+                       'number': [1, 2, 3],
+                       'empty': [np.nan] * 3})
+    has_dsign = [[isinstance(value, str) and '$' in value for value in row]
+                 for row in df.itertuples(index=False)]
+    tfs = [[value in ('t', 'f', 'True', 'False') for value in row]
+           for row in df.itertuples(index=False)]
+
+    assert pp.find_str(df).values.tolist() == has_dsign
+    assert pp.is_tf(df).values.tolist() == tfs
@@ -0,0 +1,78 @@
+import os
+import shutil
+import uuid
+import numpy as np
+import pandas as pd
+import pytest
+from src.data import DATA_PROCESSED, table_path
+from src.data import storage
+from src.features import review_features as rf
+
+
+def raw_reviews():
+    return pd.DataFrame({
+        'id': range(5),
+        'listing_id': [1, 1, 2, 2, 3],
+        'comments': ['Great clean place, the host was lovely.',
+                     'Dirty and noisy. Bad location.',
+                     'El piso es muy bonito y la cocina es muy limpia',
+                     np.nan,
+                     '12345']})
+
+
+def test_comment_features():
+    features = rf.comment_features(raw_reviews().comments.dropna())
+
+    assert features.words.tolist() == [7, 5, 11, 0]
+    assert features.sentiment.tolist() == [3 / 7, -3 / 5, 0, 0]
+    assert features.language.tolist() == ['en', 'en', 'es', '']
+    assert features.clean_count.tolist() == [1, 0, 0, 0]
+    assert features.noise_count.tolist() == [0, 1, 0, 0]
+    assert features.location_count.tolist() == [0, 1, 0, 0]
+
+
+def test_the_chunks_add_up_to_the_whole_file():
+    reviews = raw_reviews()
+    whole = rf.chunk_sums(reviews)
+    chunks = rf.add_sums(rf.chunk_sums(reviews.iloc[i:i + 2])
+                         for i in range(0, len(reviews), 2))
+
+    assert whole.columns.tolist() == rf.SUM_COLS
+    pd.testing.assert_frame_equal(chunks, whole, check_dtype=False)
+    features = rf.aggregate_features(whole)
+    assert features.n_reviews.tolist() == [2, 1, 1]
+    assert features.lang_en.tolist() == [1, 0, 0]
+    assert features.loc[1, 'mean_words'] == 6
+
+
+@pytest.mark.parametrize('chunks', [
+    [],
+    [raw_reviews().iloc[:0]],
+    [raw_reviews().iloc[3:4]],
+])
+def test_no_reviews_give_empty_features(chunks):
+    sums = rf.add_sums(rf.chunk_sums(chunk) for chunk in chunks)
+    features = rf.aggregate_features(sums)
+
+    assert sums.columns.tolist() == rf.SUM_COLS
+    assert len(features) == 0
+    assert features.columns.tolist() == rf.aggregate_features(
+        rf.chunk_sums(raw_reviews())).columns.tolist()
+
+
+def test_create_review_features_of_an_empty_file(tmp_path):
+    city = 'test_' + uuid.uuid4().hex[:8]
+    os.makedirs(os.path.join(tmp_path, city))
+    raw_reviews().iloc[:0].to_csv(
+        os.path.join(tmp_path, city, 'reviews.csv'), index=False)
+    try:
+        features = rf.create_review_features(str(tmp_path), city,
+                                             n_workers=1)
+        saved = storage.load_table(table_path(DATA_PROCESSED, city,
+                                              'review_features'))
+    finally:
+        shutil.rmtree(os.path.join(DATA_PROCESSED, city),
+                      ignore_errors=True)
+
+    assert len(features) == 0
+    assert len(saved) == 0
@@ -0,0 +1,23 @@
+import numpy as np
+import pandas as pd
+from src.data import schema
+
+
+def test_known_kinds_are_assigned_by_name():
+    # Few rows, where the free text repeats like a category
+    listings = pd.DataFrame({
+        'summary': ['Cozy room'] * 8 + ['Big house', np.nan],
+        'space': ['Nice'] * 10,
+        'room_type': ['Private room'] * 5 + ['Entire home/apt'] * 5,
+        'host_response_time': ['within an hour'] * 10,
+        'price': ['$1,000.00', '$50.00'] * 5,
+        'accommodates': range(10)})
+
+    kinds = schema.infer_column_kinds(listings).kind
+
+    assert kinds.summary == 'free_text_cols'
+    assert kinds.space == 'free_text_cols'
+    assert kinds.room_type == 'categorical_simple_cols'
+    assert kinds.host_response_time == 'time_cols'
+    assert kinds.price == 'price_cols'
+    assert kinds.accommodates == 'num_cols'
@@ -0,0 +1,44 @@
+import logging
+import os
+import pandas as pd
+import pytest
+import src.data.dtypes as dt
+import src.data.missing_data as md
+import src.data.preprocessing as pp
+import src.data.schema as schema
+from src.data import listings_cols_path, table_path
+from src.data import storage
+
+
+def processed_tables(raw_dir, city):
+    """ The processed tables of a city, as create_dataset saves them. """
+    calendar, listings, reviews = pp.load_data(raw_dir, city)
+    cols_df = schema.load_column_kinds(
+        os.path.join(raw_dir, city, 'listings.csv'), listings,
+        listings_cols_path(city))
+    tables = md.fill_missing(*pp.transform_all(calendar, listings, reviews,
+                                               listings_cols_df=cols_df),
+                             city=city)
+    return dict(zip(['calendar', 'listings', 'reviews'],
+                    dt.compact_all(*tables)))
+
+
+@pytest.mark.parametrize('data_format', ['parquet', 'feather'])
+def test_processed_tables_round_trip(processed_city, tmp_path, caplog,
+                                     data_format):
+    tables = processed_tables(*processed_city)
+    for name, df in tables.items():
+        path = table_path(str(tmp_path), 'test', name, data_format)
+        with caplog.at_level(logging.WARNING, logger=storage.__name__):
+            storage.save_table(df, path)
+        assert not caplog.records
+        pd.testing.assert_frame_equal(storage.load_table(path), df)
+
+
+def test_mixed_columns_are_logged(tmp_path, caplog):
+    df = pd.DataFrame({'tf': [True, 0.5, None], 'text': ['a', 1, None]})
+    path = table_path(str(tmp_path), 'test', 'mixed', 'parquet')
+    with caplog.at_level(logging.WARNING, logger=storage.__name__):
+        storage.save_table(df, path)
+    assert "['tf']" in caplog.text
+    assert "['text']" in caplog.text
@@ -0,0 +1,17 @@
+import os
+import numpy as np
+import pandas as pd
+from src.models.train_model import TARGET, training_data
+
+
+def test_training_data_leaves_out_the_imputed_targets(processed_city):
+    raw_dir, city = processed_city
+    raw = pd.read_csv(os.path.join(raw_dir, city, 'listings.csv'))
+    # The listings without host_since are dropped by the imputer
+    scores = raw[TARGET][raw.host_since.notnull()]
+    assert scores.isnull().any()
+
+    _, y, names = training_data(city, TARGET)
+
+    np.testing.assert_allclose(np.sort(y), np.sort(scores.dropna()))
+    assert not any(name.startswith('review_scores_') for name in names)
@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+import scipy.cluster.hierarchy as sch
+from src.utils import cluster_corr, pairwise_corr
+
+
+def gappy_ts(n_dates=80, n_series=30, seed=0):
+    random = np.random.RandomState(seed)
+    ts = pd.DataFrame(random.randn(n_dates, n_series).cumsum(axis=0).round())
+    ts = ts.mask(random.rand(n_dates, n_series) < 0.3)
+    ts[3] = 5.0
+    ts.iloc[:-4, 4] = np.nan
+    ts.iloc[:20, 10:20] = np.nan
+    return ts
+
+
+def test_pairwise_corr_as_pandas():
+    ts = gappy_ts()
+    for method in ['pearson', 'spearman']:
+        corr, counts = pairwise_corr(ts, method, min_periods=3,
+                                     max_memory=10000)
+        expected = ts.corr(method, min_periods=3)
+        np.testing.assert_allclose(corr.values, expected.values, atol=1e-10)
+        assert (counts.values == ts.notnull().astype(int).T.dot(
+            ts.notnull().astype(int)).values).all()
+
+
+def test_cluster_corr_as_the_notebook():
+    ts = gappy_ts(seed=1).fillna(0)
+    corr = ts.corr().fillna(0).values
+    d = sch.distance.pdist(corr)
+    expected = sch.fcluster(sch.linkage(d, method='complete'),
+                            0.5 * d.max(), 'distance')
+
+    clustered, ind = cluster_corr(ts)
+    assert (pd.crosstab(expected, ind).gt(0).sum(axis=1) == 1).all()
+    assert (ts.columns[np.argsort(ind, kind='stable')] ==
+            clustered.columns).all()